@@ -0,0 +1,124 @@
+#! /usr/bin/env python3
+"""Benchmark the matching of DICOM series against autolist rules.
+
+Compares testing every (series, rule) pair with autolist.rule_matches, as
+autolist did before RuleMatcher, with a RuleMatcher compiled once for all
+the sessions of a study.
+
+Usage: python benchmarks/autolist_matcher.py [--rules N] [--series N]
+       [--sessions N]
+"""
+
+import argparse
+import random
+import time
+
+from neurospin_to_bids import autolist
+
+TASKS = ['rest', 'localizer', 'nback', 'motor', 'language', 'faces', 'reward']
+ACQUISITIONS = ['PA', 'AP', 'LR', 'RL']
+
+
+def make_rules(count, rng):
+    """Generate rules similar to those of NeuroSpin studies."""
+    rules = [
+        {'SeriesDescription': 'mprage-sag-T1*', 'data_type': 'anat'},
+        {'SeriesDescription': 't2-space-sag*', 'data_type': 'anat'},
+        {'SeriesDescription': '*flair*', 'data_type': 'anat'},
+        {'SeriesDescription': 'b0-gre-field-mapping', 'data_type': 'fmap'},
+        {'SeriesDescription': '*_SBRef', 'data_type': 'func'},
+        {'SeriesDescription': 'dwi-*-[0-9]*', 'data_type': 'dwi'},
+    ]
+    while len(rules) < count:
+        task = rng.choice(TASKS)
+        run = rng.randint(1, 20)
+        acq = rng.choice(ACQUISITIONS)
+        pattern = rng.choice(
+            [
+                f'mbepi-2mm-{task}-run{run:02d}-{acq}',
+                f'mbepi-?mm-{task}-run{run:02d}*',
+                f'ep2d-bold-{task}-{acq}*',
+                f'*{task}-run{run:02d}',
+            ]
+        )
+        rules.append({'SeriesDescription': pattern, 'data_type': 'func'})
+    for index, rule in enumerate(rules):
+        rule['bids_name'] = f'acq-{index}_bold'
+    return rules
+
+
+def make_session(count, rng):
+    """Generate the (SeriesNumber, SeriesDescription) of a session."""
+    descriptions = ['localizer', 'mprage-sag-T1-iso', 'b0-gre-field-mapping']
+    while len(descriptions) < count:
+        task = rng.choice(TASKS)
+        run = rng.randint(1, 20)
+        acq = rng.choice(ACQUISITIONS)
+        descriptions.append(
+            rng.choice(
+                [
+                    f'mbepi-2mm-{task}-run{run:02d}-{acq}',
+                    f'mbepi-2mm-{task}-run{run:02d}-{acq}_SBRef',
+                    f'ep2d-bold-{task}-{acq}',
+                    f'dwi-{acq}-{run}',
+                ]
+            )
+        )
+    return list(enumerate(descriptions, start=2))
+
+
+def match_naive(sessions, rules):
+    return [
+        [
+            [
+                rule_index
+                for rule_index, rule in enumerate(rules)
+                if autolist.rule_matches(rule, description)
+            ]
+            for _, description in session
+        ]
+        for session in sessions
+    ]
+
+
+def match_compiled(sessions, rules):
+    matcher = autolist.RuleMatcher(rules)
+    return [
+        [matcher.matching_rules(description) for _, description in session]
+        for session in sessions
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rules', type=int, default=120)
+    parser.add_argument('--series', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    rules = make_rules(args.rules, rng)
+    sessions = [make_session(args.series, rng) for _ in range(args.sessions)]
+
+    timings = {}
+    results = {}
+    for name, function in [('naive', match_naive), ('compiled', match_compiled)]:
+        start_time = time.perf_counter()
+        results[name] = function(sessions, rules)
+        timings[name] = time.perf_counter() - start_time
+    assert results['naive'] == results['compiled']
+    pairs = args.rules * args.series * args.sessions
+    print(
+        f'{args.rules} rules, {args.sessions} sessions of {args.series} series '
+        f'({pairs} pairs)'
+    )
+    for name, duration in timings.items():
+        print(
+            f'{name:>8}: {duration:.3f} s '
+            f'({1e3 * duration / args.sessions:.3f} ms per session)'
+        )
+    print(f' speedup: {timings["naive"] / timings["compiled"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 #! /usr/bin/env python3
 
 import argparse
+import collections
+import contextlib
+import datetime
+import functools
 import glob
 import importlib.resources
 import json
@@ -17,16 +21,42 @@ from pathlib import Path
 import mne
 import pandas as pd
 import pydeface.utils as pdu
-import yaml
 from bids_validator import BIDSValidator
 from mne_bids import make_dataset_description, write_raw_bids
 
-from . import acquisition_db, bids, exp_info, postprocess, utils
+from . import (
+    acquisition_db,
+    acquisition_index,
+    bids,
+    cache,
+    catalog,
+    compress,
+    convert,
+    dicom_headers,
+    discover,
+    exp_info,
+    fs_metadata,
+    io_limits,
+    journal,
+    manifest,
+    mirror,
+    output_staging,
+    pipeline,
+    postprocess,
+    scheduling,
+    staging,
+    utils,
+    watch,
+)
 from .utils import DataError, UserError, yes_no
 
 logger = logging.getLogger(__name__)
 
 
+PIPELINE_STAGES = ('compress', 'postprocess', 'deface', 'sidecar')
+"""Stages of the conversion pipeline whose concurrency can be configured."""
+
+
 def bids_copy_events(
     behav_path='exp_info/recorded_events', data_root_path='', dataset_name=None
 ):
@@ -223,6 +253,25 @@ def bids_acquisition_download(
     no_gz=False,
     data_orientation='default',
     dry_run=False,
+    jobs=None,
+    conversion_backend=None,
+    simulated_latency=0.0,
+    cache_dir=None,
+    cache_size=None,
+    staging_dir=None,
+    prefetch_depth=2,
+    staging_quota=None,
+    output_staging_dir=None,
+    stage_workers=None,
+    resume=False,
+    retry_failed=False,
+    memory_budget=None,
+    gzip_threads=None,
+    scan_workers=acquisition_db.DEFAULT_SCAN_WORKERS,
+    acquisition_catalog=None,
+    derived_series='convert',
+    check_completeness=None,
+    subjects=None,
 ):
     """Automatically download files from neurospin server to a BIDS dataset.
 
@@ -248,6 +297,76 @@ def bids_acquisition_download(
     extra digits for NIP, the NIP then would look like xxxxxxxx-ssss)
     6) Event file corresponding to downloaded bold.nii not found
 
+    The DICOM series are converted by the conversion_backend (see
+    convert.BACKENDS). By default all series are converted by a single
+    dcm2niibatch process. If jobs is given, one dcm2niix process is run per
+    series instead, with at most `jobs` of them running concurrently.
+
+    If cache_dir is given, the outputs of the conversions are stored in this
+    directory, and reused whenever the same series is imported again (see
+    cache.ConversionCache). cache_size is the maximum size of the cache in
+    bytes.
+
+    If staging_dir is given, the DICOM series are copied to this local
+    directory ahead of their conversion, prefetching up to prefetch_depth
+    series and using at most staging_quota bytes (see staging.SeriesStager).
+
+    If memory_budget is given, concurrent conversions are only started while
+    the sum of their estimated peak memory usage fits in this number of bytes
+    (see scheduling.ResourceBudget).
+
+    The size of the outputs is estimated before the conversion, and compared
+    with the free space of the dataset, sourcedata and scratch directories.
+    The shortfalls are reported as warnings, and a series is only converted if
+    its outputs still fit at the time of its conversion.
+
+    If output_staging_dir is given, the session directories are built in this
+    local directory, and moved into the dataset once they are complete (see
+    output_staging.OutputStaging).
+
+    The series to be converted flow through a pipeline of stages (conversion,
+    renaming, defacing, sidecar updates), which process them concurrently.
+    stage_workers maps the name of a stage (see PIPELINE_STAGES) to the number
+    of series that it processes at the same time (1 by default). Each session
+    is committed and marked as imported as soon as its last series is done.
+
+    If gzip_threads is given (and no_gz is false), the series are converted
+    to uncompressed NIfTI, and compressed in a separate stage of the pipeline
+    using this number of threads per file (see compress.gzip_file).
+
+    The progress of the conversion is recorded in a journal (see
+    journal.Journal). If resume is true, the series that were planned by the
+    previous run but not completed are converted, without reading
+    participants_to_import.tsv or looking up the acquisition database again.
+    If retry_failed is true, the series whose conversion or post-processing
+    failed are converted again.
+
+    The session and series directories are looked up in the acquisition
+    database with scan_workers directories listed concurrently (see
+    acquisition_db.SessionResolver.prefetch).
+
+    If acquisition_catalog (catalog.Catalog) is given, a dry run reads the
+    number and size of the files of each series from the catalog instead of
+    the archive. Since the timestamps of the files are not in the catalog,
+    the series that are in the conversion manifest are then assumed to be
+    up to date.
+
+    If derived_series is 'tag' or 'skip', the DICOM header of each series to
+    convert is read (see dicom_headers.derived_series_reason), and a warning
+    is logged for the derived series (e.g. MPR, ROI, phoenix reports), which
+    are not converted if derived_series is 'skip'.
+
+    If check_completeness is 'warn' or 'defer', the number of files of each
+    series to convert is compared with the number expected from its DICOM
+    header (see dicom_headers.expected_instance_count). Incomplete series are
+    reported in the warnings, or with 'defer', left out of this import and
+    their session is not marked as imported, so that they are converted by
+    a later run.
+
+    If subjects is given, it is a list of lines of participants_to_import.tsv
+    (see exp_info.iterate_participants_list), which are imported instead of
+    reading the file (see watch.watch_archive).
+
     """
 
     ####################################
@@ -286,13 +405,88 @@ def bids_acquisition_download(
         # List for the bacth file for dc2nii_batch command
         infiles_dcm2nii = []
 
-        # List for data to deface
-        files_for_pydeface = []
+        gz_ext = '' if no_gz else '.gz'
 
-        # Dict of descriptors to be added
-        dict_descriptors = {}
+        conversion_options = {
+            'isGz': not no_gz,
+            'isFlipY': data_orientation != 'dicom',  # default is True
+            'isVerbose': False,
+            'isCreateBIDS': True,
+            'isOnlySingleFile': False,
+        }
+        dcm2nii_batch_file = os.path.join(exp_info_path, 'batch_dcm2nii.yaml')
 
-        gz_ext = '' if no_gz else '.gz'
+        # Journal of the progress of the conversion, for resuming it
+        conversion_journal = journal.Journal(
+            os.path.join(report_path, 'conversion_journal.jsonl')
+        )
+        resuming = resume or retry_failed
+
+        stager = None
+        if staging_dir is not None:
+            stager = staging.SeriesStager(
+                staging_dir,
+                depth=prefetch_depth,
+                quota=staging_quota,
+                on_staged=lambda series: conversion_journal.record(
+                    series['manifest_key'], 'staged'
+                ),
+            )
+        # When compressing in a separate stage, the fingerprints still use
+        # conversion_options: the outputs are compressed NIfTI either way. The
+        # cache stores the uncompressed outputs of the backend under a
+        # different key (see convert.cache_key).
+        separate_gzip = gzip_threads is not None and not no_gz
+        backend_options = conversion_options
+        if separate_gzip:
+            backend_options = dict(conversion_options, isGz=False)
+            if gzip_threads > 1 and compress.find_pigz() is None:
+                logger.warning(
+                    'pigz is not installed, each file is compressed in a '
+                    'single thread instead of %d',
+                    gzip_threads,
+                )
+        backend = convert.get_backend(
+            conversion_backend,
+            backend_options,
+            jobs=jobs,
+            batch_file=dcm2nii_batch_file,
+            latency=simulated_latency,
+            stager=stager,
+            memory_budget=(
+                None
+                if memory_budget is None
+                else scheduling.ResourceBudget(memory_budget, name='memory')
+            ),
+            disk_space=scheduling.DiskSpaceAdmission(),
+        )
+        converter_version = backend.version()
+        conversion_cache = None
+        if cache_dir is not None:
+            conversion_cache = cache.ConversionCache(cache_dir, max_size=cache_size)
+
+        # Record of the series already converted, for skipping them
+        conversion_manifest = manifest.ConversionManifest(
+            os.path.join(report_path, 'conversion_manifest.json'),
+            data_root_path or os.curdir,
+        )
+        # Sessions to be marked as imported once all their series are
+        # converted, indexed by session directory
+        sessions_to_mark = {}
+        # Files of the series directories listed while planning, so that they
+        # are not listed again to look up the DICOM headers
+        series_stats = {}
+
+        # Status of the target, sourcedata and scratch directories, which
+        # are checked for every series
+        fs_cache = fs_metadata.MetadataCache()
+
+        # Local directory where the session directories are built
+        session_staging = None
+        if output_staging_dir is not None:
+            session_staging = output_staging.OutputStaging(
+                output_staging_dir, target_root_path
+            )
 
         ####################################
         # GETTING INFORMATION TO DOWNLOAD
@@ -303,10 +497,74 @@ def bids_acquisition_download(
         # participant_id / NIP / infos_participant / session_label / acq_date /
         # location / to_import
 
-        # Read the participants_to_import.tsv file for getting subjects/sessions to
-        # download
-        pti_filename = exp_info.find_participants_to_import_tsv(exp_info_path)
-        for subject_info in exp_info.iterate_participants_list(pti_filename):
+        if resuming:
+            # Continue the conversion recorded in the journal, without looking
+            # up the subjects/sessions again
+            subjects_to_import = []
+            try:
+                journal_sessions, journal_series, journal_states = (
+                    conversion_journal.load()
+                )
+            except FileNotFoundError:
+                raise UserError(
+                    f'cannot resume, no conversion journal in {report_path}'
+                )
+            for series_key, state in journal_states.items():
+                file_to_convert = journal_series[series_key]
+                if state == 'failed':
+                    if not retry_failed:
+                        continue
+                elif not resume or (
+                    state == 'patched'
+                    and conversion_manifest.is_up_to_date(
+                        series_key, file_to_convert['fingerprint']
+                    )
+                ):
+                    continue
+                if session_staging is not None:
+                    file_to_convert['out_dir'] = session_staging.local_path(
+                        file_to_convert['out_dir']
+                    )
+                fs_cache.makedirs(file_to_convert['out_dir'])
+                if state != 'patched':
+                    # Remove the files left by an interrupted conversion,
+                    # which are not recorded in the manifest
+                    for filename in convert.series_output_files(file_to_convert):
+                        logger.info('removing partial output %s', filename)
+                        os.unlink(filename)
+                        fs_cache.forget(filename)
+                infiles_dcm2nii.append(file_to_convert)
+            for session_dir, session_info in journal_sessions.items():
+                sessions_to_mark[session_dir] = dict(session_info, pending=0)
+            for file_to_convert in infiles_dcm2nii:
+                sessions_to_mark[file_to_convert['session_dir']]['pending'] += 1
+            logger.info(
+                'resuming the conversion of %d series from %s',
+                len(infiles_dcm2nii),
+                conversion_journal.filename,
+            )
+        elif subjects is not None:
+            subjects_to_import = list(subjects)
+        else:
+            # Read the participants_to_import.tsv file for getting
+            # subjects/sessions to download
+            pti_filename = exp_info.find_participants_to_import_tsv(exp_info_path)
+            subjects_to_import = list(exp_info.iterate_participants_list(pti_filename))
+        session_resolver = acquisition_db.SessionResolver()
+        # MEG runs are not looked up through the resolver
+        session_resolver.prefetch(
+            (
+                (
+                    subject_info['location'],
+                    subject_info['acq_date'].strftime('%Y%m%d'),
+                    subject_info['NIP'],
+                )
+                for subject_info in subjects_to_import
+                if subject_info['location'].strip().lower() != 'meg'
+            ),
+            workers=scan_workers,
+        )
+        for subject_info in subjects_to_import:
             logger.debug('Now handling:\n%s', subject_info)
             sub_entity = subject_info['subject_label']
             ses_entity = subject_info.get('session_label', '')
@@ -321,14 +579,28 @@ def bids_acquisition_download(
 
             sub_path = os.path.join(target_root_path, sub_entity, ses_entity)
             sourcedata_sub_path = os.path.join(sourcedata_path, sub_entity, ses_entity)
-            if not os.path.exists(sub_path):
-                os.makedirs(sub_path)
-
-            # Avoid redownloading subjects/sessions
-            if not force_download:
-                check_file = os.path.join(sub_path, 'downloaded')
-                if os.path.isfile(check_file):
-                    continue
+            if session_staging is None:
+                fs_cache.makedirs(sub_path)
+
+            # Avoid redownloading subjects/sessions: the series of a marked
+            # session are still compared with the conversion manifest, so that
+            # series that changed or were completed since are converted again
+            session_marked = (
+                not force_download
+                and fs_cache.exists(os.path.join(sub_path, manifest.DOWNLOADED_MARKER))
+                and manifest.is_session_imported(
+                    sub_path, subject_info['to_import'], conversion_options
+                )
+            )
+            session_status = sessions_to_mark.setdefault(
+                sub_path,
+                {
+                    'to_import': subject_info['to_import'],
+                    'series_keys': [],
+                    'pending': 0,
+                    'complete': True,
+                },
+            )
 
             # Date in format used by /neurospin/acquisition: YYYYMMDD
             acq_date = subject_info['acq_date'].strftime('%Y%m%d')
@@ -353,6 +625,10 @@ def bids_acquisition_download(
             if len(seqs_to_retrieve) > 0 and isinstance(seqs_to_retrieve[0], str):
                 seqs_to_retrieve = [seqs_to_retrieve]
 
+            # Directories of the session, created once all its sequences are
+            # planned
+            session_work_paths = set()
+
             # download data, store information in batch files for anat/fmri
             # download data for meg data
             for value in seqs_to_retrieve:
@@ -365,11 +641,16 @@ def bids_acquisition_download(
                         acq_date,
                         str(exc),
                     )
+                    session_status['complete'] = False
 
                 target_path = os.path.join(sub_path, value[1])
                 sourcedata_target_path = os.path.join(sourcedata_sub_path, value[1])
-                if not os.path.exists(target_path):
-                    os.makedirs(target_path)
+                # Directory where the files are created before being
+                # committed to target_path
+                work_path = target_path
+                if session_staging is not None and value[1] != 'meg':
+                    work_path = session_staging.local_path(target_path)
+                session_work_paths.add(work_path)
 
                 target_filename = bids.add_entities(
                     value[2], sub_entity + '_' + ses_entity
@@ -377,10 +658,12 @@ def bids_acquisition_download(
 
                 # MEG CASE
                 if value[1] == 'meg':
+                    if session_marked:
+                        # MEG runs have no fingerprint in the manifest
+                        continue
                     # Create subject path if necessary
                     meg_path = os.path.join(sub_path, 'meg')
-                    if not os.path.exists(meg_path):
-                        os.makedirs(meg_path)
+                    fs_cache.makedirs(meg_path)
 
                     meg_file = os.path.join(
                         acquisition_db.get_database_path(subject_info['location']),
@@ -400,71 +683,121 @@ def bids_acquisition_download(
                 # MRI CASE
                 # todo: bad practices, to refactor for the sake of simplicity
                 else:
-                    download = True
-                    dicom_paths = []
-                    path_file_glob = ''
                     try:
-                        nip_dir = acquisition_db.get_session_path(
+                        nip_dir = session_resolver.get_session_path(
                             subject_info['location'], acq_date, nip
                         )
                     except DataError as exc:
                         list_warning.append(str(exc))
-                        download = False
+                        session_status['complete'] = False
                         continue
-                    path_file_glob = os.path.join(nip_dir, f'{int(value[0]):06d}_*')
-                    dicom_paths = glob.glob(path_file_glob)
+                    dicom_path = session_resolver.get_series_path(nip_dir, value[0])
 
-                    if not dicom_paths and download:
-                        list_warning.append('file not found ' + path_file_glob)
-                    elif download:
-                        dicom_path = dicom_paths[0]
+                    if dicom_path is None:
+                        list_warning.append(
+                            'file not found '
+                            + os.path.join(nip_dir, f'{int(value[0]):06d}_*')
+                        )
+                        session_status['complete'] = False
+                    else:
                         list_imported.append('importation of ' + dicom_path)
 
-                        if value[1] == 'anat' and deface:
-                            logger.info('\n Deface with pydeface')
-                            files_for_pydeface.append(
-                                os.path.join(
-                                    target_path, target_filename + '.nii' + gz_ext
-                                )
-                            )
-
                         # append list for preparing the batch importation
                         file_to_convert = {
                             'in_dir': dicom_path,
                             'out_dir': target_path,
                             'filename': os.path.splitext(target_filename)[0],
+                            'deface': value[1] == 'anat' and deface,
+                            'descriptors': {},
+                            'session_dir': sub_path,
                         }
+                        series_key = conversion_manifest.key(file_to_convert)
+                        file_to_convert['manifest_key'] = series_key
+                        catalog_stats = None
+                        if dry_run and acquisition_catalog is not None:
+                            catalog_stats = acquisition_catalog.series_stats(dicom_path)
+                        if catalog_stats is not None:
+                            file_to_convert['fingerprint'] = None
+                            (
+                                file_to_convert['file_count'],
+                                file_to_convert['size'],
+                            ) = catalog_stats
+                        else:
+                            series_stat = acquisition_db.scan_series_dir(dicom_path)
+                            series_stats[dicom_path] = series_stat
+                            file_to_convert['fingerprint'] = (
+                                manifest.series_fingerprint(
+                                    series_stat, converter_version, conversion_options
+                                )
+                            )
+                            (
+                                file_to_convert['file_count'],
+                                file_to_convert['size'],
+                            ) = scheduling.series_stats(series_stat)
                         is_file_to_import = os.path.join(
                             os.getcwd(), target_path, target_filename + '.nii' + gz_ext
                         )
                         logger.debug('is_file_to_import=%s', is_file_to_import)
-                        if os.path.isfile(is_file_to_import):
+                        if conversion_manifest.is_up_to_date(
+                            series_key, file_to_convert['fingerprint']
+                        ) or (
+                            catalog_stats is not None
+                            and series_key in conversion_manifest
+                        ):
+                            list_already_imported.append(
+                                f'already imported: {is_file_to_import}'
+                            )
+                        elif series_key not in conversion_manifest and fs_cache.isfile(
+                            is_file_to_import
+                        ):
+                            # Imported before the conversion manifest existed
                             list_already_imported.append(
                                 f'already imported: {is_file_to_import}'
                             )
                         else:
-                            infiles_dcm2nii.append(file_to_convert)
+                            derived_reason = None
+                            if derived_series != 'convert' and catalog_stats is None:
+                                derived_reason = dicom_headers.derived_series_reason(
+                                    acquisition_db.get_series_header(
+                                        dicom_path, series_stat
+                                    )
+                                )
+                            if derived_reason is not None:
+                                logger.warning(
+                                    '%s derived series %s (%s)',
+                                    'not converting'
+                                    if derived_series == 'skip'
+                                    else 'converting',
+                                    dicom_path,
+                                    derived_reason,
+                                )
+                            if derived_reason is None or derived_series == 'tag':
+                                file_to_convert['out_dir'] = work_path
+                                infiles_dcm2nii.append(file_to_convert)
+                                session_status['series_keys'].append(series_key)
+                                session_status['pending'] += 1
 
                         # Create the symlink in sourcedata
                         sourcedata_link = os.path.join(
                             sourcedata_target_path, file_to_convert['filename']
                         )
                         try:
-                            link_already_exists = os.path.samefile(
+                            link_already_exists = fs_cache.samefile(
                                 sourcedata_link, dicom_path
                             )
                         except FileNotFoundError:
                             link_already_exists = False
                         if not link_already_exists:
                             try:
-                                if os.path.islink(sourcedata_link):
+                                if fs_cache.islink(sourcedata_link):
                                     os.unlink(sourcedata_link)
-                                    os.makedirs(sourcedata_target_path, exist_ok=True)
+                                    fs_cache.makedirs(sourcedata_target_path)
                                     os.symlink(
                                         dicom_path,
                                         sourcedata_link,
                                         target_is_directory=True,
                                     )
+                                    fs_cache.forget(sourcedata_link)
                             except OSError:
                                 logger.error(
                                     'could not create a sourcedata symlink %s -> %s',
@@ -472,39 +805,106 @@ def bids_acquisition_download(
                                     dicom_path,
                                 )
 
-                        # Add descriptor(s) into the json file
-                        filename_json = os.path.join(
-                            target_path, os.path.splitext(target_filename)[0] + '.json'
-                        )
+                        # Descriptor(s) to be added into the json file
                         entities, _, _ = bids.parse_bids_name(target_filename)
                         task = entities.get('task')
                         if task:
-                            dict_descriptors.update(
-                                {
-                                    filename_json: {
-                                        'TaskName': task,
-                                    }
-                                }
-                            )
+                            file_to_convert['descriptors'] = {'TaskName': task}
 
                         if len(value) == 4:
-                            dict_descriptors.update({filename_json: value[3]})
-
-        # Importation and conversion of dicom files
-        dcm2nii_batch = {
-            'Options': {
-                'isGz': not no_gz,
-                'isFlipY': data_orientation != 'dicom',  # default is True
-                'isVerbose': False,
-                'isCreateBIDS': True,
-                'isOnlySingleFile': False,
-            },
-            'Files': infiles_dcm2nii,
-        }
-
-        dcm2nii_batch_file = os.path.join(exp_info_path, 'batch_dcm2nii.yaml')
-        with open(dcm2nii_batch_file, 'w') as f:
-            yaml.dump(dcm2nii_batch, f)
+                            file_to_convert['descriptors'] = value[3]
+
+            for work_path in sorted(session_work_paths):
+                fs_cache.makedirs(work_path)
+
+        fs_cache.log_statistics()
+
+        # Check that the series are complete, e.g. not still being
+        # transferred to the archive, from one header per series
+        if check_completeness is not None:
+            headers = acquisition_db.get_headers(
+                [
+                    file_to_convert['in_dir']
+                    for file_to_convert in infiles_dcm2nii
+                    if file_to_convert['fingerprint'] is not None
+                ],
+                series_stats=series_stats,
+            )
+            for file_to_convert in list(infiles_dcm2nii):
+                expected_count = dicom_headers.expected_instance_count(
+                    headers.get(file_to_convert['in_dir'])
+                )
+                if (
+                    expected_count is None
+                    or file_to_convert['file_count'] >= expected_count
+                ):
+                    continue
+                message = (
+                    f'incomplete series {file_to_convert["in_dir"]}: '
+                    f'{file_to_convert["file_count"]} of {expected_count} files'
+                )
+                if check_completeness == 'defer':
+                    logger.warning('not converting %s', message)
+                    infiles_dcm2nii.remove(file_to_convert)
+                    session_status = sessions_to_mark[file_to_convert['session_dir']]
+                    session_status['series_keys'].remove(
+                        file_to_convert['manifest_key']
+                    )
+                    session_status['pending'] -= 1
+                    session_status['complete'] = False
+                else:
+                    list_warning.append(message)
+
+        # Importation and conversion of dicom files, longest first so that
+        # concurrent conversions end at about the same time
+        infiles_dcm2nii = scheduling.longest_first(infiles_dcm2nii)
+
+        # Check the free space for the outputs before starting. When
+        # compressing in a separate stage, the converter first writes
+        # uncompressed NIfTI.
+        output_sizes = [
+            scheduling.estimate_output_size(
+                file_to_convert, backend_options.get('isGz', True)
+            )
+            for file_to_convert in infiles_dcm2nii
+        ]
+        total_output_size = sum(output_sizes)
+        space_requirements = [
+            (target_root_path, total_output_size),
+            (sourcedata_path, 4096 * len(infiles_dcm2nii)),  # symlinks
+        ]
+        if cache_dir is not None:
+            space_requirements.append(
+                (cache_dir, min(total_output_size, cache_size or total_output_size))
+            )
+        in_flight = jobs or 1
+        if staging_dir is not None:
+            # The series being converted and those prefetched are staged, the
+            # largest ones come first
+            staged_size = sum(
+                file_to_convert.get('size', 0)
+                for file_to_convert in infiles_dcm2nii[: in_flight + prefetch_depth]
+            )
+            space_requirements.append(
+                (staging_dir, min(staged_size, staging_quota or staged_size))
+            )
+        if output_staging_dir is not None:
+            # Each session is staged until all its series are converted
+            session_sizes = collections.Counter()
+            for file_to_convert, size in zip(
+                infiles_dcm2nii, output_sizes, strict=True
+            ):
+                session_sizes[file_to_convert['session_dir']] += size
+            space_requirements.append(
+                (
+                    output_staging_dir,
+                    sum(size for _, size in session_sizes.most_common(in_flight)),
+                )
+            )
+        list_warning.extend(scheduling.check_disk_space(space_requirements))
+        convert.write_batch_file(
+            dcm2nii_batch_file, conversion_options, infiles_dcm2nii
+        )
 
         report_lines = ['-' * 80]
         for i in list_already_imported:
@@ -541,72 +941,248 @@ def bids_acquisition_download(
 
     if dry_run:
         logger.info('no importation, dry-run option is enabled')
+        if session_staging is not None:
+            session_staging.cleanup()
     else:
-        cmd = ('dcm2niibatch', dcm2nii_batch_file)
-        ret = subprocess.call(cmd)
-        if ret != 0:
-            logger.error('dcm2niibatch returned an error, see above')
-
+        # Remove the outputs of a previous conversion of modified series
         for file_to_convert in infiles_dcm2nii:
-            generated_files = glob.glob(
-                os.path.join(
-                    file_to_convert['out_dir'], file_to_convert['filename'] + '*'
+            series_key = file_to_convert['manifest_key']
+            for filename in conversion_manifest.outputs(series_key):
+                if fs_cache.isfile(filename):
+                    logger.info('removing outdated file %s', filename)
+                    os.unlink(filename)
+                    fs_cache.forget(filename)
+            conversion_manifest.forget(series_key)
+
+        if not resuming:
+            conversion_journal.start_plan()
+            for session_dir, session_status in sessions_to_mark.items():
+                conversion_journal.plan_session(
+                    session_dir,
+                    session_status['to_import'],
+                    session_status['series_keys'],
+                    session_status['complete'],
+                )
+            for file_to_convert in infiles_dcm2nii:
+                # Record the final location, the staging area is not reused
+                target_series = dict(file_to_convert)
+                if session_staging is not None:
+                    target_series['out_dir'] = session_staging.target_path(
+                        file_to_convert['out_dir']
+                    )
+                conversion_journal.plan_series(
+                    file_to_convert['manifest_key'], target_series
                 )
+
+        # Create participants.tsv in dataset folder (take out NIP column)
+        if not resuming:
+            participants_path = os.path.join(target_root_path, 'participants.tsv')
+            df_participant = pd.DataFrame.from_dict(
+                dic_info_participants, orient='index'
             )
-            for filename in generated_files:
-                if not filename.endswith('.json'):
-                    postprocess.rename_file_with_postfixes(filename)
-
-        # loop for checking if downloaded are ok and create the downloaded
-        # files
-        #    done_file = open(os.path.join(sub_path, 'downloaded'), 'w')
-        #    done_file.close()
-
-        # Data to deface
-        # ~ print(files_for_pydeface)
-        if files_for_pydeface:
-            with (
-                importlib.resources.path(
-                    'neurospin_to_bids.template_deface', 'mean_reg2mean.nii.gz'
-                ) as template,
-                importlib.resources.path(
-                    'neurospin_to_bids.template_deface', 'facemask.nii.gz'
-                ) as facemask,
+            df_participant.index.rename('participant_id', inplace=True)
+            df_participant.to_csv(participants_path, sep='\t', na_rep='n/a')
+
+        # Sessions marked as imported during this run
+        finished_sessions = set()
+
+        def finish_session(session_dir):
+            # Move the session built locally into the dataset
+            if session_staging is not None:
+                session_staging.commit(session_dir)
+            # Mark the session if all its series have been converted
+            session_status = sessions_to_mark[session_dir]
+            if session_status['complete'] and all(
+                series_key in conversion_manifest
+                for series_key in session_status['series_keys']
             ):
-                print(template)
-                os.environ['FSLDIR'] = '/drf/local/fsl/bin/'
-                os.environ['FSLOUTPUTTYPE'] = 'NIFTI_PAIR'
-                os.environ['PATH'] = (
-                    os.environ['FSLDIR'] + os.pathsep + os.environ['PATH']
+                conversion_manifest.save()
+                manifest.mark_session_imported(
+                    target_root_path,
+                    session_dir,
+                    session_status['to_import'],
+                    conversion_options,
                 )
+                finished_sessions.add(session_dir)
 
-                for file_to_deface in files_for_pydeface:
-                    print(f'\nDeface with pydeface {file_to_deface}')
-                    pdu.deface_image(
-                        infile=file_to_deface,
-                        outfile=file_to_deface,
-                        facemask=facemask,
-                        template=template,
-                        force=True,
+        for session_dir, session_status in sessions_to_mark.items():
+            if session_status['pending'] == 0:
+                finish_session(session_dir)
+
+        def convert_series(series):
+            for result in convert.convert_with_cache(backend, series, conversion_cache):
+                if result.returncode == 0:
+                    conversion_journal.record(
+                        result.series['manifest_key'], 'converted'
+                    )
+                else:
+                    conversion_journal.record(
+                        result.series['manifest_key'],
+                        'failed',
+                        error=f'conversion failed with status {result.returncode}',
                     )
+                yield result
+
+        def catch_failures(func):
+            # Record the failure of a series instead of stopping the pipeline
+            @functools.wraps(func)
+            def wrapper(result):
+                if result.returncode != 0:
+                    return result
+                try:
+                    return func(result)
+                except Exception as exc:
+                    logger.exception('%s failed for %s', func.__name__, result.series)
+                    conversion_journal.record(
+                        result.series['manifest_key'], 'failed', error=str(exc)
+                    )
+                    return result._replace(returncode=-1)
 
-        # Create participants.tsv in dataset folder (take out NIP column)
-        participants_path = os.path.join(target_root_path, 'participants.tsv')
-        df_participant = pd.DataFrame.from_dict(dic_info_participants, orient='index')
-        df_participant.index.rename('participant_id', inplace=True)
-        df_participant.to_csv(participants_path, sep='\t', na_rep='n/a')
+            return wrapper
 
-        if dict_descriptors:
-            # ~ print(dict_descriptors)
+        @catch_failures
+        def compress_series(result):
+            result = result._replace(
+                files=compress.gzip_outputs(result.files, threads=gzip_threads)
+            )
+            conversion_journal.record(result.series['manifest_key'], 'compressed')
+            return result
+
+        @catch_failures
+        def postprocess_series(result):
+            result = result._replace(
+                files=postprocess.rename_converted_files(result.files)
+            )
+            conversion_journal.record(result.series['manifest_key'], 'postprocessed')
+            return result
+
+        @catch_failures
+        def deface_series(result):
+            if result.series['deface']:
+                file_to_deface = os.path.join(
+                    result.series['out_dir'],
+                    result.series['filename'] + '.nii' + gz_ext,
+                )
+                print(f'\nDeface with pydeface {file_to_deface}')
+                pdu.deface_image(
+                    infile=file_to_deface,
+                    outfile=file_to_deface,
+                    facemask=facemask,
+                    template=template,
+                    force=True,
+                )
+                conversion_journal.record(result.series['manifest_key'], 'defaced')
+            return result
+
+        @catch_failures
+        def update_sidecar(result):
             # Adding a new key value pair in a json file such as taskname
-            for k, v in dict_descriptors.items():
-                with open(k, 'r+') as json_file:
-                    temp_json = json.load(json_file)
-                    for key, val in v.items():
-                        temp_json[key] = val
-                    json_file.seek(0)
-                    json.dump(temp_json, json_file)
-                    json_file.truncate()
+            if result.series['descriptors']:
+                postprocess.update_json_sidecar(
+                    os.path.join(
+                        result.series['out_dir'], result.series['filename'] + '.json'
+                    ),
+                    result.series['descriptors'],
+                )
+            conversion_journal.record(result.series['manifest_key'], 'patched')
+            return result
+
+        stage_workers = stage_workers or {}
+        stages = [
+            pipeline.Stage('convert', transform=convert_series),
+            *(
+                [
+                    pipeline.Stage(
+                        'compress',
+                        compress_series,
+                        workers=stage_workers.get('compress', 1),
+                    )
+                ]
+                if separate_gzip
+                else []
+            ),
+            pipeline.Stage(
+                'postprocess',
+                postprocess_series,
+                workers=stage_workers.get('postprocess', 1),
+            ),
+            pipeline.Stage(
+                'deface', deface_series, workers=stage_workers.get('deface', 1)
+            ),
+            pipeline.Stage(
+                'sidecar', update_sidecar, workers=stage_workers.get('sidecar', 1)
+            ),
+        ]
+
+        logger.info(
+            'converting %d series with the %s backend',
+            len(infiles_dcm2nii),
+            backend.name,
+        )
+        template = facemask = None
+        with contextlib.ExitStack() as stack:
+            # Data to deface
+            if deface:
+                template = stack.enter_context(
+                    importlib.resources.path(
+                        'neurospin_to_bids.template_deface', 'mean_reg2mean.nii.gz'
+                    )
+                )
+                facemask = stack.enter_context(
+                    importlib.resources.path(
+                        'neurospin_to_bids.template_deface', 'facemask.nii.gz'
+                    )
+                )
+                os.environ['FSLDIR'] = '/drf/local/fsl/bin/'
+                os.environ['FSLOUTPUTTYPE'] = 'NIFTI_PAIR'
+                os.environ['PATH'] = (
+                    os.environ['FSLDIR'] + os.pathsep + os.environ['PATH']
+                )
+            conversion_results = []
+            try:
+                for result in pipeline.run_pipeline(infiles_dcm2nii, stages):
+                    conversion_results.append(result)
+                    outputs = result.files
+                    if session_staging is not None:
+                        outputs = [session_staging.target_path(f) for f in outputs]
+                    if result.returncode == 0 and outputs:
+                        conversion_manifest.record(
+                            result.series['manifest_key'],
+                            result.series['fingerprint'],
+                            outputs,
+                        )
+                    session_status = sessions_to_mark[result.series['session_dir']]
+                    session_status['pending'] -= 1
+                    if session_status['pending'] == 0:
+                        finish_session(result.series['session_dir'])
+            finally:
+                conversion_manifest.save()
+                conversion_journal.close()
+                if conversion_results:
+                    scheduling.write_schedule_report(
+                        os.path.join(
+                            report_path,
+                            'conversion_schedule_'
+                            + time.strftime('%d-%b-%Y-%H:%M:%S', time.gmtime())
+                            + '.tsv',
+                        ),
+                        conversion_results,
+                    )
+                if session_staging is not None:
+                    session_staging.cleanup()
+
+        failed_series = sum(result.returncode != 0 for result in conversion_results)
+        unfinished_sessions = sessions_to_mark.keys() - finished_sessions
+        if failed_series or unfinished_sessions:
+            logger.error(
+                'the import is incomplete: %d series failed, '
+                '%d sessions are not completely imported',
+                failed_series,
+                len(unfinished_sessions),
+            )
+            status = 1
+        else:
+            status = 0
 
         # Copy recorded event files
         if copy_events:
@@ -642,9 +1218,49 @@ def bids_acquisition_download(
                         )
                         print(validator.is_bids(file_to_test))
 
+        print('\n')
+        return status
+
     print('\n')
 
 
+def parse_stage_workers(text):
+    """Parse a STAGE=N command-line argument into a (STAGE, N) tuple."""
+    stage, _, workers = text.partition('=')
+    if stage not in PIPELINE_STAGES:
+        raise argparse.ArgumentTypeError(
+            f'unknown stage {stage!r} (choose from {", ".join(PIPELINE_STAGES)})'
+        )
+    try:
+        workers = int(workers)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        raise argparse.ArgumentTypeError(
+            f'invalid number of workers for {stage}: {text!r}'
+        )
+    return stage, workers
+
+
+def parse_io_limit(text):
+    """Parse a SCANNER=N command-line argument into a (SCANNER, N) tuple."""
+    scanner, _, limit = text.partition('=')
+    if scanner not in acquisition_db.NEUROSPIN_DATABASES:
+        raise argparse.ArgumentTypeError(
+            f'unknown scanner {scanner!r} '
+            f'(choose from {", ".join(acquisition_db.NEUROSPIN_DATABASES)})'
+        )
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise argparse.ArgumentTypeError(
+            f'invalid number of concurrent reads for {scanner}: {text!r}'
+        )
+    return scanner, limit
+
+
 def main(argv=sys.argv):
     prog = os.path.basename(argv[0])
     if sys.version_info < (3, 6):  # noqa: UP036
@@ -679,6 +1295,107 @@ def main(argv=sys.argv):
         help='path to the NeuroSpin acquisition archive '
         '[default: /neurospin/acquisition]',
     )
+    parser.add_argument(
+        '--scan-workers',
+        type=int,
+        default=acquisition_db.DEFAULT_SCAN_WORKERS,
+        metavar='N',
+        help='number of directories of the acquisition archive that are listed '
+        f'concurrently [default: {acquisition_db.DEFAULT_SCAN_WORKERS}]',
+    )
+    parser.add_argument(
+        '--io-limit',
+        type=parse_io_limit,
+        action='append',
+        metavar='SCANNER=N',
+        help='maximum number of concurrent reads (listings, staging and '
+        'conversion reads) from the database of a scanner, can be repeated '
+        f'[default: {io_limits.DEFAULT_LIMIT} for each scanner]',
+    )
+    parser.add_argument(
+        '--io-autotune',
+        action='store_true',
+        help='adjust the number of concurrent reads from each database '
+        'according to the throughput and latency observed, starting from '
+        '--io-limit',
+    )
+    parser.add_argument(
+        '--catalog',
+        metavar='FILE',
+        help='look up the sessions and series in a catalog written by '
+        '--export-catalog instead of the acquisition archive, e.g. for running '
+        'autolist or a dry run offline',
+    )
+    parser.add_argument(
+        '--export-catalog',
+        metavar='FILE',
+        help='export a catalog of the acquisition archive to FILE (TSV, '
+        'compressed if FILE ends with .gz), then exit',
+    )
+    parser.add_argument(
+        '--catalog-scanner',
+        action='append',
+        choices=list(acquisition_db.NEUROSPIN_DATABASES),
+        help='scanner to export to the catalog, can be repeated '
+        '[default: all scanners]',
+    )
+    parser.add_argument(
+        '--catalog-start-date',
+        type=datetime.date.fromisoformat,
+        metavar='YYYY-MM-DD',
+        help='first acquisition date to export to the catalog',
+    )
+    parser.add_argument(
+        '--catalog-end-date',
+        type=datetime.date.fromisoformat,
+        metavar='YYYY-MM-DD',
+        help='last acquisition date to export to the catalog',
+    )
+    parser.add_argument(
+        '--catalog-nip',
+        action='append',
+        metavar='NIP',
+        help='NIP of the sessions to export to the catalog, can be repeated '
+        '[default: all sessions]',
+    )
+    parser.add_argument(
+        '--discover',
+        metavar='FILE',
+        help='write the sessions of the subjects given with --discover-nip to '
+        'FILE (TSV with the NIP, acq_date and location columns of '
+        'participants_list.tsv), then exit',
+    )
+    parser.add_argument(
+        '--discover-nip',
+        action='append',
+        metavar='NIP',
+        help='NIP of a subject whose sessions are discovered, can be repeated',
+    )
+    parser.add_argument(
+        '--discover-scanner',
+        action='append',
+        choices=list(acquisition_db.NEUROSPIN_DATABASES),
+        help='scanner where sessions are discovered, can be repeated '
+        '[default: all scanners]',
+    )
+    parser.add_argument(
+        '--discover-start-date',
+        type=datetime.date.fromisoformat,
+        metavar='YYYY-MM-DD',
+        help='first acquisition date of the discovered sessions',
+    )
+    parser.add_argument(
+        '--discover-end-date',
+        type=datetime.date.fromisoformat,
+        metavar='YYYY-MM-DD',
+        help='last acquisition date of the discovered sessions',
+    )
+    parser.add_argument(
+        '--acquisition-index',
+        metavar='FILE',
+        help='SQLite database where the directory listings of the acquisition '
+        'archive are kept, so that repeated lookups do not scan the archive',
+    )
     parser.add_argument(
         '--no-gz',
         action='store_true',
@@ -701,6 +1418,138 @@ def main(argv=sys.argv):
         'neurospin_to_bids from January 2020 to February '
         '2022.',
     )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        metavar='N',
+        help='convert the DICOM series with one dcm2niix process per series, '
+        'running at most N of them concurrently [default: convert all series '
+        'with a single dcm2niibatch process]',
+    )
+    parser.add_argument(
+        '--conversion-backend',
+        choices=list(convert.BACKENDS.keys()),
+        help='program used for converting the DICOM series to NIfTI; the '
+        'simulated backend produces placeholder files without reading the '
+        'DICOM data, it is intended for testing [default: dcm2niix if --jobs '
+        'is given, dcm2niibatch otherwise]',
+    )
+    parser.add_argument(
+        '--simulated-latency',
+        type=float,
+        default=0.0,
+        metavar='SECONDS',
+        help='time taken by the conversion of each series with the simulated '
+        'backend [default: 0]',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        help='directory where the outputs of conversions are cached, so that '
+        'they can be reused when the same series is imported again, possibly '
+        'in another dataset; it can be shared between users',
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=utils.parse_size,
+        metavar='SIZE',
+        help='maximum size of the conversion cache (e.g. 500G), the least '
+        'recently used entries are evicted [default: unlimited]',
+    )
+    parser.add_argument(
+        '--staging-dir',
+        metavar='DIR',
+        help='local scratch directory where the DICOM series are copied ahead '
+        'of their conversion, instead of having dcm2niix read them from the '
+        'acquisition archive (requires the dcm2niix backend)',
+    )
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=2,
+        metavar='N',
+        help='number of series copied to the staging directory ahead of the '
+        'series being converted [default: 2]',
+    )
+    parser.add_argument(
+        '--staging-quota',
+        type=utils.parse_size,
+        metavar='SIZE',
+        help='maximum space used in the staging directory (e.g. 20G) '
+        '[default: unlimited]',
+    )
+    parser.add_argument(
+        '--memory-budget',
+        type=utils.parse_size,
+        metavar='SIZE',
+        help='maximum memory used by concurrent conversions, estimated from the '
+        'size of the DICOM series (e.g. 16G) [default: unlimited]',
+    )
+    parser.add_argument(
+        '--mirror-dir',
+        metavar='DIR',
+        help='persistent local mirror of the DICOM series, which are copied '
+        'there on first conversion and read from there by later imports',
+    )
+    parser.add_argument(
+        '--mirror-size',
+        type=utils.parse_size,
+        metavar='SIZE',
+        help='maximum size of the mirror (e.g. 200G), the least recently used '
+        'series are evicted [default: unlimited]',
+    )
+    parser.add_argument(
+        '--output-staging-dir',
+        metavar='DIR',
+        help='local scratch directory where each session is built, before '
+        'being moved into the dataset in one step once complete',
+    )
+    parser.add_argument(
+        '--stage-workers',
+        type=parse_stage_workers,
+        action='append',
+        metavar='STAGE=N',
+        help='number of series processed concurrently by a stage of the '
+        f'conversion pipeline ({", ".join(PIPELINE_STAGES)}), can be repeated '
+        '[default: 1 for each stage]',
+    )
+    parser.add_argument(
+        '--gzip-threads',
+        type=int,
+        metavar='N',
+        help='convert to uncompressed NIfTI, then compress the files in a '
+        'separate stage, using N threads per file if pigz is installed',
+    )
+    parser.add_argument(
+        '--derived-series',
+        choices=('convert', 'tag', 'skip'),
+        default='convert',
+        help='how to handle derived series (e.g. MPR, ROI, phoenix reports), '
+        'detected from their DICOM header: convert them, convert them with a '
+        'warning (tag), or warn and do not convert them (skip) '
+        '[default: convert]',
+    )
+    parser.add_argument(
+        '--check-completeness',
+        choices=('warn', 'defer'),
+        help='compare the number of files of each series with the number '
+        'expected from its DICOM header, and warn about incomplete series '
+        '(e.g. still being transferred), or leave them for a later run (defer)',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='continue the conversion recorded in report/conversion_journal.jsonl '
+        'by a previous run that was interrupted, without looking up the '
+        'series again',
+    )
+    parser.add_argument(
+        '--retry-failed',
+        action='store_true',
+        help='convert again the series that failed in the previous run, as '
+        'recorded in report/conversion_journal.jsonl',
+    )
     parser.add_argument(
         '--dry-run',
         '-n',
@@ -718,6 +1567,30 @@ def main(argv=sys.argv):
         action='store_true',
         help='Try to use the experimental autolist feature',
     )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='keep polling the acquisition archive, and import each session of '
+        'participants_to_import.tsv (or of participants_list.tsv with '
+        '--autolist) as soon as its files have stopped changing; implies '
+        '--noninteractive',
+    )
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=watch.DEFAULT_POLL_INTERVAL,
+        metavar='SECONDS',
+        help='time between two polls of the archive with --watch '
+        f'[default: {watch.DEFAULT_POLL_INTERVAL:g}]',
+    )
+    parser.add_argument(
+        '--quiet-period',
+        type=float,
+        default=watch.DEFAULT_QUIET_PERIOD,
+        metavar='SECONDS',
+        help='time without changes after which a session is imported with '
+        f'--watch [default: {watch.DEFAULT_QUIET_PERIOD:g}]',
+    )
     parser.add_argument(
         '--debug',
         dest='logging_level',
@@ -729,6 +1602,29 @@ def main(argv=sys.argv):
 
     # LOAD CONSOLE ARGUMENTS
     args = parser.parse_args(argv[1:])
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.prefetch < 1:
+        parser.error('--prefetch must be at least 1')
+    if args.gzip_threads is not None and args.gzip_threads < 1:
+        parser.error('--gzip-threads must be at least 1')
+    if args.scan_workers < 1:
+        parser.error('--scan-workers must be at least 1')
+    if args.mirror_dir and args.staging_dir:
+        parser.error('--mirror-dir and --staging-dir are mutually exclusive')
+    if args.catalog and args.acquisition_index:
+        parser.error('--catalog and --acquisition-index are mutually exclusive')
+    if args.watch and (
+        args.resume or args.retry_failed or args.dry_run or args.catalog
+    ):
+        parser.error(
+            '--watch cannot be combined with --resume, --retry-failed, '
+            '--dry-run or --catalog'
+        )
+    if args.poll_interval <= 0:
+        parser.error('--poll-interval must be positive')
+    if args.discover and not args.discover_nip:
+        parser.error('--discover requires at least one --discover-nip')
 
     # Configure logging to a file + colorized logging on stderr
     report_dir = os.path.join(args.root_path, 'report')
@@ -750,33 +1646,128 @@ def main(argv=sys.argv):
 
     logger.info('Started %s', ' '.join(shlex.quote(arg) for arg in argv))
 
-    utils.set_noninteractive(args.noninteractive)
+    # Nobody is there to answer the questions of a long-running watch
+    utils.set_noninteractive(args.noninteractive or args.watch)
     acquisition_db.set_root_path(args.acquisition_dir)
+    if args.acquisition_index:
+        acquisition_db.set_index(
+            acquisition_index.AcquisitionIndex(args.acquisition_index)
+        )
+    if args.io_limit or args.io_autotune:
+        acquisition_db.set_io_limits(
+            io_limits.ArchiveLimits(
+                dict(args.io_limit or ()), autotune=args.io_autotune
+            )
+        )
+    if args.mirror_dir:
+        acquisition_db.set_mirror(
+            mirror.ArchiveMirror(args.mirror_dir, max_size=args.mirror_size)
+        )
 
     try:
-        if args.autolist:
+        if args.export_catalog:
+            catalog.export_catalog(
+                args.export_catalog,
+                scanners=args.catalog_scanner,
+                start_date=args.catalog_start_date,
+                end_date=args.catalog_end_date,
+                nips=args.catalog_nip,
+                workers=args.scan_workers,
+            )
+            return
+        acquisition_catalog = None
+        if args.catalog:
+            acquisition_catalog = catalog.Catalog(args.catalog)
+            acquisition_db.set_index(acquisition_catalog)
+        if args.discover:
+            sessions = discover.discover_sessions(
+                args.discover_nip,
+                scanners=args.discover_scanner,
+                start_date=args.discover_start_date,
+                end_date=args.discover_end_date,
+                workers=args.scan_workers,
+            )
+            discover.write_discovered_sessions(args.discover, sessions)
+            return
+        # DICOM headers used by autolist rules, derived series and
+        # completeness checks are only read once per series
+        acquisition_db.set_header_index(
+            dicom_headers.HeaderIndex(
+                os.path.join(report_dir, 'dicom_header_index.json')
+            )
+        )
+        if args.autolist and not args.watch:
             from . import autolist
 
-            autolist.autolist_dicom(os.path.join(args.root_path, 'exp_info'))
+            autolist.autolist_dicom(
+                os.path.join(args.root_path, 'exp_info'),
+                scan_workers=args.scan_workers,
+            )
             return
         deface = yes_no('\nDo you want deface T1?', default=None, noninteractive=False)
-        return (
-            bids_acquisition_download(
-                data_root_path=args.root_path,
-                dataset_name=args.dataset_name,
-                force_download=False,
-                behav_path='exp_info/recorded_events',
-                copy_events=args.copy_events,
-                deface=deface,
-                no_gz=args.no_gz,
-                data_orientation=args.data_orientation,
-                dry_run=args.dry_run,
+        import_options = {
+            'data_root_path': args.root_path,
+            'dataset_name': args.dataset_name,
+            'force_download': False,
+            'behav_path': 'exp_info/recorded_events',
+            'copy_events': args.copy_events,
+            'deface': deface,
+            'no_gz': args.no_gz,
+            'data_orientation': args.data_orientation,
+            'dry_run': args.dry_run,
+            'jobs': args.jobs,
+            'conversion_backend': args.conversion_backend,
+            'simulated_latency': args.simulated_latency,
+            'cache_dir': args.cache_dir,
+            'cache_size': args.cache_size,
+            'staging_dir': args.staging_dir,
+            'prefetch_depth': args.prefetch,
+            'staging_quota': args.staging_quota,
+            'output_staging_dir': args.output_staging_dir,
+            'stage_workers': dict(args.stage_workers or ()),
+            'resume': args.resume,
+            'retry_failed': args.retry_failed,
+            'memory_budget': args.memory_budget,
+            'gzip_threads': args.gzip_threads,
+            'scan_workers': args.scan_workers,
+            'acquisition_catalog': acquisition_catalog,
+            'derived_series': args.derived_series,
+            'check_completeness': args.check_completeness,
+        }
+        if args.watch:
+            watch.watch_archive(
+                os.path.join(args.root_path, 'exp_info'),
+                lambda subjects: bids_acquisition_download(
+                    subjects=subjects, **import_options
+                ),
+                use_autolist=args.autolist,
+                poll_interval=args.poll_interval,
+                quiet_period=args.quiet_period,
+                scan_workers=args.scan_workers,
             )
-            or 0
-        )
+            return
+        return bids_acquisition_download(**import_options) or 0
     except UserError as exc:
         logger.fatal(f'aborting due to user error: {exc}')
         return 1
+    finally:
+        if acquisition_db.HEADER_INDEX is not None:
+            acquisition_db.HEADER_INDEX.close()
+            acquisition_db.HEADER_INDEX.save()
+            acquisition_db.set_header_index(None)
+        acquisition_db.set_mirror(None)
+        if acquisition_db.IO_LIMITS is not None:
+            logger.info(
+                'concurrent reads from each database: %s',
+                ', '.join(
+                    f'{scanner}={limit}'
+                    for scanner, limit in acquisition_db.IO_LIMITS.current_limits().items()
+                ),
+            )
+            acquisition_db.set_io_limits(None)
+        if acquisition_db.ACQUISITION_INDEX is not None:
+            acquisition_db.ACQUISITION_INDEX.close()
+            acquisition_db.set_index(None)
 
 
 if __name__ == '__main__':
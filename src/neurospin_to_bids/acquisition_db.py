@@ -1,9 +1,14 @@
 """Tools for working with the NeuroSpin DICOM archive."""
 
+import contextlib
+import datetime
+import fnmatch
 import glob
 import logging
 import os.path
+import sqlite3
 
+from . import acquisition_index, utils
 from .utils import DataError, UserError
 
 logger = logging.getLogger()
@@ -29,12 +34,87 @@ a laptop.
 """
 
 
+ACQUISITION_INDEX = None
+"""Local index of the archive, or None.
+
+If set, the lookups of sessions and series are answered from the index
+(acquisition_index.AcquisitionIndex), falling back to listing the archive if
+the index cannot be used, or from a snapshot of the archive (catalog.Catalog).
+"""
+
+
+MIRROR = None
+"""Local mirror of the DICOM series (mirror.ArchiveMirror), or None."""
+
+HEADER_INDEX = None
+"""Index of the DICOM headers of the series (dicom_headers.HeaderIndex), or None.
+
+If None, get_series_headers reads the headers every time.
+"""
+
+DEFAULT_HEADER_WORKERS = 4
+"""Default number of processes reading DICOM headers concurrently."""
+
+IO_LIMITS = None
+"""Limits on concurrent reads from each database (io_limits.ArchiveLimits).
+
+If None, the number of concurrent reads is only bounded by the number of
+workers of each operation.
+"""
+
+
 def set_root_path(root_path):
     """Set the acquisition root path globally for the current process."""
     global ACQUISITION_ROOT_PATH
     ACQUISITION_ROOT_PATH = root_path
 
 
+def set_index(index):
+    """Set the index of the archive globally for the current process."""
+    global ACQUISITION_INDEX
+    ACQUISITION_INDEX = index
+
+
+def set_mirror(mirror):
+    """Set the local mirror of the archive globally for the current process."""
+    global MIRROR
+    MIRROR = mirror
+
+
+def open_series(series_dir):
+    """Context manager giving the path from which a DICOM series can be read.
+
+    If a mirror is set (see set_mirror), the series is read through the
+    mirror, otherwise it is read from the archive.
+    """
+    if MIRROR is None:
+        return contextlib.nullcontext(series_dir)
+    return MIRROR.open(series_dir)
+
+
+def set_io_limits(io_limits):
+    """Set the limits on concurrent reads globally for the current process."""
+    global IO_LIMITS
+    IO_LIMITS = io_limits
+
+
+def archive_reader(path, size=0):
+    """Context manager wrapping a read of size bytes from path in the archive.
+
+    If limits are set (see set_io_limits), the read waits for a free reader
+    slot of the database containing path.
+    """
+    if IO_LIMITS is None:
+        return contextlib.nullcontext()
+    return IO_LIMITS.reader(path, size)
+
+
+def set_header_index(header_index):
+    """Set the index of DICOM headers globally for the current process."""
+    global HEADER_INDEX
+    HEADER_INDEX = header_index
+
+
 def get_database_path(scanner):
     """Get the full path to the database corresponding to the given scanner.
 
@@ -82,7 +162,12 @@ def get_session_path(scanner, acq_date, nip):
         optionally be suffixed with the session number and StudyID for
         disambiguation.
     """
-    session_paths = get_session_paths(scanner, acq_date, nip)
+    return _unique_session_path(
+        get_session_paths(scanner, acq_date, nip), scanner, acq_date, nip
+    )
+
+
+def _unique_session_path(session_paths, scanner, acq_date, nip):
     if len(session_paths) == 1:
         return session_paths[0]
     elif len(session_paths) == 0:
@@ -117,14 +202,233 @@ def get_session_paths(scanner, acq_date, nip):
     """
     db_path = get_database_path(scanner)
     if scanner.lower() == 'meg':
-        session_dir = os.path.join(db_path, nip, acq_date)
+        nip_dir = os.path.join(db_path, nip)
+        if ACQUISITION_INDEX is not None:
+            try:
+                # Once found, the directory of a past date does not change
+                names = ACQUISITION_INDEX.find_entries(
+                    nip_dir,
+                    lambda name: name == acq_date,
+                    immutable=acquisition_index.is_immutable_date(acq_date),
+                )
+            except sqlite3.Error as exc:
+                logger.warning('cannot use the acquisition index: %s', exc)
+            else:
+                return [os.path.join(nip_dir, name) for name in names]
+        session_dir = os.path.join(nip_dir, acq_date)
         if os.path.isdir(session_dir):
             return [session_dir]
         else:
             return []
     else:  # MRI
         date_dir = os.path.join(db_path, acq_date)
-        return glob.glob(os.path.join(glob.escape(date_dir), glob.escape(nip) + '*'))
+        if ACQUISITION_INDEX is not None:
+            try:
+                names = ACQUISITION_INDEX.find_entries(
+                    date_dir,
+                    lambda name: session_matches_nip(name, nip),
+                    immutable=acquisition_index.is_immutable_date(acq_date),
+                )
+            except sqlite3.Error as exc:
+                logger.warning('cannot use the acquisition index: %s', exc)
+            else:
+                return [os.path.join(date_dir, name) for name in names]
+        with archive_reader(date_dir):
+            return glob.glob(
+                os.path.join(glob.escape(date_dir), glob.escape(nip) + '*')
+            )
+
+
+def parse_directory_date(name):
+    """Parse the name of a date directory of the archive.
+
+    MRI databases use YYYYMMDD, the MEG database uses YYMMDD. A datetime.date
+    is returned, or None if the name is not a date.
+    """
+    # strptime accepts fewer digits than the format, e.g. 000115 as %Y%m%d
+    date_format = {8: '%Y%m%d', 6: '%y%m%d'}.get(len(name))
+    if date_format is None or not name.isdigit():
+        return None
+    try:
+        return datetime.datetime.strptime(name, date_format).date()
+    except ValueError:
+        return None
+
+
+def session_matches_nip(name, nip):
+    """Test if a session directory name matches a NIP (see get_session_paths)."""
+    # Same matching as glob.glob(nip + '*'), which ignores hidden files
+    return not name.startswith('.') and fnmatch.fnmatchcase(
+        name, glob.escape(nip) + '*'
+    )
+
+
+DEFAULT_SCAN_WORKERS = 8
+"""Default number of directories of the archive listed concurrently."""
+
+
+class SessionResolver:
+    """Resolve sessions and series, listing each directory of the archive once.
+
+    Looking up each session with get_session_paths, then each of its series
+    with a glob, lists the same date directory once per participant, and the
+    same session directory once per series. Instead, the resolver keeps the
+    listing of each directory for its lifetime, so that each session and
+    series is resolved with a lookup in memory. It should therefore only be
+    used for the duration of one import.
+
+    The directories needed by a list of lookups can be listed concurrently
+    beforehand (see prefetch), so that the latency of the network filesystem
+    is not paid one directory at a time. If the acquisition index is set (see
+    set_index), the listings go through the index.
+    """
+
+    def __init__(self):
+        self._listings = {}
+
+    def list_directory(self, path):
+        """List the names of the entries of a directory of the archive.
+
+        An empty list is returned if the directory does not exist.
+        """
+        try:
+            return self._listings[path]
+        except KeyError:
+            pass
+        if ACQUISITION_INDEX is not None:
+            try:
+                names = _list_session_dir(path)
+            except FileNotFoundError:
+                names = []
+        else:
+            try:
+                with archive_reader(path), os.scandir(path) as it:
+                    names = [entry.name for entry in it]
+            except FileNotFoundError:
+                names = []
+        self._listings[path] = names
+        return names
+
+    def _lookup_dir(self, scanner, acq_date, nip):
+        db_path = get_database_path(scanner)
+        if scanner.lower() == 'meg':
+            return os.path.join(db_path, nip)
+        else:  # MRI
+            return os.path.join(db_path, acq_date)
+
+    def get_session_paths(self, scanner, acq_date, nip):
+        """Same as the get_session_paths function."""
+        if ACQUISITION_INDEX is not None:
+            # The index implements the expiry of negative lookups
+            return get_session_paths(scanner, acq_date, nip)
+        lookup_dir = self._lookup_dir(scanner, acq_date, nip)
+        names = self.list_directory(lookup_dir)
+        if scanner.lower() == 'meg':
+            return [os.path.join(lookup_dir, acq_date)] if acq_date in names else []
+        else:  # MRI
+            return [
+                os.path.join(lookup_dir, name)
+                for name in names
+                if session_matches_nip(name, nip)
+            ]
+
+    def get_session_path(self, scanner, acq_date, nip):
+        """Same as the get_session_path function."""
+        return _unique_session_path(
+            self.get_session_paths(scanner, acq_date, nip), scanner, acq_date, nip
+        )
+
+    def list_dicom_series(self, session_dir):
+        """Same as the list_dicom_series function."""
+        return _parse_series_dirs(self.list_directory(session_dir))
+
+    def get_series_path(self, session_dir, series_number):
+        """Get the path to a DICOM series directory, or None if not found.
+
+        The directory of series number N is named like {N:06d}_description.
+        If there are several, the first in alphabetical order is returned.
+        """
+        prefix = f'{int(series_number):06d}_'
+        for name in sorted(self.list_directory(session_dir)):
+            if name.startswith(prefix):
+                return os.path.join(session_dir, name)
+        return None
+
+    def prefetch(self, lookups, workers=DEFAULT_SCAN_WORKERS):
+        """List the directories needed by lookups, workers at a time.
+
+        lookups is an iterable of (scanner, acq_date, nip) tuples, as passed
+        to get_session_paths. The directories where the sessions are looked
+        up are listed first, then the directories of the sessions found.
+        Invalid scanners are skipped, they are reported by the actual lookup.
+        """
+        lookups_by_dir = {}
+        for scanner, acq_date, nip in lookups:
+            try:
+                lookup_dir = self._lookup_dir(scanner, acq_date, nip)
+            except UserError:
+                continue
+            lookups_by_dir.setdefault(lookup_dir, []).append((scanner, acq_date, nip))
+
+        # Each worker fills a different key of the listings
+        def resolve_sessions(lookups_in_dir):
+            session_dirs = []
+            for lookup in lookups_in_dir:
+                session_dirs.extend(self.get_session_paths(*lookup))
+            return session_dirs
+
+        session_dirs = set()
+        for found in utils.imap_unordered_bounded(
+            resolve_sessions, lookups_by_dir.values(), workers
+        ):
+            session_dirs.update(found)
+        for _ in utils.imap_unordered_bounded(
+            self.list_directory, session_dirs - self._listings.keys(), workers
+        ):
+            pass
+        logger.debug(
+            'listed %d directories of the acquisition archive', len(self._listings)
+        )
+
+
+def scan_series_dir(series_dir):
+    """List the files of a DICOM series directory, with their size and mtime.
+
+    A list of (name, size, mtime_ns) tuples is returned, sorted by name.
+    """
+    series_stat = []
+    with archive_reader(series_dir), os.scandir(series_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                stat_result = entry.stat()
+                series_stat.append(
+                    (entry.name, stat_result.st_size, stat_result.st_mtime_ns)
+                )
+    series_stat.sort()
+    return series_stat
+
+
+def _list_session_dir(session_dir):
+    if ACQUISITION_INDEX is not None:
+        # Session directories are found in date directories (YYYYMMDD)
+        acq_date = os.path.basename(os.path.dirname(os.path.normpath(session_dir)))
+        try:
+            names = ACQUISITION_INDEX.list_directory(
+                session_dir,
+                max_age=(
+                    None
+                    if acquisition_index.is_immutable_date(acq_date)
+                    else ACQUISITION_INDEX.ttl
+                ),
+            )
+        except sqlite3.Error as exc:
+            logger.warning('cannot use the acquisition index: %s', exc)
+        else:
+            if names is None:
+                raise FileNotFoundError(f'no such directory: {session_dir!r}')
+            return names
+    with archive_reader(session_dir):
+        return os.listdir(session_dir)
 
 
 def list_dicom_series(session_dir):
@@ -135,11 +439,67 @@ def list_dicom_series(session_dir):
     using canonicalize_filename(). The series are returned in no particular
     order.
     """
-    for directory in os.listdir(session_dir):
+    return _parse_series_dirs(_list_session_dir(session_dir))
+
+
+def _parse_series_dirs(names):
+    for directory in names:
         try:
             series_number, series_description = directory.split('_', 1)
+            series_number = int(series_number)
         except ValueError:
             logger.warning('invalid series directory name %s', directory)
-        series_number = int(series_number)
+            continue
         series_description = canonicalize_filename(series_description)
         yield (series_number, series_description)
+
+
+def _get_header_index():
+    from . import dicom_headers
+
+    if HEADER_INDEX is None:
+        return dicom_headers.HeaderIndex()
+    return HEADER_INDEX
+
+
+def get_series_header(series_dir, series_stat=None):
+    """Get the DICOM header of one series (see get_series_headers).
+
+    series_stat may be the files of the series, if they have already been
+    listed with scan_series_dir.
+    """
+    series_stats = None if series_stat is None else {series_dir: series_stat}
+    return _get_header_index().get_headers([series_dir], series_stats=series_stats)[
+        series_dir
+    ]
+
+
+def get_headers(series_dirs, workers=DEFAULT_HEADER_WORKERS, series_stats=None):
+    """Get the DICOM headers of several series, read concurrently.
+
+    A dictionary mapping each series directory to its header is returned
+    (see get_series_headers). series_stats may map series directories to
+    their files, if they have already been listed with scan_series_dir.
+    """
+    return _get_header_index().get_headers(
+        series_dirs, workers=workers, series_stats=series_stats
+    )
+
+
+def get_series_headers(session_dir, workers=DEFAULT_HEADER_WORKERS):
+    """Get the DICOM headers of the series of a session directory.
+
+    A dictionary mapping each SeriesNumber to the header fields of the series
+    (see dicom_headers.read_series_header) is returned. The headers are read
+    through the header index if it is set (see set_header_index).
+    """
+    series_dirs = {}
+    for directory in _list_session_dir(session_dir):
+        series_number, sep, _ = directory.partition('_')
+        if sep and series_number.isdigit():
+            series_dirs[os.path.join(session_dir, directory)] = int(series_number)
+    headers = _get_header_index().get_headers(series_dirs, workers=workers)
+    return {
+        series_number: headers[series_dir]
+        for series_dir, series_number in series_dirs.items()
+    }
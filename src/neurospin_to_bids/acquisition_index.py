@@ -0,0 +1,153 @@
+"""Local index of the directory listings of the NeuroSpin DICOM archive.
+
+Looking up a session in the archive lists the date directory of its scanner,
+and the session directory itself to find its series, both over NFS. The
+AcquisitionIndex keeps these listings in a local SQLite database, so that
+subsequent lookups (e.g. by autolist, then by the import, or by the next
+import of the same study) do not touch the archive:
+
+- the listings of dates that are long past are considered immutable, since
+  the archive is only ever appended to on the day of the acquisition;
+- other listings are refreshed when they are older than a time-to-live;
+- a lookup that finds nothing (missing directory, or no session matching a
+  NIP) is only trusted for negative_ttl seconds, even for past dates, in
+  case data is archived late.
+
+The index is refreshed incrementally: only the directories that are looked
+up are listed, and only when their listing is stale.
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_TTL = 3600.0
+"""Maximum age of the listing of a recent directory, in seconds."""
+
+DEFAULT_NEGATIVE_TTL = 600.0
+"""Maximum age of a lookup that found nothing, in seconds."""
+
+IMMUTABLE_AFTER = datetime.timedelta(days=2)
+"""Age of an acquisition date after which its directories are immutable."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    path TEXT PRIMARY KEY,
+    listed_at REAL NOT NULL,
+    missing INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (path, name)
+);
+"""
+
+
+def is_immutable_date(acq_date):
+    """Test if the directories of an acquisition date are final.
+
+    acq_date is in the format of the date directories of the archive:
+    YYYYMMDD for MRI, YYMMDD for the MEG.
+    """
+    # strptime accepts fewer digits than the format, e.g. 000115 as %Y%m%d
+    date_format = {8: '%Y%m%d', 6: '%y%m%d'}.get(len(acq_date))
+    if date_format is None or not acq_date.isdigit():
+        return False
+    try:
+        date = datetime.datetime.strptime(acq_date, date_format).date()
+    except ValueError:
+        return False
+    return date <= datetime.date.today() - IMMUTABLE_AFTER
+
+
+class AcquisitionIndex:
+    """SQLite cache of directory listings of the acquisition archive.
+
+    filename (str): path to the SQLite database, created if needed.
+    ttl (float): maximum age in seconds of the listings of recent directories.
+    negative_ttl (float): maximum age in seconds of the lookups that found
+        nothing.
+    """
+
+    def __init__(self, filename, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def list_directory(self, path, max_age=None):
+        """List the names of the entries of a directory.
+
+        The cached listing is returned if it is younger than max_age seconds
+        (None for no limit), otherwise the directory is listed again. None is
+        returned if the directory does not exist.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT listed_at, missing FROM listings WHERE path = ?', (path,)
+            ).fetchone()
+            if row is not None:
+                listed_at, missing = row
+                age = time.time() - listed_at
+                if missing:
+                    if age < self.negative_ttl:
+                        return None
+                elif max_age is None or age < max_age:
+                    return [
+                        name
+                        for (name,) in self._connection.execute(
+                            'SELECT name FROM entries WHERE path = ?', (path,)
+                        )
+                    ]
+        return self._refresh(path)
+
+    def _refresh(self, path):
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            names = None
+        logger.debug('indexed %s', path)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO listings VALUES (?, ?, ?)',
+                (path, time.time(), names is None),
+            )
+            self._connection.execute('DELETE FROM entries WHERE path = ?', (path,))
+            self._connection.executemany(
+                'INSERT INTO entries VALUES (?, ?)',
+                ((path, name) for name in names or ()),
+            )
+        return names
+
+    def find_entries(self, path, match, immutable=False):
+        """List the entries of a directory whose name is selected by match.
+
+        If immutable is false, the cached listing is only used if it is
+        younger than ttl. If nothing matches, the lookup is negative and the
+        directory is listed again if the listing is older than negative_ttl.
+        """
+        max_age = None if immutable else self.ttl
+        names = self.list_directory(path, max_age=max_age)
+        matches = [name for name in names or () if match(name)]
+        if not matches and names is not None:
+            names = self.list_directory(
+                path, max_age=min(max_age or self.negative_ttl, self.negative_ttl)
+            )
+            matches = [name for name in names or () if match(name)]
+        return matches
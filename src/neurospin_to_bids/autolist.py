@@ -6,12 +6,14 @@
 
 """Auto-listing of session contents by parsing the acquisition database."""
 
+import collections
 import csv
 import fnmatch
 import itertools
 import json
 import logging
 import os
+import re
 
 import yaml
 
@@ -20,7 +22,7 @@ from . import acquisition_db, bids, exp_info
 logger = logging.getLogger(__name__)
 
 
-def autolist_dicom(exp_info_path):
+def autolist_dicom(exp_info_path, scan_workers=acquisition_db.DEFAULT_SCAN_WORKERS):
     """Create participants_to_import.tsv using autolist rules.
 
     The list of subjects and sessions is read from participants_list.tsv. For
@@ -28,13 +30,18 @@ def autolist_dicom(exp_info_path):
     listed to obtain the list of (SequenceNumber, SequenceDescription), which
     are then matched against rules defined in autolist.yaml.
 
+    The session directories of all subjects are listed beforehand, with
+    scan_workers directories listed concurrently.
+
     Known limitation: duplicate BIDS names are not checked across different
     lines of the same subject and session.
     """
     filename = os.path.join(exp_info_path, 'participants_to_import.tsv')
     with open(filename, 'x', encoding='utf-8') as csv_file:
         first = True
-        for subject_info in _generate_autolist_dicom_lines(exp_info_path):
+        for subject_info in _generate_autolist_dicom_lines(
+            exp_info_path, scan_workers=scan_workers
+        ):
             if first:
                 # We use the list of columns that were read from the input
                 # participants_list.tsv, so we have to wait until the first
@@ -53,19 +60,58 @@ def autolist_dicom(exp_info_path):
             writer.writerow(subject_info)
 
 
-def _generate_autolist_dicom_lines(exp_info_path):
+def autolist_subjects(
+    exp_info_path, subjects_info, scan_workers=acquisition_db.DEFAULT_SCAN_WORKERS
+):
+    """Apply the autolist rules to lines of participants_list.tsv.
+
+    subjects_info is a list of lines read with
+    exp_info.iterate_participants_list. The lines of participants_to_import.tsv
+    are returned as a list, without writing the file (see autolist_dicom).
+    """
+    return list(
+        _generate_autolist_dicom_lines(
+            exp_info_path, scan_workers=scan_workers, subjects_info=subjects_info
+        )
+    )
+
+
+def _generate_autolist_dicom_lines(
+    exp_info_path,
+    scan_workers=acquisition_db.DEFAULT_SCAN_WORKERS,
+    subjects_info=None,
+):
     with open(os.path.join(exp_info_path, 'autolist.yaml'), 'rb') as f:
         autolist_config = yaml.safe_load(f)
         # TODO validate the autolist config
 
-    for subject_info in exp_info.iterate_participants_list(
-        os.path.join(exp_info_path, 'participants_list.tsv')
-    ):
+    if subjects_info is None:
+        subjects_info = list(
+            exp_info.iterate_participants_list(
+                os.path.join(exp_info_path, 'participants_list.tsv')
+            )
+        )
+    matcher = RuleMatcher(autolist_config['rules'])
+    resolver = acquisition_db.SessionResolver()
+    # MEG sessions are not in dated directories of the MRI layout
+    resolver.prefetch(
+        (
+            (
+                subject_info['location'],
+                subject_info['acq_date'].strftime('%Y%m%d'),
+                subject_info['NIP'],
+            )
+            for subject_info in subjects_info
+            if subject_info['location'].strip().lower() != 'meg'
+        ),
+        workers=scan_workers,
+    )
+    for subject_info in subjects_info:
         logger.debug('Now autolisting:\n%s', subject_info)
         location = subject_info['location']
         acq_date = subject_info['acq_date'].strftime('%Y%m%d')
         nip = subject_info['NIP']
-        session_dirs = acquisition_db.get_session_paths(location, acq_date, nip)
+        session_dirs = resolver.get_session_paths(location, acq_date, nip)
         if len(session_dirs) == 0:
             logger.error(
                 'no directory found for given NIP %s in %s on %s',
@@ -80,7 +126,9 @@ def _generate_autolist_dicom_lines(exp_info_path):
         for session_dir in session_dirs:
             # TODO implement reading of to_import for manual overrides
             to_import_for_session = list(
-                autolist_dicom_session(session_dir, autolist_config)
+                autolist_dicom_session(
+                    session_dir, autolist_config, resolver=resolver, matcher=matcher
+                )
             )
             if len(to_import_for_session) != 0:
                 if sessions_found == 0:
@@ -99,106 +147,210 @@ def _generate_autolist_dicom_lines(exp_info_path):
         yield subject_info
 
 
-def autolist_dicom_session(session_dir, autolist_config):
-    """Generate rules for the to_import column for a given session."""
-    series_list = sorted(acquisition_db.list_dicom_series(session_dir))
+def autolist_dicom_session(session_dir, autolist_config, resolver=None, matcher=None):
+    """Generate rules for the to_import column for a given session.
+
+    If resolver (acquisition_db.SessionResolver) is given, the session
+    directory is listed through it. If matcher (RuleMatcher) is given, it
+    must have been compiled from the rules of autolist_config.
+    """
+    if resolver is None:
+        series_list = sorted(acquisition_db.list_dicom_series(session_dir))
+    else:
+        series_list = sorted(resolver.list_dicom_series(session_dir))
     logger.debug('List of DICOM series in %s: %s', session_dir, series_list)
+    headers = None
+    if any('header' in rule for rule in autolist_config['rules']):
+        headers = acquisition_db.get_series_headers(session_dir)
     match_list = list(
         _autolist_dicom_first_pass(
-            series_list, autolist_config, session_dir=session_dir
+            series_list,
+            autolist_config,
+            session_dir=session_dir,
+            headers=headers,
+            matcher=matcher,
         )
     )
     _autolist_handle_repetitions(match_list, autolist_config)
     return _autolist_generate_to_import(match_list)
 
 
-def rule_matches(rule, series_description):
-    return fnmatch.fnmatchcase(series_description, rule['SeriesDescription'])
+def rule_matches(rule, series_description, header=None):
+    """Test if a rule matches a series.
+
+    The optional 'header' key of the rule maps DICOM header fields to glob
+    patterns, which must all match the header of the series (see
+    dicom_headers.read_series_header). Multi-valued fields, such as
+    ImageType, are matched as their DICOM representation (e.g.
+    ORIGINAL\\PRIMARY\\M\\ND).
+    """
+    if not fnmatch.fnmatchcase(series_description, rule['SeriesDescription']):
+        return False
+    return _header_matches(rule, header)
+
+
+def _header_matches(rule, header):
+    for field, pattern in rule.get('header', {}).items():
+        if header is None or field not in header:
+            return False
+        value = header[field]
+        if isinstance(value, list):
+            value = '\\'.join(str(item) for item in value)
+        if not fnmatch.fnmatchcase(str(value), pattern):
+            return False
+    return True
+
+
+# Characters that may start a wildcard in a glob pattern
+_WILDCARD_RE = re.compile(r'[*?[]')
+
+
+class RuleMatcher:
+    """Match series against all the rules of an autolist configuration.
+
+    The SeriesDescription patterns of the rules are compiled once, and
+    indexed by their literal prefix (up to the first wildcard), so that a
+    series description is only matched against the patterns of the rules
+    whose prefix it starts with. The rules matching each series description
+    are remembered, since the same descriptions recur in every session.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._patterns_by_prefix = collections.defaultdict(list)
+        for rule_index, rule in enumerate(rules):
+            pattern = rule['SeriesDescription']
+            prefix = _WILDCARD_RE.split(pattern, 1)[0]
+            self._patterns_by_prefix[prefix].append(
+                (rule_index, re.compile(fnmatch.translate(pattern)))
+            )
+        self._prefix_lengths = sorted(
+            {len(prefix) for prefix in self._patterns_by_prefix}
+        )
+        self._matches = {}
+
+    def _description_matches(self, series_description):
+        try:
+            return self._matches[series_description]
+        except KeyError:
+            pass
+        matches = []
+        for length in self._prefix_lengths:
+            if length > len(series_description):
+                break
+            for rule_index, regex in self._patterns_by_prefix.get(
+                series_description[:length], ()
+            ):
+                if regex.match(series_description):
+                    matches.append(rule_index)
+        matches.sort()
+        self._matches[series_description] = matches
+        return matches
 
+    def matching_rules(self, series_description, header=None):
+        """List the indices of the rules matching a series, in order.
 
-def _autolist_dicom_first_pass(series_list, autolist_config, session_dir='<unknown>'):
+        The result is the same as testing each rule with rule_matches.
+        """
+        return [
+            rule_index
+            for rule_index in self._description_matches(series_description)
+            if _header_matches(self.rules[rule_index], header)
+        ]
+
+
+def _autolist_dicom_first_pass(
+    series_list,
+    autolist_config,
+    session_dir='<unknown>',
+    headers=None,
+    matcher=None,
+):
     rules = autolist_config['rules']
+    if matcher is None:
+        matcher = RuleMatcher(rules)
     consecutive_series_rule = None
     consecutive_next_series_number = None  # to prevent F821 flake8 warning
     consecutive_next_order = None  # to prevent F821 flake8 warning
     for series_number, series_description in series_list:
         rule_matched = -1
-        for rule_index, rule in enumerate(rules):
-            if rule_matches(rule, series_description):
-                logger.debug(
-                    'rule %d matches series description %d (%s)',
+        header = None if headers is None else headers.get(series_number)
+        for rule_index in matcher.matching_rules(series_description, header):
+            rule = rules[rule_index]
+            logger.debug(
+                'rule %d matches series description %d (%s)',
+                rule_index,
+                series_number,
+                series_description,
+            )
+            if rule_matched != -1:
+                logger.warning(
+                    'in DICOM session %s, rules %d (%s) '
+                    'and %d (%s) both match series %d (%s), '
+                    'the first one takes precedence',
+                    session_dir,
+                    rule_matched,
+                    rules[rule_matched]['SeriesDescription'],
                     rule_index,
+                    rule['SeriesDescription'],
                     series_number,
                     series_description,
                 )
-                if rule_matched != -1:
-                    logger.warning(
-                        'in DICOM session %s, rules %d (%s) '
-                        'and %d (%s) both match series %d (%s), '
-                        'the first one takes precedence',
-                        session_dir,
-                        rule_matched,
-                        rules[rule_matched]['SeriesDescription'],
-                        rule_index,
-                        rule['SeriesDescription'],
-                        series_number,
-                        series_description,
-                    )
-                    continue
-                rule_matched = rule_index
-                if consecutive_series_rule is not None and (
-                    consecutive_series_rule != rule_index
-                    or (consecutive_next_series_number != series_number)
-                ):
-                    logger.warning(
-                        'Missing elements of the consecutive '
-                        'series %d (%s): only %d/%d elements found',
-                        consecutive_series_rule,
-                        rules[consecutive_series_rule]['SeriesDescription'],
-                        consecutive_next_order,
-                        len(rules[consecutive_series_rule]['consecutive_series']),
-                    )
-                    consecutive_series_rule = None
-                data_type = rule['data_type']
-                metadata = rule.get('metadata')
-                if 'bids_name' in rule:
-                    bids_name = rule['bids_name']
-                    assert consecutive_series_rule is None
-                elif 'consecutive_series' in rule:
-                    if consecutive_series_rule is not None:
-                        assert consecutive_series_rule == rule_index
-                        bids_name = rule['consecutive_series'][consecutive_next_order][
-                            'bids_name'
-                        ]
-                        consecutive_next_order += 1
-                        consecutive_next_series_number += 1
-                        if consecutive_next_order >= len(rule['consecutive_series']):
-                            consecutive_series_rule = None
-                    else:
-                        bids_name = rule['consecutive_series'][0]['bids_name']
-                        consecutive_series_rule = rule_index
-                        consecutive_next_order = 1
-                        consecutive_next_series_number = series_number + 1
+                continue
+            rule_matched = rule_index
+            if consecutive_series_rule is not None and (
+                consecutive_series_rule != rule_index
+                or (consecutive_next_series_number != series_number)
+            ):
+                logger.warning(
+                    'Missing elements of the consecutive '
+                    'series %d (%s): only %d/%d elements found',
+                    consecutive_series_rule,
+                    rules[consecutive_series_rule]['SeriesDescription'],
+                    consecutive_next_order,
+                    len(rules[consecutive_series_rule]['consecutive_series']),
+                )
+                consecutive_series_rule = None
+            data_type = rule['data_type']
+            metadata = rule.get('metadata')
+            if 'bids_name' in rule:
+                bids_name = rule['bids_name']
+                assert consecutive_series_rule is None
+            elif 'consecutive_series' in rule:
+                if consecutive_series_rule is not None:
+                    assert consecutive_series_rule == rule_index
+                    bids_name = rule['consecutive_series'][consecutive_next_order][
+                        'bids_name'
+                    ]
+                    consecutive_next_order += 1
+                    consecutive_next_series_number += 1
+                    if consecutive_next_order >= len(rule['consecutive_series']):
+                        consecutive_series_rule = None
                 else:
-                    logger.error(
-                        'ignoring malformed rule %d (%s): missing '
-                        'mandatory key bids_name or '
-                        'consecutive_series',
-                        rule_index,
-                        rule['SeriesDescription'],
-                    )
-                    rule_matched = -1
-
-                logger.debug(
-                    'first pass rule: %d -> %s/%s', series_number, data_type, bids_name
+                    bids_name = rule['consecutive_series'][0]['bids_name']
+                    consecutive_series_rule = rule_index
+                    consecutive_next_order = 1
+                    consecutive_next_series_number = series_number + 1
+            else:
+                logger.error(
+                    'ignoring malformed rule %d (%s): missing '
+                    'mandatory key bids_name or '
+                    'consecutive_series',
+                    rule_index,
+                    rule['SeriesDescription'],
                 )
-                yield {
-                    'series_number': series_number,
-                    'data_type': data_type,
-                    'bids_name': bids_name,
-                    'metadata': metadata,
-                    'rule_index': rule_index,
-                }
+                rule_matched = -1
+
+            logger.debug(
+                'first pass rule: %d -> %s/%s', series_number, data_type, bids_name
+            )
+            yield {
+                'series_number': series_number,
+                'data_type': data_type,
+                'bids_name': bids_name,
+                'metadata': metadata,
+                'rule_index': rule_index,
+            }
 
 
 def _autolist_handle_repetitions(series_list, autolist_config, add_runs_only=False):
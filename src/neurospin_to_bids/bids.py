@@ -5,6 +5,7 @@ import csv
 import itertools
 import json
 import logging
+import os
 import re
 import warnings
 
@@ -85,6 +86,20 @@ class BIDSTSVDialect(csv.Dialect):
     lineterminator = '\r\n'
 
 
+def add_to_bidsignore(dataset_dir, pattern):
+    """Add a pattern to the .bidsignore file of a dataset, if not present."""
+    bidsignore = os.path.join(dataset_dir, '.bidsignore')
+    try:
+        with open(bidsignore, encoding='utf-8') as f:
+            patterns = f.read().splitlines()
+    except FileNotFoundError:
+        patterns = []
+    if pattern in patterns:
+        return
+    with open(bidsignore, 'a', encoding='utf-8') as f:
+        f.write(pattern + '\n')
+
+
 def validate_bids_partial_name(name):
     """Verify if the partial base name of a BIDS file is well-formed.
 
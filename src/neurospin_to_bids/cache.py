@@ -0,0 +1,256 @@
+"""Cache of conversion outputs, which can be shared between datasets.
+
+The outputs of dcm2niix are stored under the fingerprint of the conversion
+(see manifest.series_fingerprint), which covers the source DICOM files, the
+converter version and the conversion options. Outputs are stored before any
+dataset-specific post-processing (renaming, defacing, sidecar updates), so
+that they can be reused by any dataset that imports the same series.
+
+The size of the cache can be bounded, in which case the least recently used
+entries are evicted. The cache directory may be shared between concurrent
+users: entries are created atomically, the directory is listed again before
+each eviction to take the entries and accesses of other users into account,
+and an entry that disappears (evicted by another process) is simply a cache
+miss.
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+ENTRY_STEM = 'series'
+"""Stem replacing the dataset-specific target filename in cached files."""
+
+
+def _can_link(filename, deface):
+    # JSON sidecars are modified in-place after conversion, and so are images
+    # that are defaced, so they must not share their inode with the cache.
+    return not (filename.endswith('.json') or deface)
+
+
+def _link_or_copy(src, dst, link=True):
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass  # e.g. the cache is on a different filesystem
+    shutil.copy2(src, dst)
+
+
+def _tree_size(path):
+    size = 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            size += _tree_size(entry.path)
+        else:
+            size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+class LRUDirectory:
+    """Directory of entries with a bounded total size.
+
+    Each entry is a directory, identified by a key (e.g. a fingerprint),
+    whose mtime records its last access (see touch). When the total size of
+    the entries exceeds max_size, the least recently used entries are
+    evicted, except those that are pinned (i.e. in use).
+
+    cache_dir (str): path to the directory, created if needed.
+    max_size (int): maximum total size of the entries in bytes, or None for
+        no limit.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # Index of the entries: key -> [size, last access time]. It is filled
+        # lazily, and refreshed from the directory before each eviction.
+        self._entries = None
+        self._pinned = collections.Counter()
+        self._lock = threading.RLock()
+        os.makedirs(os.path.join(cache_dir, 'tmp'), exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def touch(self, key):
+        """Record an access to an entry."""
+        entry_dir = self._entry_dir(key)
+        os.utime(entry_dir)
+        with self._lock:
+            if self._entries is not None and key in self._entries:
+                self._entries[key][1] = os.stat(entry_dir).st_mtime
+
+    def add_entry(self, key, size):
+        """Record a new entry, evicting older entries if needed."""
+        with self._lock:
+            self._load_entries()
+            self._entries[key] = [size, os.stat(self._entry_dir(key)).st_mtime]
+            self.evict()
+
+    @contextlib.contextmanager
+    def pinned(self, key):
+        """Context manager protecting an entry from eviction."""
+        with self._lock:
+            self._pinned[key] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pinned[key] -= 1
+                if not self._pinned[key]:
+                    del self._pinned[key]
+                    # Entries that were in use may have to be evicted now
+                    self.evict()
+
+    def _load_entries(self, refresh=False):
+        if self._entries is not None and not refresh:
+            return
+        # The sizes of the known entries are kept, since entries are never
+        # modified once created; only the new entries are measured.
+        known_entries = self._entries or {}
+        self._entries = {}
+        for prefix_entry in os.scandir(self.cache_dir):
+            if prefix_entry.name == 'tmp' or not prefix_entry.is_dir():
+                continue
+            for entry in os.scandir(prefix_entry.path):
+                try:
+                    size = known_entries.get(entry.name, [None])[0]
+                    if size is None:
+                        size = _tree_size(entry.path)
+                    self._entries[entry.name] = [size, entry.stat().st_mtime]
+                except OSError:
+                    continue  # removed concurrently
+
+    def total_size(self):
+        """Total size of the entries, in bytes."""
+        with self._lock:
+            self._load_entries()
+            return sum(size for size, _ in self._entries.values())
+
+    def evict(self):
+        """Remove the least recently used entries to respect max_size."""
+        if self.max_size is None:
+            return
+        with self._lock:
+            # Other users of the directory may have added, accessed or evicted
+            # entries since it was last listed
+            self._load_entries(refresh=True)
+            total_size = sum(size for size, _ in self._entries.values())
+            by_last_access = sorted(self._entries.items(), key=lambda item: item[1][1])
+            for key, (size, _) in by_last_access:
+                if total_size <= self.max_size:
+                    break
+                if key in self._pinned:
+                    continue
+                logger.debug('evicting %s from %s', key, self.cache_dir)
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                del self._entries[key]
+                total_size -= size
+
+
+class ConversionCache(LRUDirectory):
+    """Directory containing the outputs of previous conversions.
+
+    cache_dir (str): path to the cache directory, created if needed.
+    max_size (int): maximum total size of the cached files in bytes, or None
+        for an unbounded cache.
+    """
+
+    def fetch(self, fingerprint, file_to_convert, deface=False):
+        """Copy the cached outputs of a conversion to the target directory.
+
+        The files are hard-linked if possible, except those that are modified
+        in-place later on. They are first gathered in a temporary directory
+        next to the target files, so that a failed fetch does not leave
+        partial outputs behind. The list of the target files is returned, or
+        None if the conversion is not in the cache.
+        """
+        entry_dir = self._entry_dir(fingerprint)
+        out_dir = file_to_convert['out_dir']
+        try:
+            names = sorted(
+                name for name in os.listdir(entry_dir) if name.startswith(ENTRY_STEM)
+            )
+        except FileNotFoundError:
+            return None
+        except OSError as exc:
+            logger.warning('cannot fetch %s from the cache: %s', entry_dir, exc)
+            return None
+        files = []
+        try:
+            tmp_dir = tempfile.mkdtemp(prefix='.cache-', dir=out_dir)
+            try:
+                for name in names:
+                    filename = file_to_convert['filename'] + name[len(ENTRY_STEM) :]
+                    _link_or_copy(
+                        os.path.join(entry_dir, name),
+                        os.path.join(tmp_dir, filename),
+                        link=_can_link(filename, deface),
+                    )
+                for name in names:
+                    filename = file_to_convert['filename'] + name[len(ENTRY_STEM) :]
+                    os.replace(
+                        os.path.join(tmp_dir, filename),
+                        os.path.join(out_dir, filename),
+                    )
+                    files.append(os.path.join(out_dir, filename))
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except OSError as exc:
+            for filename in files:
+                with contextlib.suppress(OSError):
+                    os.unlink(filename)
+            if isinstance(exc, FileNotFoundError):
+                return None  # evicted concurrently
+            logger.warning('cannot fetch %s from the cache: %s', entry_dir, exc)
+            return None
+        with contextlib.suppress(OSError):
+            self.touch(fingerprint)
+        logger.debug('fetched %s from the cache', file_to_convert['in_dir'])
+        return files
+
+    def store(self, fingerprint, file_to_convert, files, deface=False):
+        """Store the outputs of a conversion in the cache.
+
+        files is the list of the files produced by the conversion, before
+        any renaming. Errors are logged and otherwise ignored.
+        """
+        stem = os.path.join(file_to_convert['out_dir'], file_to_convert['filename'])
+        if not files or not all(filename.startswith(stem) for filename in files):
+            return
+        entry_dir = self._entry_dir(fingerprint)
+        if os.path.isdir(entry_dir):
+            return
+        try:
+            tmp_dir = tempfile.mkdtemp(dir=os.path.join(self.cache_dir, 'tmp'))
+            size = 0
+            for filename in files:
+                cached_filename = os.path.join(
+                    tmp_dir, ENTRY_STEM + filename[len(stem) :]
+                )
+                _link_or_copy(
+                    filename, cached_filename, link=_can_link(filename, deface)
+                )
+                size += os.path.getsize(cached_filename)
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # Another process has stored the same entry concurrently
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+        except OSError as exc:
+            logger.warning(
+                'cannot store %s in the cache: %s', file_to_convert['in_dir'], exc
+            )
+            return
+        self.add_entry(fingerprint, size)
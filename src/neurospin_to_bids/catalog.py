@@ -0,0 +1,221 @@
+"""Portable snapshot of the contents of the NeuroSpin acquisition archive.
+
+Listing the archive over a VPN is slow, which makes autolist and dry runs
+impractical on a laptop. A catalog is a compact TSV file (gzip-compressed if
+its name ends with .gz) describing the sessions of the archive and their
+series, with the number and total size of their files. It is exported once
+on a NeuroSpin workstation (see export_catalog), optionally restricted to a
+range of dates or to a list of NIPs, then the lookups of sessions and series
+can be answered from it (see Catalog), so that only the actual conversion
+needs to read the archive.
+
+Each line of the catalog describes an entry of a session directory: for MRI
+scanners, a DICOM series directory of database/<scanner>/<date>/<session>;
+for MEG, a file of neuromag/data/<nip>/<date>.
+"""
+
+import csv
+import gzip
+import logging
+import os
+
+from . import acquisition_db, bids, utils
+from .utils import UserError
+
+logger = logging.getLogger(__name__)
+
+
+CATALOG_COLUMNS = (
+    'scanner',
+    'acq_date',
+    'session',
+    'series',
+    'file_count',
+    'size',
+)
+"""Columns of a catalog file.
+
+For MRI scanners, session is the name of the session directory (e.g.
+aa000001-0001_001), for MEG it is the NIP.
+"""
+
+
+def _open_catalog(filename, mode, compressed=None):
+    if compressed is None:
+        compressed = filename.endswith('.gz')
+    if compressed:
+        return gzip.open(filename, mode + 't', encoding='utf-8', newline='')
+    return open(filename, mode, encoding='utf-8', newline='')
+
+
+def _session_dir(scanner, acq_date, session):
+    db_path = acquisition_db.get_database_path(scanner)
+    if scanner == 'meg':
+        return os.path.join(db_path, session, acq_date)
+    else:  # MRI
+        return os.path.join(db_path, acq_date, session)
+
+
+def _list_names(path):
+    try:
+        with os.scandir(path) as it:
+            return sorted(entry.name for entry in it if not entry.name.startswith('.'))
+    except FileNotFoundError:
+        return []
+
+
+def _scan_session(session):
+    scanner, acq_date, session_name = session
+    session_dir = _session_dir(scanner, acq_date, session_name)
+    rows = []
+    with acquisition_db.archive_reader(session_dir):
+        with os.scandir(session_dir) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                file_count, size = _directory_stats(entry.path)
+            else:
+                file_count, size = 1, entry.stat().st_size
+            rows.append((scanner, acq_date, session_name, entry.name, file_count, size))
+    return rows
+
+
+def _directory_stats(path):
+    file_count = 0
+    size = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                sub_count, sub_size = _directory_stats(entry.path)
+                file_count += sub_count
+                size += sub_size
+            elif entry.is_file():
+                file_count += 1
+                size += entry.stat().st_size
+    return file_count, size
+
+
+def _iterate_sessions(scanner, start_date, end_date, nips):
+    def date_in_range(name):
+        date = acquisition_db.parse_directory_date(name)
+        return (
+            date is not None
+            and (start_date is None or date >= start_date)
+            and (end_date is None or date <= end_date)
+        )
+
+    db_path = acquisition_db.get_database_path(scanner)
+    if scanner == 'meg':
+        for nip in nips if nips is not None else _list_names(db_path):
+            for acq_date in _list_names(os.path.join(db_path, nip)):
+                if date_in_range(acq_date):
+                    yield (scanner, acq_date, nip)
+    else:  # MRI
+        for acq_date in _list_names(db_path):
+            if not date_in_range(acq_date):
+                continue
+            for session in _list_names(os.path.join(db_path, acq_date)):
+                if nips is None or any(
+                    acquisition_db.session_matches_nip(session, nip) for nip in nips
+                ):
+                    yield (scanner, acq_date, session)
+
+
+def export_catalog(
+    filename,
+    scanners=None,
+    start_date=None,
+    end_date=None,
+    nips=None,
+    workers=acquisition_db.DEFAULT_SCAN_WORKERS,
+):
+    """Export a catalog of the acquisition archive to a TSV file.
+
+    scanners (list): keys of acquisition_db.NEUROSPIN_DATABASES to export
+        [default: all scanners].
+    start_date, end_date (datetime.date): range of acquisition dates to
+        export, inclusive [default: no limit].
+    nips (list): NIPs of the sessions to export [default: all sessions].
+    workers (int): number of session directories scanned concurrently.
+
+    The number of exported series is returned.
+    """
+    if scanners is None:
+        scanners = list(acquisition_db.NEUROSPIN_DATABASES)
+    for scanner in scanners:
+        if scanner not in acquisition_db.NEUROSPIN_DATABASES:
+            raise UserError(f'invalid scanner {scanner!r}')
+    tmp_filename = filename + '.tmp'
+    row_count = 0
+    with _open_catalog(tmp_filename, 'w', compressed=filename.endswith('.gz')) as f:
+        writer = csv.writer(f, dialect=bids.BIDSTSVDialect)
+        writer.writerow(CATALOG_COLUMNS)
+        for scanner in scanners:
+            sessions = _iterate_sessions(scanner, start_date, end_date, nips)
+            for rows in utils.imap_unordered_bounded(_scan_session, sessions, workers):
+                writer.writerows(rows)
+                row_count += len(rows)
+    os.replace(tmp_filename, filename)
+    logger.info('exported %d series to the catalog %s', row_count, filename)
+    return row_count
+
+
+class Catalog:
+    """Directory listings of the acquisition archive, read from a catalog.
+
+    A Catalog can be used in place of an acquisition index (see
+    acquisition_db.set_index), so that sessions and series are looked up in
+    the catalog instead of the archive. Directories that are not in the
+    catalog are reported as missing.
+
+    filename (str): path to a catalog written by export_catalog.
+    """
+
+    ttl = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._listings = {}
+        self._stats = {}
+        try:
+            f = _open_catalog(filename, 'r')
+        except FileNotFoundError:
+            raise UserError(f'the catalog {filename} does not exist')
+        with f:
+            reader = csv.DictReader(f, dialect=bids.BIDSTSVDialect)
+            if reader.fieldnames is None or set(CATALOG_COLUMNS) - set(
+                reader.fieldnames
+            ):
+                raise UserError(f'{filename} is not a valid catalog')
+            for row in reader:
+                session_dir = _session_dir(
+                    row['scanner'], row['acq_date'], row['session']
+                )
+                self._add_entry(os.path.dirname(session_dir))
+                self._add_entry(session_dir)
+                series_dir = os.path.join(session_dir, row['series'])
+                self._add_entry(series_dir)
+                self._stats[series_dir] = (int(row['file_count']), int(row['size']))
+
+    def _add_entry(self, path):
+        parent, name = os.path.split(path)
+        # A dict is used as an ordered set
+        self._listings.setdefault(parent, {})[name] = None
+
+    def list_directory(self, path, max_age=None):
+        """List the names of the entries of a directory, None if missing."""
+        names = self._listings.get(os.path.normpath(path))
+        return None if names is None else list(names)
+
+    def find_entries(self, path, match, immutable=False):
+        """List the entries of a directory whose name is selected by match."""
+        return [name for name in self.list_directory(path) or () if match(name)]
+
+    def series_stats(self, series_dir):
+        """Get the (file_count, size) of a series, or None if it is unknown."""
+        return self._stats.get(os.path.normpath(series_dir))
+
+    def close(self):
+        pass
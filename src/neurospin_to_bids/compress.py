@@ -0,0 +1,91 @@
+"""Compression of the NIfTI files produced by the conversion.
+
+dcm2niix compresses its outputs itself, single-threaded on many builds, which
+can take most of the conversion time of large 4D series. Instead, the series
+can be converted to uncompressed NIfTI, and compressed afterwards with pigz
+(multi-threaded block compression) if it is installed, or else with the gzip
+module, whose compression runs concurrently in several threads. In both
+cases the gzip header contains no file name or timestamp, so that the
+checksums of the outputs are reproducible.
+"""
+
+import contextlib
+import functools
+import gzip
+import logging
+import os
+import shutil
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+
+COMPRESSION_LEVEL = 6
+"""Compression level, the default of gzip, pigz and dcm2niix."""
+
+
+@functools.cache
+def find_pigz():
+    """Path to the pigz executable, or None if it is not installed."""
+    return shutil.which('pigz')
+
+
+def gzip_file(filename, threads=1):
+    """Compress a file to filename + '.gz', removing the original.
+
+    The compressed file is written under a temporary name first, so that an
+    interrupted compression never leaves a truncated .gz file. The path to
+    the compressed file is returned.
+    """
+    gz_filename = filename + '.gz'
+    tmp_filename = gz_filename + '.tmp'
+    pigz = find_pigz()
+    try:
+        with open(tmp_filename, 'wb') as f:
+            if pigz:
+                subprocess.run(
+                    (
+                        pigz,
+                        '--stdout',
+                        '--no-name',
+                        f'-{COMPRESSION_LEVEL}',
+                        '--processes',
+                        str(threads),
+                        filename,
+                    ),
+                    stdout=f,
+                    check=True,
+                )
+            else:
+                with (
+                    open(filename, 'rb') as f_in,
+                    gzip.GzipFile(
+                        filename='',
+                        mode='wb',
+                        fileobj=f,
+                        compresslevel=COMPRESSION_LEVEL,
+                        mtime=0,
+                    ) as f_out,
+                ):
+                    shutil.copyfileobj(f_in, f_out, 2**20)
+        shutil.copymode(filename, tmp_filename)
+        os.replace(tmp_filename, gz_filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_filename)
+        raise
+    os.unlink(filename)
+    logger.debug('compressed %s', filename)
+    return gz_filename
+
+
+def gzip_outputs(filenames, threads=1):
+    """Compress the uncompressed NIfTI files among the outputs of a series.
+
+    The list of the resulting filenames is returned, other files (e.g. JSON
+    sidecars) are left untouched.
+    """
+    return [
+        gzip_file(filename, threads=threads) if filename.endswith('.nii') else filename
+        for filename in filenames
+    ]
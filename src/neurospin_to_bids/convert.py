@@ -0,0 +1,539 @@
+"""Conversion of DICOM series to NIfTI using dcm2niix."""
+
+import collections
+import contextlib
+import functools
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import typing
+
+import nibabel
+import numpy
+import yaml
+
+from . import acquisition_db, manifest, scheduling, utils
+from .utils import UserError
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionResult(typing.NamedTuple):
+    """Outcome of the conversion of one DICOM series.
+
+    series is the dictionary describing the series (in_dir, out_dir,
+    filename), returncode is the exit status of the converter, and files is
+    the list of the paths of the files that were produced for this series.
+    duration is the time taken by the conversion in seconds, or None if it is
+    unknown (e.g. outputs fetched from the cache).
+    """
+
+    series: dict
+    returncode: int
+    files: list
+    duration: float | None = None
+
+
+@functools.cache
+def get_dcm2niix_version():
+    """Get the version string of the installed dcm2niix.
+
+    'unknown' is returned if the version cannot be determined.
+    """
+    try:
+        completed = subprocess.run(
+            ('dcm2niix', '--version'),
+            check=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+    except OSError:
+        return 'unknown'
+    match = re.search(r'\bv[0-9]+\.[0-9]+\.[0-9]+\S*', completed.stdout)
+    return match.group(0) if match else 'unknown'
+
+
+def dcm2niix_command(file_to_convert, options, out_dir=None):
+    """Build the dcm2niix command line for one series.
+
+    The options dictionary uses the keys of the Options section of the
+    dcm2niibatch configuration file (isGz, isFlipY...), so that both
+    converters give the same results.
+    """
+    if out_dir is None:
+        out_dir = file_to_convert['out_dir']
+    return (
+        'dcm2niix',
+        '-b',
+        'y' if options.get('isCreateBIDS', True) else 'n',
+        '-z',
+        'y' if options.get('isGz', False) else 'n',
+        # -y is not listed in the help of dcm2niix, it is the command-line
+        # counterpart of the isFlipY option of dcm2niibatch.
+        '-y',
+        'y' if options.get('isFlipY', True) else 'n',
+        '-s',
+        'y' if options.get('isOnlySingleFile', False) else 'n',
+        '-v',
+        '1' if options.get('isVerbose', False) else '0',
+        '-f',
+        file_to_convert['filename'],
+        '-o',
+        out_dir,
+        file_to_convert['in_dir'],
+    )
+
+
+def convert_series(file_to_convert, options):
+    """Convert one DICOM series with dcm2niix.
+
+    dcm2niix writes into a private temporary directory, so that the exact list
+    of the files produced for this series is known, even when other series
+    are converted concurrently into the same output directory. The files are
+    then moved to the output directory.
+
+    A ConversionResult is returned.
+    """
+    out_dir = file_to_convert['out_dir']
+    tmp_dir = tempfile.mkdtemp(prefix='.dcm2niix-', dir=out_dir)
+    try:
+        cmd = dcm2niix_command(file_to_convert, options, out_dir=tmp_dir)
+        logger.debug('running %s', ' '.join(cmd))
+        try:
+            returncode = subprocess.call(cmd)
+        except OSError as exc:
+            logger.error('cannot run dcm2niix: %s', exc)
+            returncode = 127
+        files = []
+        for basename in sorted(os.listdir(tmp_dir)):
+            filename = os.path.join(out_dir, basename)
+            os.replace(os.path.join(tmp_dir, basename), filename)
+            files.append(filename)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return ConversionResult(file_to_convert, returncode, files)
+
+
+def series_output_files(file_to_convert):
+    """List the files of the output directory named after a series.
+
+    Their name is the target filename followed by an extension or a suffix
+    (e.g. _e2 for multi-echo series), not by a longer name.
+    """
+    return glob.glob(
+        os.path.join(
+            glob.escape(file_to_convert['out_dir']),
+            glob.escape(file_to_convert['filename']) + '[._]*',
+        )
+    )
+
+
+def write_batch_file(batch_file, options, files_to_convert):
+    """Write a configuration file for dcm2niibatch."""
+    dcm2nii_batch = {
+        'Options': options,
+        'Files': [
+            {key: file_to_convert[key] for key in ('in_dir', 'out_dir', 'filename')}
+            for file_to_convert in files_to_convert
+        ],
+    }
+    with open(batch_file, 'w') as f:
+        yaml.dump(dcm2nii_batch, f)
+
+
+class ConversionBackend:
+    """Base class of the backends that convert DICOM series to NIfTI.
+
+    options is a dictionary using the keys of the Options section of the
+    dcm2niibatch configuration file (isGz, isFlipY...).
+
+    The default implementation of convert() calls convert_series() for each
+    series, running at most `jobs` of them concurrently. If a stager (see
+    staging.SeriesStager) is given, each series is read from a local copy
+    that is prefetched while the previous series are being converted. If a
+    memory_budget (see scheduling.ResourceBudget) is given, a conversion only
+    starts once its estimated peak memory fits in the budget. Without a
+    stager, each series is read through the local mirror of the archive, if
+    one is set (see acquisition_db.open_series). If disk_space
+    (see scheduling.DiskSpaceAdmission) is given, a series whose estimated
+    outputs do not fit in its output directory fails without being converted.
+    A conversion that reads the archive holds a reader slot of its database
+    (see acquisition_db.archive_reader).
+    """
+
+    name = None
+
+    def __init__(
+        self, options, jobs=1, stager=None, memory_budget=None, disk_space=None
+    ):
+        self.options = options
+        self.jobs = jobs
+        self.stager = stager
+        self.memory_budget = memory_budget
+        self.disk_space = disk_space
+
+    def version(self):
+        """Version of the converter, used for fingerprinting conversions."""
+        return get_dcm2niix_version()
+
+    def convert(self, files_to_convert):
+        """Convert an iterable of DICOM series.
+
+        Each series is a dictionary with the in_dir, out_dir and filename
+        keys. A ConversionResult is yielded for each series, in no particular
+        order.
+        """
+        if self.stager is None:
+            yield from utils.imap_unordered_bounded(
+                self._convert_archived_series, files_to_convert, self.jobs
+            )
+        else:
+            yield from utils.imap_unordered_bounded(
+                self._convert_staged_series,
+                self.stager.stage(files_to_convert),
+                self.jobs,
+            )
+
+    def _timed_convert_series(self, file_to_convert, reads_archive=False):
+        # The reader slot is only taken once memory and disk space are
+        # reserved, so that waiting conversions do not hold it
+        with contextlib.ExitStack() as stack:
+            if self.memory_budget is not None:
+                stack.enter_context(
+                    self.memory_budget.reserve(
+                        scheduling.estimate_peak_memory(file_to_convert)
+                    )
+                )
+            if self.disk_space is not None:
+                try:
+                    stack.enter_context(
+                        self.disk_space.reserve(
+                            file_to_convert['out_dir'],
+                            scheduling.estimate_output_size(
+                                file_to_convert, self.options.get('isGz', True)
+                            ),
+                        )
+                    )
+                except OSError as exc:
+                    logger.error(
+                        'cannot convert %s: %s', file_to_convert['in_dir'], exc
+                    )
+                    return ConversionResult(file_to_convert, exc.errno, [])
+            if reads_archive:
+                stack.enter_context(
+                    acquisition_db.archive_reader(
+                        file_to_convert['in_dir'], file_to_convert.get('size', 0)
+                    )
+                )
+            start_time = time.monotonic()
+            result = self.convert_series(file_to_convert)
+            return result._replace(duration=time.monotonic() - start_time)
+
+    def _convert_archived_series(self, file_to_convert):
+        with acquisition_db.open_series(file_to_convert['in_dir']) as in_dir:
+            result = self._timed_convert_series(
+                dict(file_to_convert, in_dir=in_dir),
+                # Unless the series is read from the mirror
+                reads_archive=in_dir == file_to_convert['in_dir'],
+            )
+        return result._replace(series=file_to_convert)
+
+    def _convert_staged_series(self, staged_item):
+        file_to_convert, staged_dir = staged_item
+        try:
+            if staged_dir is None:
+                result = self._timed_convert_series(file_to_convert, reads_archive=True)
+            else:
+                result = self._timed_convert_series(
+                    dict(file_to_convert, in_dir=staged_dir)
+                )
+        finally:
+            if staged_dir is not None:
+                self.stager.release(staged_dir)
+        return result._replace(series=file_to_convert)
+
+    def convert_series(self, file_to_convert):
+        """Convert one DICOM series, returning a ConversionResult."""
+        raise NotImplementedError
+
+
+class Dcm2niibatchBackend(ConversionBackend):
+    """Convert all series with a single dcm2niibatch process.
+
+    The exact list of files produced by each series is unknown, it is
+    approximated by the files written during the batch whose name is the
+    target filename followed by an extension or a suffix (e.g. _e2 for
+    multi-echo series). If dcm2niibatch fails, all the series of the batch
+    are reported as failed, and so are the series that produced no file.
+    Concurrent conversions and staging are not supported. If
+    disk_space is given, the space for the outputs of all the series is
+    reserved before the batch starts, and the series that do not fit are
+    left out of the batch and reported as failed.
+    """
+
+    name = 'dcm2niibatch'
+
+    def __init__(self, options, batch_file, disk_space=None):
+        super().__init__(options, disk_space=disk_space)
+        self.batch_file = batch_file
+
+    def convert(self, files_to_convert):
+        # The reservations are released once the batch is done, when the
+        # outputs show up in the free space of their volume
+        with contextlib.ExitStack() as stack:
+            admitted = []
+            for file_to_convert in files_to_convert:
+                if self.disk_space is not None:
+                    try:
+                        stack.enter_context(
+                            self.disk_space.reserve(
+                                file_to_convert['out_dir'],
+                                scheduling.estimate_output_size(
+                                    file_to_convert, self.options.get('isGz', True)
+                                ),
+                            )
+                        )
+                    except OSError as exc:
+                        logger.error(
+                            'cannot convert %s: %s', file_to_convert['in_dir'], exc
+                        )
+                        yield ConversionResult(file_to_convert, exc.errno, [])
+                        continue
+                admitted.append(file_to_convert)
+            results = self._convert_batch(admitted) if admitted else []
+        yield from results
+
+    def _convert_batch(self, files_to_convert):
+        write_batch_file(self.batch_file, self.options, files_to_convert)
+        # Files left by earlier runs are older than the batch (mtimes may be
+        # rounded to the second on some filesystems)
+        start_time = int(time.time())
+        cmd = ('dcm2niibatch', self.batch_file)
+        ret = subprocess.call(cmd)
+        if ret != 0:
+            logger.error('dcm2niibatch returned an error, see above')
+        results = []
+        for file_to_convert in files_to_convert:
+            files = []
+            for filename in series_output_files(file_to_convert):
+                try:
+                    if os.stat(filename).st_mtime >= start_time:
+                        files.append(filename)
+                except FileNotFoundError:
+                    continue
+            if ret != 0:
+                returncode = ret
+            elif not files:
+                logger.error(
+                    'dcm2niibatch produced no file for %s', file_to_convert['in_dir']
+                )
+                returncode = 1
+            else:
+                returncode = 0
+            results.append(ConversionResult(file_to_convert, returncode, files))
+        return results
+
+
+class Dcm2niixBackend(ConversionBackend):
+    """Convert each series with its own dcm2niix process.
+
+    At most `jobs` dcm2niix processes are run concurrently.
+    """
+
+    name = 'dcm2niix'
+
+    def convert_series(self, file_to_convert):
+        result = convert_series(file_to_convert, self.options)
+        if result.returncode != 0:
+            logger.error(
+                'dcm2niix returned an error (exit status %d) for %s',
+                result.returncode,
+                file_to_convert['in_dir'],
+            )
+        return result
+
+
+class SimulatedBackend(ConversionBackend):
+    """Pretend to convert series, producing placeholder outputs.
+
+    Each series takes `latency` seconds and produces a small NIfTI image with
+    its JSON sidecar. The DICOM directory is not read, so that the other
+    stages of the import can be tested and benchmarked on a machine without
+    dcm2niix or access to the acquisition database.
+    """
+
+    name = 'simulated'
+
+    def __init__(
+        self,
+        options,
+        jobs=1,
+        stager=None,
+        memory_budget=None,
+        disk_space=None,
+        latency=0.0,
+    ):
+        super().__init__(
+            options,
+            jobs=jobs,
+            stager=stager,
+            memory_budget=memory_budget,
+            disk_space=disk_space,
+        )
+        self.latency = latency
+
+    def version(self):
+        return 'simulated'
+
+    def convert_series(self, file_to_convert):
+        time.sleep(self.latency)
+        stem = os.path.join(file_to_convert['out_dir'], file_to_convert['filename'])
+        nifti_filename = stem + ('.nii.gz' if self.options.get('isGz') else '.nii')
+        image = nibabel.Nifti1Image(numpy.zeros((4, 4, 4), dtype=numpy.int16), None)
+        nibabel.save(image, nifti_filename)
+        files = [nifti_filename]
+        if self.options.get('isCreateBIDS', True):
+            with open(stem + '.json', 'w') as f:
+                json.dump(
+                    {
+                        'ConversionSoftware': 'neurospin_to_bids simulated backend',
+                        'SeriesDescription': os.path.basename(
+                            file_to_convert['in_dir']
+                        ),
+                    },
+                    f,
+                )
+            files.append(stem + '.json')
+        return ConversionResult(file_to_convert, 0, files)
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (Dcm2niibatchBackend, Dcm2niixBackend, SimulatedBackend)
+}
+"""Conversion backends, indexed by name."""
+
+
+def get_backend(
+    name,
+    options,
+    *,
+    jobs=None,
+    batch_file=None,
+    latency=0.0,
+    stager=None,
+    memory_budget=None,
+    disk_space=None,
+):
+    """Instantiate a conversion backend.
+
+    name (str): one of the keys of BACKENDS, or None to select a default
+        backend: dcm2niibatch if jobs is None, dcm2niix otherwise.
+    """
+    if name is None:
+        name = 'dcm2niibatch' if jobs is None else 'dcm2niix'
+    if jobs is None:
+        jobs = 1
+    if name == 'dcm2niibatch':
+        if stager is not None:
+            logger.warning('staging is not supported by dcm2niibatch, ignoring')
+        if memory_budget is not None:
+            logger.warning('a memory budget is not supported by dcm2niibatch, ignoring')
+        if acquisition_db.MIRROR is not None:
+            logger.warning('the mirror is not supported by dcm2niibatch, ignoring')
+        return Dcm2niibatchBackend(options, batch_file, disk_space=disk_space)
+    elif name == 'dcm2niix':
+        return Dcm2niixBackend(
+            options,
+            jobs=jobs,
+            stager=stager,
+            memory_budget=memory_budget,
+            disk_space=disk_space,
+        )
+    elif name == 'simulated':
+        return SimulatedBackend(
+            options,
+            jobs=jobs,
+            stager=stager,
+            memory_budget=memory_budget,
+            disk_space=disk_space,
+            latency=latency,
+        )
+    else:
+        backends = ', '.join(BACKENDS.keys())
+        raise UserError(
+            f'invalid conversion backend {name!r}, must be one of {backends}'
+        )
+
+
+def cache_key(backend, file_to_convert):
+    """Compute the key of the outputs of a conversion in a ConversionCache.
+
+    The fingerprint of the series describes the final outputs of the import,
+    whereas the cache stores the outputs of the backend, which may be run with
+    different options (e.g. uncompressed NIfTI compressed in a later stage),
+    so the options of the backend are part of the key.
+    """
+    return hashlib.sha256(
+        json.dumps(
+            {
+                'fingerprint': file_to_convert['fingerprint'],
+                'options': {
+                    key: backend.options.get(key)
+                    for key in manifest.FINGERPRINT_OPTIONS
+                },
+            },
+            sort_keys=True,
+        ).encode('utf-8')
+    ).hexdigest()
+
+
+def convert_with_cache(backend, files_to_convert, cache=None):
+    """Convert DICOM series, reusing the outputs found in a ConversionCache.
+
+    Each series must have a 'fingerprint' key (see
+    manifest.series_fingerprint), and may have a 'deface' key, which prevents
+    the sharing of the image file with the cache. The outputs of successful
+    conversions are added to the cache, under their cache_key.
+
+    The series are pulled lazily from files_to_convert. Cache hits are
+    yielded along with the next conversion result, so that they do not wait
+    for the conversion of the whole cohort.
+    """
+    if cache is None:
+        yield from backend.convert(files_to_convert)
+        return
+    cache_hits = collections.deque()
+
+    def cache_misses():
+        for file_to_convert in files_to_convert:
+            files = cache.fetch(
+                cache_key(backend, file_to_convert),
+                file_to_convert,
+                deface=file_to_convert.get('deface', False),
+            )
+            if files is None:
+                yield file_to_convert
+            else:
+                cache_hits.append(ConversionResult(file_to_convert, 0, files))
+
+    for result in backend.convert(cache_misses()):
+        while cache_hits:
+            yield cache_hits.popleft()
+        if result.returncode == 0:
+            cache.store(
+                cache_key(backend, result.series),
+                result.series,
+                result.files,
+                deface=result.series.get('deface', False),
+            )
+        yield result
+    yield from cache_hits
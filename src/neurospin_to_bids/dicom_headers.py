@@ -0,0 +1,275 @@
+"""Index of the DICOM headers of the series of the acquisition archive.
+
+The name of a series directory only gives its SeriesNumber and a
+canonicalized SeriesDescription. Other header fields (see HEADER_FIELDS) are
+read from one DICOM file of each series, without its pixel data. Several
+series are read concurrently in a process pool, since parsing DICOM is
+CPU-bound, and the headers are kept in a JSON index keyed by the series
+directory, so that they are only read again if the files of the series have
+changed.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+
+import pydicom
+import pydicom.errors
+import pydicom.multival
+
+from . import acquisition_db, utils
+
+logger = logging.getLogger(__name__)
+
+
+HEADER_FIELDS = (
+    'SOPClassUID',
+    'Modality',
+    'SeriesNumber',
+    'SeriesDescription',
+    'ProtocolName',
+    'ImageType',
+    'AcquisitionDate',
+    'AcquisitionTime',
+    'SeriesTime',
+    'RepetitionTime',
+    'EchoTime',
+    'NumberOfTemporalPositions',
+    'ImagesInAcquisition',
+    'NumberOfFrames',
+)
+"""Header fields that are read and stored in the index."""
+
+MAX_INSTANCES = 3
+"""Number of files of a series that are tried before giving up."""
+
+INDEX_VERSION = 3
+
+
+NON_IMAGE_SOP_CLASSES = {
+    '1.2.840.10008.5.1.4.1.1.7': 'Secondary Capture Image Storage',
+    '1.2.840.10008.5.1.4.1.1.66': 'Raw Data Storage',
+    '1.3.12.2.1107.5.9.1': 'Siemens CSA Non-Image Storage',
+}
+"""SOP classes of series that are not acquired images (e.g. phoenix reports)."""
+
+DERIVED_IMAGE_TYPES = ('DERIVED', 'SECONDARY')
+"""Values of the first two items of ImageType marking derived images."""
+
+
+def _json_value(value):
+    if isinstance(value, pydicom.multival.MultiValue):
+        return [_json_value(item) for item in value]
+    # The IS and DS value representations are subclasses of int and float
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    return str(value)
+
+
+def read_series_header(series_dir, series_stat=None, max_instances=MAX_INSTANCES):
+    """Read the header fields of a DICOM series.
+
+    The files of the series are tried in alphabetical order, stopping at the
+    first valid DICOM file. series_stat may be the files of the series, if
+    they have already been listed with acquisition_db.scan_series_dir. A
+    dictionary mapping the fields of HEADER_FIELDS that are present to their
+    values is returned, or None if no valid DICOM file was found.
+    """
+    if series_stat is None:
+        series_stat = acquisition_db.scan_series_dir(series_dir)
+    names = sorted(name for name, _, _ in series_stat)
+    for name in names[:max_instances]:
+        try:
+            dataset = pydicom.dcmread(
+                os.path.join(series_dir, name),
+                stop_before_pixels=True,
+                specific_tags=list(HEADER_FIELDS),
+            )
+        except (OSError, pydicom.errors.InvalidDicomError) as exc:
+            logger.debug('cannot read DICOM header of %s: %s', name, exc)
+            continue
+        return {
+            field: _json_value(dataset[field].value)
+            for field in HEADER_FIELDS
+            if field in dataset and dataset[field].value is not None
+        }
+    logger.warning('no valid DICOM file found in %s', series_dir)
+    return None
+
+
+def derived_series_reason(header):
+    """Tell why a series is derived rather than acquired, from its header.
+
+    A series is derived if its ImageType starts with DERIVED or SECONDARY
+    (e.g. MPR, projections, ROI or parametric maps computed on the scanner),
+    or if its SOP class is not one of acquired images (see
+    NON_IMAGE_SOP_CLASSES). A short description of the reason is returned,
+    or None if the series is not derived or its header is unknown.
+    """
+    if header is None:
+        return None
+    sop_class = NON_IMAGE_SOP_CLASSES.get(header.get('SOPClassUID'))
+    if sop_class is not None:
+        return f'SOP class is {sop_class}'
+    image_type = header.get('ImageType', [])
+    if isinstance(image_type, str):
+        image_type = [image_type]
+    for value in image_type[:2]:
+        if value in DERIVED_IMAGE_TYPES:
+            return 'ImageType is ' + '\\'.join(image_type)
+    return None
+
+
+def expected_instance_count(header):
+    """Estimate the minimum number of files of a complete series.
+
+    The estimate is the number of images in the acquisition (e.g. slices)
+    times the number of temporal positions (volumes). None is returned if
+    the header does not allow an estimate, e.g. for enhanced multi-frame
+    DICOM or Siemens mosaics whose number of volumes is not in the standard
+    header.
+    """
+    if header is None or 'NumberOfFrames' in header:
+        return None
+    image_type = header.get('ImageType', [])
+    if 'MOSAIC' in image_type:
+        # One file per volume
+        return header.get('NumberOfTemporalPositions')
+    images = header.get('ImagesInAcquisition')
+    if not images:
+        return None
+    return images * header.get('NumberOfTemporalPositions', 1)
+
+
+def series_stat_fingerprint(series_stat):
+    """Compute a fingerprint of the files of a series (see scan_series_dir)."""
+    return hashlib.sha256(
+        json.dumps(sorted(list(entry) for entry in series_stat)).encode('utf-8')
+    ).hexdigest()
+
+
+class HeaderIndex:
+    """Index of the DICOM headers of series, stored as a JSON file.
+
+    filename (str): path to the JSON file, or None for an index that is only
+        kept in memory.
+
+    The process pool reading the headers is kept from one call of get_headers
+    to the next, until close() is called.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.series = {}
+        self.dirty = False
+        self._executor = None
+        self._executor_workers = 0
+        if filename is None:
+            return
+        try:
+            with open(filename, encoding='utf-8') as f:
+                contents = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            logger.warning('ignoring unreadable header index %s: %s', filename, exc)
+            return
+        if contents.get('version') != INDEX_VERSION:
+            logger.warning(
+                'ignoring header index %s with unknown version %r',
+                filename,
+                contents.get('version'),
+            )
+            return
+        self.series = contents['series']
+
+    def get_headers(self, series_dirs, workers=1, series_stats=None):
+        """Get the headers of several DICOM series.
+
+        The headers of the series that are not in the index, or whose files
+        have changed, are read with up to workers processes. series_stats
+        may map series directories to their files, as already listed by
+        acquisition_db.scan_series_dir, the other directories are listed with
+        up to workers threads. A dictionary mapping each series directory to
+        its header (see read_series_header) is returned.
+        """
+        series_stats = dict(series_stats or {})
+        unscanned = [
+            series_dir for series_dir in series_dirs if series_dir not in series_stats
+        ]
+        series_stats.update(
+            utils.imap_unordered_bounded(
+                lambda series_dir: (
+                    series_dir,
+                    acquisition_db.scan_series_dir(series_dir),
+                ),
+                unscanned,
+                max(workers, 1),
+            )
+        )
+        fingerprints = {
+            series_dir: series_stat_fingerprint(series_stats[series_dir])
+            for series_dir in series_dirs
+        }
+        stale = [
+            series_dir
+            for series_dir, fingerprint in fingerprints.items()
+            if self.series.get(series_dir, {}).get('fingerprint') != fingerprint
+        ]
+        if len(stale) > 1 and workers > 1:
+            # The workers read the files already listed, without listing the
+            # directories again
+            headers = list(
+                self._get_executor(workers).map(
+                    read_series_header,
+                    stale,
+                    [series_stats[series_dir] for series_dir in stale],
+                )
+            )
+        else:
+            headers = [
+                read_series_header(series_dir, series_stats[series_dir])
+                for series_dir in stale
+            ]
+        for series_dir, header in zip(stale, headers, strict=True):
+            self.series[series_dir] = {
+                'fingerprint': fingerprints[series_dir],
+                'header': header,
+            }
+            self.dirty = True
+        return {
+            series_dir: self.series[series_dir]['header'] for series_dir in fingerprints
+        }
+
+    def _get_executor(self, workers):
+        if self._executor is None or self._executor_workers < workers:
+            self.close()
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            self._executor_workers = workers
+        return self._executor
+
+    def close(self):
+        """Stop the processes reading the headers."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            self._executor_workers = 0
+
+    def save(self):
+        """Write the index to disk, if it has been modified."""
+        if not self.dirty or self.filename is None:
+            return
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump(
+                {'version': INDEX_VERSION, 'series': self.series},
+                f,
+                indent=1,
+                sort_keys=True,
+            )
+        os.replace(tmp_filename, self.filename)
+        self.dirty = False
@@ -0,0 +1,126 @@
+"""Discovery of the acquisition sessions of a list of subjects.
+
+Writing participants_list.tsv requires the acquisition date and location of
+each session of each subject. Instead of looking them up by hand, the
+sessions of a list of NIPs are found by listing the date directories of the
+archive in a range of dates, for all scanners or only some of them.
+"""
+
+import csv
+import logging
+import os
+
+from . import acquisition_db, bids, exp_info, utils
+from .utils import UserError
+
+logger = logging.getLogger(__name__)
+
+
+DISCOVERY_COLUMNS = ('NIP', 'acq_date', 'location', 'session_dir')
+"""Columns of the list of discovered sessions.
+
+The first three columns are those of participants_list.tsv.
+"""
+
+
+def discover_sessions(
+    nips,
+    scanners=None,
+    start_date=None,
+    end_date=None,
+    workers=acquisition_db.DEFAULT_SCAN_WORKERS,
+):
+    """Find the acquisition sessions of a list of subjects.
+
+    nips (list): NIPs of the subjects (see exp_info.validate_NIP).
+    scanners (list): keys of acquisition_db.NEUROSPIN_DATABASES to search
+        [default: all scanners].
+    start_date, end_date (datetime.date): range of acquisition dates to
+        search, inclusive [default: no limit].
+    workers (int): number of directories listed concurrently.
+
+    The directories are listed through the acquisition index if it is set
+    (see acquisition_db.set_index). A list of dictionaries with the keys of
+    DISCOVERY_COLUMNS is returned, sorted by NIP and date.
+    """
+    for nip in nips:
+        try:
+            exp_info.validate_NIP(nip)
+        except exp_info.ValidationError as exc:
+            raise UserError(f'{nip!r}: {exc}') from exc
+    if scanners is None:
+        scanners = list(acquisition_db.NEUROSPIN_DATABASES)
+    for scanner in scanners:
+        if scanner not in acquisition_db.NEUROSPIN_DATABASES:
+            raise UserError(f'invalid scanner {scanner!r}')
+
+    def in_range(name):
+        date = acquisition_db.parse_directory_date(name)
+        return (
+            date is not None
+            and (start_date is None or date >= start_date)
+            and (end_date is None or date <= end_date)
+        )
+
+    resolver = acquisition_db.SessionResolver()
+    # Directories to list: (scanner, path) pairs
+    lookup_dirs = []
+    for scanner in scanners:
+        db_path = acquisition_db.get_database_path(scanner)
+        if scanner == 'meg':
+            lookup_dirs.extend((scanner, os.path.join(db_path, nip)) for nip in nips)
+        else:  # MRI
+            lookup_dirs.extend(
+                (scanner, os.path.join(db_path, name))
+                for name in resolver.list_directory(db_path)
+                if in_range(name)
+            )
+
+    def find_sessions(lookup):
+        scanner, lookup_dir = lookup
+        sessions = []
+        for name in resolver.list_directory(lookup_dir):
+            if scanner == 'meg':
+                if in_range(name):
+                    nip = os.path.basename(lookup_dir)
+                    acq_date = acquisition_db.parse_directory_date(name)
+                    sessions.append((nip, acq_date, scanner, lookup_dir, name))
+            else:  # MRI
+                for nip in nips:
+                    if acquisition_db.session_matches_nip(name, nip):
+                        acq_date = acquisition_db.parse_directory_date(
+                            os.path.basename(lookup_dir)
+                        )
+                        sessions.append((nip, acq_date, scanner, lookup_dir, name))
+        return sessions
+
+    rows = []
+    for sessions in utils.imap_unordered_bounded(find_sessions, lookup_dirs, workers):
+        rows.extend(
+            {
+                'NIP': nip,
+                'acq_date': acq_date,
+                'location': scanner,
+                'session_dir': os.path.join(lookup_dir, name),
+            }
+            for nip, acq_date, scanner, lookup_dir, name in sessions
+        )
+    rows.sort(key=lambda row: (row['NIP'], row['acq_date'], row['session_dir']))
+    logger.info(
+        'found %d sessions of %d subjects in %d directories',
+        len(rows),
+        len(nips),
+        len(lookup_dirs),
+    )
+    return rows
+
+
+def write_discovered_sessions(filename, rows):
+    """Write discovered sessions to a TSV file (see DISCOVERY_COLUMNS)."""
+    with open(filename, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(
+            f, dialect=bids.BIDSTSVDialect, fieldnames=DISCOVERY_COLUMNS
+        )
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, acq_date=row['acq_date'].isoformat()))
@@ -0,0 +1,157 @@
+"""Cache of filesystem metadata for the duration of an import.
+
+While planning an import, the same target, sourcedata and acquisition
+directories are checked again and again (os.path.exists, os.path.isfile,
+os.path.islink, os.path.samefile...), once per series or per session. On NFS
+each of these checks is a round trip to the server. The MetadataCache lists
+each directory once with os.scandir, and answers the checks of its entries
+from the listing, keeping the status of the entries that had to be stat'ed.
+
+The cache only knows about the changes made through it (see makedirs and
+forget), so it must only be used for the duration of one import, while
+nothing else modifies the directories that it has listed.
+"""
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class _NewDirectory:
+    """Stand-in for the os.DirEntry of a directory created through the cache."""
+
+    def is_dir(self):
+        return True
+
+    def is_file(self):
+        return False
+
+    def is_symlink(self):
+        return False
+
+
+_NEW_DIRECTORY = _NewDirectory()
+
+
+class MetadataCache:
+    """Directory listings and file status, each read once from the filesystem.
+
+    The hits and misses attributes count the checks answered from the cache,
+    and the calls that had to go to the filesystem. All the checks may be stale
+    in the same way as exists.
+    """
+
+    def __init__(self):
+        # Entries of each listed directory by name, or None if it is missing
+        self._listings = {}
+        self._stats = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _entries(self, dir_path):
+        try:
+            entries = self._listings[dir_path]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return entries
+        self.misses += 1
+        try:
+            with os.scandir(dir_path) as it:
+                entries = {entry.name: entry for entry in it}
+        except (FileNotFoundError, NotADirectoryError):
+            entries = None
+        self._listings[dir_path] = entries
+        return entries
+
+    def _entry(self, path):
+        path = os.path.abspath(path)
+        entries = self._entries(os.path.dirname(path))
+        if entries is None:
+            return None
+        return entries.get(os.path.basename(path))
+
+    def exists(self, path):
+        """Cached equivalent of os.path.exists (without following symlinks).
+
+        The answer comes from the listing of the parent directory, read the
+        first time one of its entries is checked. A path created or removed
+        afterwards other than through the cache (makedirs and forget), e.g. by
+        a conversion or by the commit of a staged session, is not seen: the
+        answer may be stale until the path is forgotten.
+        """
+        return self._entry(path) is not None
+
+    def isfile(self, path):
+        """Cached equivalent of os.path.isfile."""
+        entry = self._entry(path)
+        return entry is not None and entry.is_file()
+
+    def isdir(self, path):
+        """Cached equivalent of os.path.isdir."""
+        path = os.path.abspath(path)
+        if path == os.path.dirname(path):
+            return True
+        entry = self._entry(path)
+        return entry is not None and entry.is_dir()
+
+    def islink(self, path):
+        """Cached equivalent of os.path.islink."""
+        entry = self._entry(path)
+        return entry is not None and entry.is_symlink()
+
+    def stat(self, path):
+        """Cached equivalent of os.stat, following symlinks."""
+        path = os.path.abspath(path)
+        try:
+            stat_result = self._stats[path]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return stat_result
+        if self._entry(path) is None:
+            raise FileNotFoundError(f'no such file or directory: {path!r}')
+        self.misses += 1
+        stat_result = self._stats[path] = os.stat(path)
+        return stat_result
+
+    def samefile(self, path1, path2):
+        """Cached equivalent of os.path.samefile."""
+        return os.path.samestat(self.stat(path1), self.stat(path2))
+
+    def makedirs(self, path):
+        """Create a directory and its parents, unless it is known to exist."""
+        missing_dirs = []
+        path = os.path.abspath(path)
+        while not self.isdir(path):
+            missing_dirs.append(path)
+            path = os.path.dirname(path)
+        if not missing_dirs:
+            return
+        self.misses += 1
+        os.makedirs(missing_dirs[0], exist_ok=True)
+        # Add the new directories to the listings of their parents
+        for path in reversed(missing_dirs):
+            entries = self._listings.get(os.path.dirname(path))
+            if entries is not None:
+                entries[os.path.basename(path)] = _NEW_DIRECTORY
+            self._listings[path] = {}
+
+    def forget(self, path):
+        """Forget what is known about path, after modifying it."""
+        path = os.path.abspath(path)
+        self._listings.pop(os.path.dirname(path), None)
+        self._listings.pop(path, None)
+        self._stats.pop(path, None)
+
+    def log_statistics(self):
+        """Log the number of checks saved by the cache."""
+        logger.info(
+            'filesystem metadata: %d checks answered from the cache, '
+            '%d calls to the filesystem',
+            self.hits,
+            self.misses,
+        )
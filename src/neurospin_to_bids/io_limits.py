@@ -0,0 +1,196 @@
+"""Limits on concurrent reads from each database of the acquisition archive.
+
+The databases of NEUROSPIN_DATABASES may sit on different storage backends:
+a number of concurrent readers that keeps a fast backend busy can overload a
+slow one, where requests then queue up and latency grows without any gain
+in throughput. Each database therefore has its own limit on the number of
+concurrent reads (listings, staging and conversion reads, see
+acquisition_db.archive_reader).
+
+The limits can also be tuned automatically: the throughput of the reads of a
+database is measured over windows of completed reads, and the limit is moved
+one step at a time in the direction that improves the throughput (hill
+climbing). The limit is lowered when latency grows without any gain in
+throughput, and it is not raised while readers do not even use it.
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from . import acquisition_db
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_LIMIT = 8
+"""Default number of concurrent reads from a database."""
+
+MAX_LIMIT = 64
+"""Maximum number of concurrent reads reached by automatic tuning."""
+
+TUNING_WINDOW = 16
+"""Number of completed reads between two adjustments of a limit."""
+
+THROUGHPUT_TOLERANCE = 0.05
+"""Relative loss of throughput after which a tuning step is reverted."""
+
+LATENCY_FACTOR = 2.0
+"""Growth of the mean latency of reads, relative to the lowest latency
+observed, above which a limit is lowered unless the throughput improved."""
+
+
+class ConcurrencyLimit:
+    """Limit on the number of concurrent reads, optionally tuned.
+
+    limit (int): initial number of concurrent reads.
+    name (str): name of the database, used in log messages.
+    autotune (bool): adjust the limit according to the observed throughput
+        and latency, between 1 and max_limit.
+    max_limit (int): upper bound of the automatic tuning.
+    window (int): number of completed reads between two adjustments.
+    """
+
+    def __init__(
+        self,
+        limit,
+        name='archive',
+        autotune=False,
+        max_limit=MAX_LIMIT,
+        window=TUNING_WINDOW,
+    ):
+        if limit < 1:
+            raise ValueError('the concurrency limit must be at least 1')
+        self.limit = limit
+        self.name = name
+        self.autotune = autotune
+        self.max_limit = max(max_limit, limit)
+        self.window = window
+        self.active = 0
+        self._condition = threading.Condition()
+        self._direction = 1
+        self._best_latency = None
+        self._last_throughput = None
+        self._last_unit = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._window_bytes = 0
+        self._window_latency = 0.0
+        self._window_peak = self.active
+
+    @contextlib.contextmanager
+    def reader(self, size=0):
+        """Context manager holding one of the reader slots during a read.
+
+        size (int): number of bytes read, used to measure the throughput.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+            self._window_peak = max(self._window_peak, self.active)
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            latency = time.monotonic() - start_time
+            with self._condition:
+                self.active -= 1
+                self._window_count += 1
+                self._window_bytes += size
+                self._window_latency += latency
+                if self.autotune and self._window_count >= self.window:
+                    self._tune()
+                self._condition.notify_all()
+
+    def _tune(self):
+        elapsed = max(time.monotonic() - self._window_start, 1e-9)
+        # Reads of metadata only (e.g. listings) are measured in reads/s
+        unit = 'B/s' if self._window_bytes else 'reads/s'
+        throughput = (self._window_bytes or self._window_count) / elapsed
+        latency = self._window_latency / self._window_count
+        saturated = self._window_peak >= self.limit
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+        improved = None
+        if self._last_unit == unit:
+            improved = throughput >= self._last_throughput * (1 - THROUGHPUT_TOLERANCE)
+        if improved is False:
+            # The last step made things worse, go back
+            self._direction = -self._direction
+        elif latency > LATENCY_FACTOR * self._best_latency and not (
+            improved and throughput > self._last_throughput
+        ):
+            # Requests are queueing up on the storage backend
+            self._direction = -1
+        elif self._direction > 0 and not saturated:
+            # Raising the limit is pointless while readers do not reach it
+            self._direction = 0
+        elif self._direction == 0 and saturated:
+            self._direction = 1
+        new_limit = min(max(self.limit + self._direction, 1), self.max_limit)
+        if new_limit != self.limit:
+            logger.debug(
+                'concurrent reads from %s: %d -> %d (%.3g %s, %.3g s per read)',
+                self.name,
+                self.limit,
+                new_limit,
+                throughput,
+                unit,
+                latency,
+            )
+            self.limit = new_limit
+        elif self._direction:
+            # Bound reached
+            self._direction = -self._direction
+        self._last_throughput = throughput
+        self._last_unit = unit
+        self._reset_window()
+
+
+class ArchiveLimits:
+    """Limits on concurrent reads from each database of the archive.
+
+    limits (dict): maps keys of acquisition_db.NEUROSPIN_DATABASES to their
+        initial number of concurrent reads.
+    default (int): number of concurrent reads from the other databases, and
+        from paths outside of the databases.
+    autotune (bool): tune the limits automatically (see ConcurrencyLimit).
+
+    The limits only apply to the process that created them, not to the
+    processes that it forks (see dicom_headers.HeaderIndex).
+    """
+
+    def __init__(self, limits=None, default=DEFAULT_LIMIT, autotune=False):
+        limits = limits or {}
+        self._pid = os.getpid()
+        self._limits = {
+            scanner: ConcurrencyLimit(
+                limits.get(scanner, default), name=scanner, autotune=autotune
+            )
+            for scanner in acquisition_db.NEUROSPIN_DATABASES
+        }
+        self._default_limit = ConcurrencyLimit(default, autotune=autotune)
+
+    def get_limit(self, path):
+        """Get the ConcurrencyLimit of the database containing path."""
+        path = os.path.abspath(path)
+        for scanner, limit in self._limits.items():
+            db_path = os.path.abspath(acquisition_db.get_database_path(scanner))
+            if path == db_path or path.startswith(db_path + os.sep):
+                return limit
+        return self._default_limit
+
+    def reader(self, path, size=0):
+        """Context manager holding a reader slot of the database of path."""
+        if os.getpid() != self._pid:
+            return contextlib.nullcontext()
+        return self.get_limit(path).reader(size)
+
+    def current_limits(self):
+        """Get the current limit of each database, as a dictionary."""
+        return {scanner: limit.limit for scanner, limit in self._limits.items()}
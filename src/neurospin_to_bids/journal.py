@@ -0,0 +1,131 @@
+"""Journal of the progress of the conversion of a dataset.
+
+The journal is an append-only file of JSON lines, each of them recording a
+change in the state of a DICOM series (see SERIES_STATES) or the plan of a
+session. Lines are flushed as soon as they are written, so that the journal
+survives a crash of the import, which can then be resumed without scanning
+the acquisition database again (see Journal.load).
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+SERIES_STATES = (
+    'planned',
+    'staged',
+    'converted',
+    'compressed',
+    'postprocessed',
+    'defaced',
+    'patched',
+    'failed',
+)
+"""States of a series, in processing order. 'patched' is the final state."""
+
+
+class Journal:
+    """Append-only journal stored in a file of JSON lines.
+
+    Series and sessions are identified by a key: the key of the series in
+    the conversion manifest (see manifest.ConversionManifest.key), or the
+    path to the session directory.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _write(self, entry):
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.filename) or os.curdir, exist_ok=True)
+                self._file = open(self.filename, 'a', encoding='utf-8')  # noqa: SIM115
+            self._file.write(line)
+            self._file.flush()
+
+    def start_plan(self):
+        """Start a new plan, superseding the contents of the journal."""
+        self._write({'time': time.time(), 'state': 'plan'})
+
+    def plan_session(self, session_dir, to_import, series_keys, complete):
+        """Record the plan of a session."""
+        self._write(
+            {
+                'time': time.time(),
+                'state': 'session',
+                'key': session_dir,
+                'to_import': to_import,
+                'series_keys': series_keys,
+                'complete': complete,
+            }
+        )
+
+    def plan_series(self, key, series):
+        """Record a series that is planned for conversion."""
+        self._write(
+            {'time': time.time(), 'state': 'planned', 'key': key, 'series': series}
+        )
+
+    def record(self, key, state, error=None):
+        """Record a new state of a series."""
+        if state not in SERIES_STATES:
+            raise ValueError(f'invalid series state {state!r}')
+        entry = {'time': time.time(), 'state': state, 'key': key}
+        if error is not None:
+            entry['error'] = error
+        self._write(entry)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def load(self):
+        """Read the last plan recorded in the journal.
+
+        A (sessions, series, states) tuple of dictionaries is returned, which
+        map a session key to the information given to plan_session, a series
+        key to the series given to plan_series, and a series key to the last
+        state of the series. A truncated last line, as left by a crash, is
+        ignored.
+        """
+        sessions = {}
+        series = {}
+        states = {}
+        with open(self.filename, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning(
+                        '%s:%d: ignoring invalid journal entry',
+                        self.filename,
+                        line_number,
+                    )
+                    continue
+                state = entry.get('state')
+                if state == 'plan':
+                    sessions.clear()
+                    series.clear()
+                    states.clear()
+                elif state == 'session':
+                    sessions[entry['key']] = {
+                        'to_import': entry['to_import'],
+                        'series_keys': entry['series_keys'],
+                        'complete': entry['complete'],
+                    }
+                elif state == 'planned':
+                    series[entry['key']] = entry['series']
+                    states[entry['key']] = state
+                elif state in SERIES_STATES:
+                    states[entry['key']] = state
+        return sessions, series, states
@@ -0,0 +1,174 @@
+"""Manifest of the DICOM series that have been converted in a dataset.
+
+The manifest records, for each converted series, a fingerprint of its source
+DICOM directory and of the conversion settings, along with the list of the
+files that were produced. It allows re-runs to skip the series that are
+unchanged, including those that produce several files (e.g. multi-echo or
+fieldmap series) whose names cannot be guessed in advance.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from . import bids
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_VERSION = 1
+
+FINGERPRINT_OPTIONS = ('isGz', 'isFlipY')
+"""Conversion options that are taken into account in the fingerprint."""
+
+DOWNLOADED_MARKER = 'downloaded'
+"""Name of the file marking a session directory as completely imported."""
+
+
+def series_fingerprint(series_stat, converter_version, options):
+    """Compute the fingerprint of the conversion of a DICOM series.
+
+    series_stat is the list of (name, size, mtime_ns) tuples describing the
+    files of the DICOM directory (see acquisition_db.scan_series_dir),
+    converter_version is the version of the converter, and options is the
+    dictionary of conversion options.
+    """
+    h = hashlib.sha256()
+    h.update(
+        json.dumps(
+            {
+                'files': sorted(list(entry) for entry in series_stat),
+                'converter_version': converter_version,
+                'options': {key: options.get(key) for key in FINGERPRINT_OPTIONS},
+            },
+            sort_keys=True,
+        ).encode('utf-8')
+    )
+    return h.hexdigest()
+
+
+class ConversionManifest:
+    """Record of the conversions done in a dataset, stored as a JSON file.
+
+    Series are identified by a key, normally the path of their target file
+    (without extension) relative to root_dir. The paths of the output files
+    are also stored relative to root_dir.
+    """
+
+    def __init__(self, filename, root_dir):
+        self.filename = filename
+        self.root_dir = root_dir
+        self.series = {}
+        self.dirty = False
+        try:
+            with open(filename, encoding='utf-8') as f:
+                contents = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            logger.warning(
+                'ignoring unreadable conversion manifest %s: %s', filename, exc
+            )
+            return
+        if contents.get('version') != MANIFEST_VERSION:
+            logger.warning(
+                'ignoring conversion manifest %s with unknown version %r',
+                filename,
+                contents.get('version'),
+            )
+            return
+        self.series = contents['series']
+
+    def key(self, file_to_convert):
+        """Key identifying a series in the manifest."""
+        return os.path.relpath(
+            os.path.join(file_to_convert['out_dir'], file_to_convert['filename']),
+            self.root_dir,
+        )
+
+    def __contains__(self, key):
+        return key in self.series
+
+    def outputs(self, key):
+        """Full paths to the files that were produced for a series."""
+        entry = self.series.get(key)
+        if entry is None:
+            return []
+        return [os.path.join(self.root_dir, path) for path in entry['outputs']]
+
+    def is_up_to_date(self, key, fingerprint):
+        """Test if the series was converted with the same fingerprint.
+
+        The outputs of the conversion must also still exist.
+        """
+        entry = self.series.get(key)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return False
+        return all(os.path.exists(path) for path in self.outputs(key))
+
+    def record(self, key, fingerprint, outputs):
+        """Record the successful conversion of a series."""
+        self.series[key] = {
+            'fingerprint': fingerprint,
+            'outputs': sorted(os.path.relpath(path, self.root_dir) for path in outputs),
+        }
+        self.dirty = True
+
+    def forget(self, key):
+        """Remove a series from the manifest."""
+        if self.series.pop(key, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Write the manifest to disk, if it has been modified."""
+        if not self.dirty:
+            return
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump(
+                {'version': MANIFEST_VERSION, 'series': self.series},
+                f,
+                indent=1,
+                sort_keys=True,
+            )
+        os.replace(tmp_filename, self.filename)
+        self.dirty = False
+
+
+def _session_marker_contents(to_import, options):
+    # Round-trip through JSON so that tuples compare equal to lists
+    return json.loads(
+        json.dumps(
+            {
+                'to_import': to_import,
+                'options': {key: options.get(key) for key in FINGERPRINT_OPTIONS},
+            }
+        )
+    )
+
+
+def is_session_imported(session_dir, to_import, options):
+    """Test if a session was completely imported with the same settings.
+
+    An empty marker file, as may have been created by hand, marks the session
+    as imported regardless of its settings.
+    """
+    try:
+        with open(os.path.join(session_dir, DOWNLOADED_MARKER), encoding='utf-8') as f:
+            text = f.read()
+    except FileNotFoundError:
+        return False
+    if not text.strip():
+        return True
+    try:
+        return json.loads(text) == _session_marker_contents(to_import, options)
+    except ValueError:
+        return False
+
+
+def mark_session_imported(dataset_dir, session_dir, to_import, options):
+    """Mark a session directory as completely imported."""
+    with open(os.path.join(session_dir, DOWNLOADED_MARKER), 'w', encoding='utf-8') as f:
+        json.dump(_session_marker_contents(to_import, options), f)
+    bids.add_to_bidsignore(dataset_dir, DOWNLOADED_MARKER)
@@ -0,0 +1,103 @@
+"""Read-through local mirror of DICOM series from the acquisition archive.
+
+When the same sessions are converted many times (e.g. while tuning autolist
+rules), their DICOM files are read over NFS every time. The ArchiveMirror
+keeps a persistent local copy of the series that have been read: a series is
+copied on first access, and later accesses are served from the copy as long
+as the source directory still has the same files, with the same sizes and
+mtimes. The total size of the mirror is bounded by evicting the least
+recently used series (see cache.LRUDirectory).
+"""
+
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from . import acquisition_db, cache, utils
+
+logger = logging.getLogger(__name__)
+
+
+STAT_FILENAME = 'series_stat.json'
+"""Name of the file recording the source files of a mirrored series."""
+
+
+class ArchiveMirror(cache.LRUDirectory):
+    """Directory containing local copies of DICOM series.
+
+    mirror_dir (str): path to the mirror directory, created if needed.
+    max_size (int): maximum total size of the mirrored series in bytes, or
+        None for an unbounded mirror.
+    """
+
+    def __init__(self, mirror_dir, max_size=None):
+        super().__init__(mirror_dir, max_size=max_size)
+        # Series are fetched one at a time, so that a copy is never replaced
+        # while another thread is reading it
+        self._series_locks = collections.defaultdict(threading.Lock)
+
+    def _key(self, series_dir):
+        return hashlib.sha256(os.path.abspath(series_dir).encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def open(self, series_dir):
+        """Context manager giving the path to a local copy of a DICOM series.
+
+        The series is copied to the mirror if it is not there yet, or if its
+        files have changed since it was copied. The copy is not evicted
+        until the context is exited. If the series cannot be mirrored, the
+        path to the original series is given.
+        """
+        key = self._key(series_dir)
+        with self._lock:
+            series_lock = self._series_locks[key]
+        with self.pinned(key), series_lock:
+            try:
+                local_dir = self._fetch(key, series_dir)
+            except OSError as exc:
+                logger.warning('cannot mirror %s: %s', series_dir, exc)
+                local_dir = series_dir
+            yield local_dir
+
+    def _fetch(self, key, series_dir):
+        entry_dir = self._entry_dir(key)
+        local_dir = os.path.join(entry_dir, os.path.basename(series_dir))
+        # Round-trip through JSON so that tuples compare equal to lists
+        series_stat = json.loads(json.dumps(acquisition_db.scan_series_dir(series_dir)))
+        try:
+            with open(os.path.join(entry_dir, STAT_FILENAME), encoding='utf-8') as f:
+                mirrored_stat = json.load(f)
+        except (OSError, ValueError):
+            mirrored_stat = None
+        if mirrored_stat == series_stat:
+            self.touch(key)
+            logger.debug('reading %s from the mirror', series_dir)
+            return local_dir
+
+        tmp_dir = tempfile.mkdtemp(dir=os.path.join(self.cache_dir, 'tmp'))
+        try:
+            os.mkdir(os.path.join(tmp_dir, os.path.basename(series_dir)))
+            for name, file_size, _ in series_stat:
+                with acquisition_db.archive_reader(series_dir, file_size):
+                    shutil.copy2(
+                        os.path.join(series_dir, name),
+                        os.path.join(tmp_dir, os.path.basename(series_dir), name),
+                    )
+            with open(os.path.join(tmp_dir, STAT_FILENAME), 'w', encoding='utf-8') as f:
+                json.dump(series_stat, f)
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            # Outdated copy
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        size = sum(file_size for _, file_size, _ in series_stat)
+        logger.debug('mirrored %s (%s)', series_dir, utils.format_size(size))
+        self.add_entry(key, size)
+        return local_dir
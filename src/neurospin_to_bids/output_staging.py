@@ -0,0 +1,136 @@
+"""Staging of the outputs of an import on local disk.
+
+The target dataset usually lives on a network filesystem, where every file
+creation, rename or rewrite is a remote operation. OutputStaging lets the
+sub-*/ses-* directories be built on local scratch (conversion, renaming,
+defacing, sidecar updates), then moves each session directory into the
+dataset in one commit, so that a crash never leaves a half-written session
+visible to downstream pipelines.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+def _make_unique_dir(parent_dir, prefix):
+    # Unlike tempfile.mkdtemp, respect the umask for the permissions
+    while True:
+        path = os.path.join(parent_dir, prefix + uuid.uuid4().hex[:8])
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            continue
+        return path
+
+
+def _link_tree(src, dst):
+    """Recreate the tree src in dst, hard-linking the files when possible."""
+    for dirpath, dirnames, filenames in os.walk(src):
+        dst_dirpath = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(dst_dirpath, exist_ok=True)
+        # os.walk lists symbolic links to directories in dirnames
+        symlinked_dirnames = [
+            name for name in dirnames if os.path.islink(os.path.join(dirpath, name))
+        ]
+        for name in filenames + symlinked_dirnames:
+            src_path = os.path.join(dirpath, name)
+            dst_path = os.path.join(dst_dirpath, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+                continue
+            try:
+                os.link(src_path, dst_path)
+            except OSError:
+                shutil.copy2(src_path, dst_path)
+
+
+def _move_tree(src, dst):
+    """Move the files of the tree src into dst, replacing existing files."""
+    for dirpath, _dirnames, filenames in os.walk(src):
+        dst_dirpath = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(dst_dirpath, exist_ok=True)
+        for name in filenames:
+            dst_path = os.path.join(dst_dirpath, name)
+            if os.path.lexists(dst_path):
+                os.unlink(dst_path)
+            shutil.move(os.path.join(dirpath, name), dst_path)
+
+
+class OutputStaging:
+    """Local staging area mirroring the directory structure of a dataset.
+
+    scratch_dir (str): local directory where a private staging area is
+        created for the current run.
+    dataset_dir (str): path to the target dataset.
+    """
+
+    def __init__(self, scratch_dir, dataset_dir):
+        os.makedirs(scratch_dir, exist_ok=True)
+        self.staging_dir = tempfile.mkdtemp(prefix='bids-', dir=scratch_dir)
+        self.dataset_dir = dataset_dir
+
+    def local_path(self, target_path):
+        """Path in the staging area corresponding to a path in the dataset."""
+        return os.path.join(
+            self.staging_dir, os.path.relpath(target_path, self.dataset_dir)
+        )
+
+    def target_path(self, local_path):
+        """Path in the dataset corresponding to a path in the staging area."""
+        return os.path.join(
+            self.dataset_dir, os.path.relpath(local_path, self.staging_dir)
+        )
+
+    def commit(self, session_dir):
+        """Move the staged contents of a session directory into the dataset.
+
+        session_dir is the path to the session directory in the dataset. The
+        new contents are assembled next to it, together with hard links to
+        the files that it already contains, and then swapped in place with
+        two renames.
+        """
+        local_dir = self.local_path(session_dir)
+        if not os.path.isdir(local_dir):
+            return
+        parent_dir, name = os.path.split(os.path.normpath(session_dir))
+        os.makedirs(parent_dir, exist_ok=True)
+        self._recover(parent_dir, name)
+        partial_dir = _make_unique_dir(parent_dir, f'.{name}.partial-')
+        try:
+            if os.path.isdir(session_dir):
+                _link_tree(session_dir, partial_dir)
+            _move_tree(local_dir, partial_dir)
+            if os.path.isdir(session_dir):
+                old_dir = _make_unique_dir(parent_dir, f'.{name}.old-')
+                os.rename(session_dir, os.path.join(old_dir, name))
+                os.rename(partial_dir, session_dir)
+                shutil.rmtree(old_dir)
+            else:
+                os.rename(partial_dir, session_dir)
+        except BaseException:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            raise
+        shutil.rmtree(local_dir, ignore_errors=True)
+        logger.debug('committed %s', session_dir)
+
+    def _recover(self, parent_dir, name):
+        """Clean up after a commit of the same session that was interrupted."""
+        for entry in os.scandir(parent_dir):
+            if entry.name.startswith(f'.{name}.partial-'):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.startswith(f'.{name}.old-'):
+                old_session_dir = os.path.join(entry.path, name)
+                session_dir = os.path.join(parent_dir, name)
+                if os.path.isdir(old_session_dir) and not os.path.exists(session_dir):
+                    logger.warning('restoring %s after an interrupted commit', name)
+                    os.rename(old_session_dir, session_dir)
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def cleanup(self):
+        """Remove the staging area."""
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
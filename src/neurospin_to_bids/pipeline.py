@@ -0,0 +1,124 @@
+"""Streaming pipeline of processing stages.
+
+The items (e.g. DICOM series) flow through a sequence of stages, each of them
+running in its own thread: an item enters a stage as soon as the previous
+stage is done with it, so that the I/O-bound and CPU-bound stages overlap
+instead of running one after the other for the whole cohort. Consecutive
+stages are connected by bounded queues, so that a fast stage cannot run
+arbitrarily far ahead of a slow one.
+"""
+
+import logging
+import queue
+import threading
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_QUEUE_SIZE = 8
+"""Default maximum number of items waiting between two stages."""
+
+_POLL_INTERVAL = 0.1
+_DONE = object()
+
+
+class Stage:
+    """A stage of a pipeline.
+
+    name (str): name of the stage, used in log messages.
+    func (callable): function applied to each item, which returns the
+        processed item.
+    workers (int): number of items that func processes concurrently. When it
+        is greater than 1, the items may leave the stage in a different order.
+    transform (callable): instead of func, function taking an iterator over
+        the input items and returning an iterator over the output items,
+        for stages that manage their own concurrency (e.g.
+        convert.ConversionBackend.convert).
+    """
+
+    def __init__(self, name, func=None, workers=1, transform=None):
+        if (func is None) == (transform is None):
+            raise ValueError('exactly one of func and transform must be given')
+        if workers < 1:
+            raise ValueError('the number of workers must be at least 1')
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.transform = transform
+
+    def process(self, items):
+        """Return an iterator over the processed items."""
+        if self.transform is not None:
+            return self.transform(items)
+        if self.workers == 1:
+            return map(self.func, items)
+        return utils.imap_unordered_bounded(self.func, items, self.workers)
+
+
+def run_pipeline(items, stages, queue_size=DEFAULT_QUEUE_SIZE):
+    """Pass an iterable of items through a sequence of stages.
+
+    The items output by the last stage are yielded as soon as they are
+    available. If a stage raises an exception, the whole pipeline is stopped
+    and the exception is re-raised here, once the items being processed by
+    the other stages are done.
+    """
+    stop = threading.Event()
+    errors = []
+
+    def receive(input_queue):
+        while not stop.is_set():
+            try:
+                item = input_queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def send(output_queue, item):
+        while not stop.is_set():
+            try:
+                output_queue.put(item, timeout=_POLL_INTERVAL)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def run_stage(stage, input_items, output_queue):
+        try:
+            for item in stage.process(input_items):
+                if not send(output_queue, item):
+                    break
+        except Exception as exc:  # noqa: BLE001 (re-raised by the consumer)
+            logger.debug('stopping the pipeline after an error in %s', stage.name)
+            errors.append(exc)
+            stop.set()
+        finally:
+            send(output_queue, _DONE)
+
+    threads = []
+    input_items = iter(items)
+    for stage in stages:
+        output_queue = queue.Queue(maxsize=queue_size)
+        threads.append(
+            threading.Thread(
+                target=run_stage,
+                args=(stage, input_items, output_queue),
+                name=f'pipeline-{stage.name}',
+                daemon=True,
+            )
+        )
+        input_items = receive(output_queue)
+    for thread in threads:
+        thread.start()
+    try:
+        yield from input_items
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
@@ -8,6 +8,7 @@
 import collections
 import glob
 import itertools
+import json
 import logging
 import os
 import re
@@ -28,11 +29,15 @@ ECHO_POSTFIX_RE = re.compile(r'^e([0-9]+)$')
 
 
 def rename_file_with_postfixes(filename, dry_run=False):
+    """Rename a file produced by dcm2niix, replacing postfixes with entities.
+
+    The new name of the file is returned, or None if the file was deleted.
+    """
     dirname = os.path.dirname(filename)
     basename = os.path.basename(filename)
     match = BIDS_PLUS_POSTFIXES_RE.match(basename)
     if not match:
-        return  # not a BIDS name with postfixes
+        return filename  # not a BIDS name with postfixes
     entities = collections.OrderedDict(
         bids.parse_bids_entities(match.group('entities'))
     )
@@ -46,7 +51,7 @@ def rename_file_with_postfixes(filename, dry_run=False):
                 echo_number = int(echo_postfix_match.group(1))
             except ValueError:
                 logger.error('invalid echo number %s', echo_postfix_match.group(1))
-                return  # abort
+                return filename  # abort
             if suffix in ('magnitude', 'magnitude1', 'magnitude2'):
                 suffix = f'magnitude{echo_number:d}'
                 continue
@@ -77,7 +82,7 @@ def rename_file_with_postfixes(filename, dry_run=False):
             logger.error(
                 'not fixing filename %s: unknown postfix %s', filename, postfix
             )
-            return
+            return filename
 
     if delete_file:
         logger.info(
@@ -93,6 +98,7 @@ def rename_file_with_postfixes(filename, dry_run=False):
             )
             if not dry_run:
                 os.unlink(filename_json)
+        return None
     else:
         new_basename = bids.compose_bids_name(entities, suffix, ext)
         logger.info(
@@ -114,6 +120,46 @@ def rename_file_with_postfixes(filename, dry_run=False):
             )
             if not dry_run:
                 os.rename(filename_json, os.path.join(dirname, new_basename_json))
+        return os.path.join(dirname, new_basename)
+
+
+def _split_extension(filename):
+    dirname, basename = os.path.split(filename)
+    stem, dot, ext = basename.partition('.')
+    return os.path.join(dirname, stem), dot + ext
+
+
+def rename_converted_files(filenames, dry_run=False):
+    """Fix the names of all the files produced by the conversion of a series.
+
+    rename_file_with_postfixes is called on each file except JSON sidecars,
+    which are renamed along with their data file. The list of the resulting
+    filenames is returned.
+    """
+    new_filenames = {}
+    for filename in filenames:
+        if filename.endswith('.json'):
+            continue
+        new_filename = rename_file_with_postfixes(filename, dry_run=dry_run)
+        new_filenames[filename] = new_filename
+        stem, _ = _split_extension(filename)
+        if new_filename is None:
+            new_filenames[stem + '.json'] = None
+        else:
+            new_stem, _ = _split_extension(new_filename)
+            new_filenames[stem + '.json'] = new_stem + '.json'
+    renamed = (new_filenames.get(filename, filename) for filename in filenames)
+    return [filename for filename in renamed if filename is not None]
+
+
+def update_json_sidecar(filename_json, descriptors):
+    """Add or replace key-value pairs (e.g. TaskName) in a JSON sidecar."""
+    with open(filename_json, 'r+') as json_file:
+        sidecar = json.load(json_file)
+        sidecar.update(descriptors)
+        json_file.seek(0)
+        json.dump(sidecar, json_file)
+        json_file.truncate()
 
 
 def rename_files_recursively(bids_root_dir, dry_run=False):
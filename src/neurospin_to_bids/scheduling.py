@@ -0,0 +1,267 @@
+"""Scheduling of the conversion of DICOM series.
+
+When series are converted concurrently, the total wall time depends on their
+order: a long series (e.g. a multiband fMRI run with thousands of volumes, or
+a diffusion series) that starts last keeps one worker busy while the others
+are idle. The series are therefore dispatched longest first, according to a
+simple cost model based on the number and total size of their DICOM files.
+The estimates are written to a report along with the actual durations, so
+that the model can be checked against real imports.
+
+Large series can also make dcm2niix use several GB of memory. Conversions
+can be admitted against a memory budget (see ResourceBudget), using an
+estimate of their peak memory usage, so that concurrent conversions do not
+exhaust the memory of a shared node.
+
+Finally, the size of the outputs is estimated before the import, and
+compared with the free space of the volumes where they will be written (see
+check_disk_space), and each conversion is only started if its outputs still
+fit (see DiskSpaceAdmission), instead of failing partway through the cohort
+and leaving truncated files behind.
+"""
+
+import collections
+import contextlib
+import csv
+import errno
+import logging
+import os
+import shutil
+import threading
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+SECONDS_PER_SERIES = 0.5
+"""Estimated fixed cost of the conversion of a series (process startup)."""
+
+SECONDS_PER_FILE = 0.002
+"""Estimated cost of opening and parsing the header of a DICOM file."""
+
+SECONDS_PER_BYTE = 1 / 100e6
+"""Estimated cost of reading and converting one byte of DICOM data."""
+
+
+MEMORY_BASE = 64 * 2**20
+"""Estimated memory used by dcm2niix regardless of the series."""
+
+MEMORY_PER_FILE = 64 * 2**10
+"""Estimated memory used by dcm2niix for the header of each DICOM file."""
+
+MEMORY_PER_BYTE = 2
+"""Estimated memory used per byte of DICOM data (input and output images)."""
+
+
+OUTPUT_RATIO = 1.0
+"""Estimated size of uncompressed NIfTI outputs relative to the DICOM files."""
+
+OUTPUT_RATIO_GZ = 0.6
+"""Estimated size of compressed NIfTI outputs relative to the DICOM files."""
+
+OUTPUT_BASE = 64 * 2**10
+"""Estimated size of the JSON sidecar and other small files of a series."""
+
+
+def series_stats(series_stat):
+    """Compute the (file_count, size) of a DICOM directory.
+
+    series_stat is the list of (name, size, mtime_ns) tuples returned by
+    acquisition_db.scan_series_dir.
+    """
+    return len(series_stat), sum(file_size for _, file_size, _ in series_stat)
+
+
+def estimate_conversion_time(file_to_convert):
+    """Estimate the duration of the conversion of a series, in seconds.
+
+    The series must have the file_count and size keys (see series_stats),
+    otherwise only the fixed cost is counted.
+    """
+    return (
+        SECONDS_PER_SERIES
+        + SECONDS_PER_FILE * file_to_convert.get('file_count', 0)
+        + SECONDS_PER_BYTE * file_to_convert.get('size', 0)
+    )
+
+
+def estimate_peak_memory(file_to_convert):
+    """Estimate the peak memory used by the conversion of a series, in bytes.
+
+    dcm2niix holds the whole image in memory, along with the headers of all
+    DICOM files, and a copy of the image when it is reoriented or compressed.
+    """
+    return (
+        MEMORY_BASE
+        + MEMORY_PER_FILE * file_to_convert.get('file_count', 0)
+        + MEMORY_PER_BYTE * file_to_convert.get('size', 0)
+    )
+
+
+def estimate_output_size(file_to_convert, compressed=True):
+    """Estimate the size of the outputs of the conversion of a series."""
+    ratio = OUTPUT_RATIO_GZ if compressed else OUTPUT_RATIO
+    return OUTPUT_BASE + int(ratio * file_to_convert.get('size', 0))
+
+
+def longest_first(files_to_convert):
+    """Sort series by decreasing estimated conversion time.
+
+    The sort is stable, so series with the same estimate keep their order.
+    """
+    return sorted(files_to_convert, key=estimate_conversion_time, reverse=True)
+
+
+def write_schedule_report(report_filename, results):
+    """Write the estimated and actual durations of conversions to a TSV file.
+
+    results is an iterable of convert.ConversionResult. The duration is n/a
+    for the series that were not actually converted (e.g. cache hits).
+    """
+    with open(report_filename, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(
+            (
+                'in_dir',
+                'file_count',
+                'size',
+                'estimated_duration',
+                'duration',
+                'returncode',
+            )
+        )
+        for result in results:
+            writer.writerow(
+                (
+                    result.series['in_dir'],
+                    result.series.get('file_count', 'n/a'),
+                    result.series.get('size', 'n/a'),
+                    f'{estimate_conversion_time(result.series):.2f}',
+                    'n/a' if result.duration is None else f'{result.duration:.2f}',
+                    result.returncode,
+                )
+            )
+
+
+class ResourceBudget:
+    """Amount of a resource (e.g. memory) shared by concurrent jobs.
+
+    capacity (int): total amount of the resource, or None for no limit.
+    name (str): name of the resource, used in log messages.
+
+    A job is admitted as soon as its reservation fits in the remaining
+    capacity, so that small jobs can use the capacity left over while a large
+    job is waiting. A job larger than the capacity is admitted once no other
+    job is running.
+    """
+
+    def __init__(self, capacity, name='memory'):
+        self.capacity = capacity
+        self.name = name
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, amount):
+        return (
+            self.capacity is None
+            or self.used == 0
+            or self.used + amount <= self.capacity
+        )
+
+    @contextlib.contextmanager
+    def reserve(self, amount):
+        """Context manager reserving an amount of the resource for a job."""
+        with self._condition:
+            if not self._fits(amount):
+                logger.debug(
+                    'waiting for %s of %s (%s in use)',
+                    utils.format_size(amount),
+                    self.name,
+                    utils.format_size(self.used),
+                )
+                self._condition.wait_for(lambda: self._fits(amount))
+            self.used += amount
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.used -= amount
+                self._condition.notify_all()
+
+
+def _existing_parent(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def check_disk_space(requirements):
+    """Check that the free space of volumes meets the estimated requirements.
+
+    requirements is an iterable of (path, size) pairs, where path does not
+    need to exist yet. Requirements on paths that are on the same filesystem
+    are added up. A list of messages describing the shortfalls is returned,
+    which is empty if everything fits.
+    """
+    needed = collections.defaultdict(int)
+    paths = collections.defaultdict(list)
+    for path, size in requirements:
+        existing_path = _existing_parent(path)
+        device = os.stat(existing_path).st_dev
+        needed[device] += size
+        paths[device].append(path)
+    shortfalls = []
+    for device, size in needed.items():
+        free = shutil.disk_usage(_existing_parent(paths[device][0])).free
+        if size > free:
+            shortfalls.append(
+                f'not enough disk space for {", ".join(paths[device])}: '
+                f'{utils.format_size(size)} needed (estimated), '
+                f'{utils.format_size(free)} available'
+            )
+    return shortfalls
+
+
+class DiskSpaceAdmission:
+    """Admission of conversions according to the free space of their volume.
+
+    The outputs being written by running conversions are accounted for by
+    reservations, which are released when the conversions end (their files
+    then show up in the free space of the volume).
+
+    margin (int): space left free on each volume, in bytes.
+    """
+
+    def __init__(self, margin=0):
+        self.margin = margin
+        self._reserved = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def reserve(self, path, size):
+        """Context manager reserving space for writing size bytes in path.
+
+        OSError is raised with errno ENOSPC if the space is not available.
+        """
+        existing_path = _existing_parent(path)
+        device = os.stat(existing_path).st_dev
+        with self._lock:
+            free = shutil.disk_usage(existing_path).free - self._reserved[device]
+            if size > free - self.margin:
+                raise OSError(
+                    errno.ENOSPC,
+                    f'{utils.format_size(size)} needed (estimated), '
+                    f'{utils.format_size(max(free, 0))} available',
+                    path,
+                )
+            self._reserved[device] += size
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._reserved[device] -= size
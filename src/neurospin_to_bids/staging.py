@@ -0,0 +1,172 @@
+"""Staging of DICOM series from the acquisition archive to local scratch.
+
+Reading a DICOM series file by file over NFS can take longer than its
+conversion. The SeriesStager copies the next few series to a local scratch
+directory using parallel bulk reads, while the current series are being
+converted, and removes each copy as soon as its conversion is done.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from . import acquisition_db, utils
+
+logger = logging.getLogger(__name__)
+
+
+class SeriesStager:
+    """Prefetch DICOM series to a scratch directory ahead of conversion.
+
+    scratch_dir (str): directory where the copies are made.
+    depth (int): number of series that are prefetched ahead of the series
+        being converted.
+    quota (int): maximum total size of the staged copies in bytes, or None
+        for no limit. A series that is larger than the quota is still staged
+        once all other copies have been released.
+    copy_jobs (int): number of files that are copied concurrently.
+    on_staged (callable): function called with each series once its copy is
+        complete.
+    """
+
+    def __init__(self, scratch_dir, depth=2, quota=None, copy_jobs=8, on_staged=None):
+        if depth < 1:
+            raise ValueError('the prefetch depth must be at least 1')
+        self.scratch_dir = scratch_dir
+        self.depth = depth
+        self.quota = quota
+        self.copy_jobs = copy_jobs
+        self.on_staged = on_staged
+        self._condition = threading.Condition()
+        self._used = 0
+        self._staged_sizes = {}
+        # Reservations of quota are granted in order, so that a series cannot
+        # be starved by the series that are prefetched after it.
+        self._next_ticket = 0
+        self._serving_ticket = 0
+        os.makedirs(scratch_dir, exist_ok=True)
+
+    def stage(self, files_to_convert):
+        """Stage an iterable of DICOM series, in order.
+
+        (file_to_convert, staged_dir) pairs are yielded, where staged_dir is
+        the path to the local copy of file_to_convert['in_dir'], or None if
+        the series could not be staged and must be read from its original
+        location. Each staged_dir must be passed to release() once it is no
+        longer needed.
+        """
+        iterator = iter(files_to_convert)
+        pending = collections.deque()
+        with (
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.depth
+            ) as series_pool,
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.copy_jobs
+            ) as file_pool,
+        ):
+
+            def fill():
+                while len(pending) < self.depth:
+                    file_to_convert = next(iterator, None)
+                    if file_to_convert is None:
+                        return
+                    with self._condition:
+                        ticket = self._next_ticket
+                        self._next_ticket += 1
+                    pending.append(
+                        (
+                            file_to_convert,
+                            series_pool.submit(
+                                self._stage_series, file_to_convert, ticket, file_pool
+                            ),
+                        )
+                    )
+
+            try:
+                fill()
+                while pending:
+                    file_to_convert, future = pending.popleft()
+                    fill()
+                    yield file_to_convert, future.result()
+            finally:
+                # Clean up the prefetched copies if the consumer stops early
+                for _, future in pending:
+                    staged_dir = future.result()
+                    if staged_dir is not None:
+                        self.release(staged_dir)
+
+    def _reserve(self, ticket, size):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: (
+                    self._serving_ticket == ticket
+                    and (
+                        self.quota is None
+                        or self._used == 0
+                        or self._used + size <= self.quota
+                    )
+                )
+            )
+            self._used += size
+            self._serving_ticket += 1
+            self._condition.notify_all()
+
+    def _unreserve(self, size):
+        with self._condition:
+            self._used -= size
+            self._condition.notify_all()
+
+    def _stage_series(self, file_to_convert, ticket, file_pool):
+        in_dir = file_to_convert['in_dir']
+        try:
+            series_stat = acquisition_db.scan_series_dir(in_dir)
+        except OSError as exc:
+            logger.warning('cannot stage %s: %s', in_dir, exc)
+            series_stat = None
+        size = sum(file_size for _, file_size, _ in series_stat or ())
+        self._reserve(ticket, size)
+        if series_stat is None:
+            self._unreserve(size)
+            return None
+        staged_dir = os.path.join(
+            tempfile.mkdtemp(prefix='dicom-', dir=self.scratch_dir),
+            os.path.basename(in_dir),
+        )
+        try:
+            os.mkdir(staged_dir)
+
+            def copy_file(name, file_size):
+                with acquisition_db.archive_reader(in_dir, file_size):
+                    shutil.copyfile(
+                        os.path.join(in_dir, name), os.path.join(staged_dir, name)
+                    )
+
+            for _ in file_pool.map(
+                copy_file,
+                [name for name, _, _ in series_stat],
+                [file_size for _, file_size, _ in series_stat],
+            ):
+                pass
+        except OSError as exc:
+            logger.warning('cannot stage %s: %s', in_dir, exc)
+            shutil.rmtree(os.path.dirname(staged_dir), ignore_errors=True)
+            self._unreserve(size)
+            return None
+        logger.debug('staged %s (%s)', in_dir, utils.format_size(size))
+        with self._condition:
+            self._staged_sizes[staged_dir] = size
+        if self.on_staged is not None:
+            self.on_staged(file_to_convert)
+        return staged_dir
+
+    def release(self, staged_dir):
+        """Remove a staged copy, freeing its share of the quota."""
+        shutil.rmtree(os.path.dirname(staged_dir), ignore_errors=True)
+        with self._condition:
+            size = self._staged_sizes.pop(staged_dir, 0)
+        self._unreserve(size)
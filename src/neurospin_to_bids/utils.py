@@ -1,5 +1,9 @@
 """Miscellaneous utility code."""
 
+import concurrent.futures
+import itertools
+import re
+
 
 class UserError(Exception):
     """Exception for obvious user errors that should be corrected.
@@ -25,6 +29,38 @@ class DataError(Exception):
     pass
 
 
+SIZE_RE = re.compile(r'^\s*([0-9]+(?:\.[0-9]*)?)\s*([kKMGTP]?)i?B?\s*$')
+SIZE_MULTIPLIERS = {
+    '': 1,
+    'k': 1024,
+    'K': 1024,
+    'M': 1024**2,
+    'G': 1024**3,
+    'T': 1024**4,
+    'P': 1024**5,
+}
+
+
+def parse_size(text):
+    """Parse a size in bytes, with an optional binary unit (e.g. 10G).
+
+    ValueError is raised if the text cannot be parsed.
+    """
+    match = SIZE_RE.match(text)
+    if not match:
+        raise ValueError(f'invalid size {text!r}, expected e.g. 500M or 20G')
+    return int(float(match.group(1)) * SIZE_MULTIPLIERS[match.group(2)])
+
+
+def format_size(size):
+    """Format a size in bytes for humans."""
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(size) < 1024 or unit == 'TiB':
+            break
+        size /= 1024
+    return f'{size:.1f} {unit}' if unit != 'B' else f'{size:.0f} B'
+
+
 PREFIX_LENGTH = 20
 LINE_LENGTH = 60
 
@@ -107,3 +143,31 @@ def yes_no(question: str, *, default=None, noninteractive=None) -> bool:
         if choice in valid:
             return valid[choice]
         print("Please respond with 'yes' or 'no' (or 'y' or 'n').\n")
+
+
+def imap_unordered_bounded(func, iterable, workers=1):
+    """Apply func to each item of iterable using a pool of threads.
+
+    Items are pulled lazily from iterable, so that no more than `workers`
+    calls are in flight at any time. The results are yielded in completion
+    order.
+    """
+    if workers < 1:
+        raise ValueError('the number of workers must be at least 1')
+    iterator = iter(iterable)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(func, item) for item in itertools.islice(iterator, workers)
+        }
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                item = next(iterator, _SENTINEL)
+                if item is not _SENTINEL:
+                    pending.add(executor.submit(func, item))
+                yield future.result()
+
+
+_SENTINEL = object()
@@ -0,0 +1,204 @@
+"""Conversion of new sessions as they appear in the acquisition archive.
+
+For studies that scan every day, the import would have to be run again by
+hand after each session. Instead, watch_archive polls the archive for the
+sessions of participants_to_import.tsv (or of participants_list.tsv, with the
+autolist rules), and imports each session as soon as its directory is
+stable, i.e. its files have not changed for a quiet period, so that a
+session is not converted while it is still being transferred.
+
+Each poll lists the session directories directly, bypassing the acquisition
+index, whose listings could hide new files (new session directories are
+still looked up through the index, if it is set, so they may only be found
+after its negative_ttl). Sessions of dates that are long past (see
+acquisition_index.IMMUTABLE_AFTER) are considered stable at once, and they
+are no longer polled once they have been imported.
+"""
+
+import datetime
+import logging
+import os
+import time
+
+from . import acquisition_db, acquisition_index, autolist, exp_info
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_POLL_INTERVAL = 60.0
+"""Default time between two polls of the archive, in seconds."""
+
+DEFAULT_QUIET_PERIOD = 300.0
+"""Default time without changes after which a session is stable, in seconds."""
+
+
+def session_snapshot(session_dir):
+    """Describe the contents of a session directory, for detecting changes.
+
+    A tuple of (name, contents) pairs is returned, where contents is the
+    list of files of a series directory (see acquisition_db.scan_series_dir),
+    or the (size, mtime_ns) of a file (e.g. a MEG run). None is returned if
+    the directory does not exist.
+    """
+    try:
+        with acquisition_db.archive_reader(session_dir), os.scandir(session_dir) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return None
+    snapshot = []
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                contents = tuple(acquisition_db.scan_series_dir(entry.path))
+            else:
+                stat_result = entry.stat()
+                contents = (stat_result.st_size, stat_result.st_mtime_ns)
+        except FileNotFoundError:
+            # Removed while listing the session, e.g. a temporary file
+            continue
+        snapshot.append((entry.name, contents))
+    return tuple(snapshot)
+
+
+def _is_immutable(subject_info):
+    return (
+        subject_info['acq_date']
+        <= datetime.date.today() - acquisition_index.IMMUTABLE_AFTER
+    )
+
+
+class SessionWatcher:
+    """Track the changes of session directories between polls.
+
+    quiet_period (float): time in seconds without changes after which a
+        session directory is stable.
+    """
+
+    def __init__(self, quiet_period=DEFAULT_QUIET_PERIOD):
+        self.quiet_period = quiet_period
+        # Last snapshot of each session directory, and when it last changed
+        self._snapshots = {}
+        # Snapshot of each session directory when it was last imported
+        self._imported = {}
+
+    def poll(self, session_dir, immutable=False):
+        """Check the state of a session directory.
+
+        'missing', 'changing' (changed during the quiet period), 'ready'
+        (stable, and not imported in its current state) or 'imported' is
+        returned. If immutable is true, the session is considered stable as
+        soon as it is seen.
+        """
+        snapshot = session_snapshot(session_dir)
+        if snapshot is None:
+            return 'missing'
+        now = time.monotonic()
+        previous = self._snapshots.get(session_dir)
+        if previous is None or previous[0] != snapshot:
+            changed_at = now - self.quiet_period if immutable else now
+            self._snapshots[session_dir] = (snapshot, changed_at)
+        else:
+            changed_at = previous[1]
+        if now - changed_at < self.quiet_period:
+            return 'changing'
+        if self._imported.get(session_dir) == snapshot:
+            return 'imported'
+        return 'ready'
+
+    def is_done(self, session_dir):
+        """Test if an immutable session directory has been imported."""
+        return session_dir in self._imported
+
+    def mark_imported(self, session_dir):
+        """Record that a session directory was imported in its current state."""
+        self._imported[session_dir] = self._snapshots[session_dir][0]
+
+
+def watch_archive(
+    exp_info_path,
+    import_subjects,
+    use_autolist=False,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+    quiet_period=DEFAULT_QUIET_PERIOD,
+    scan_workers=acquisition_db.DEFAULT_SCAN_WORKERS,
+    max_polls=None,
+):
+    """Import the sessions of a study as they appear in the archive.
+
+    import_subjects (callable): function importing a list of lines of
+        participants_to_import.tsv, returning a non-zero status on failure.
+    use_autolist (bool): read the sessions from participants_list.tsv and
+        apply the autolist rules to the stable sessions (see
+        autolist.autolist_subjects), instead of reading
+        participants_to_import.tsv.
+    poll_interval (float): time between two polls, in seconds.
+    quiet_period (float): time in seconds without changes after which a
+        session is imported.
+    max_polls (int): number of polls before returning [default: poll until
+        interrupted with Ctrl+C between two polls].
+
+    The lists of sessions are read again at each poll, so that lines can be
+    added while watching. Sessions whose import failed are imported again at
+    the next poll.
+    """
+    watcher = SessionWatcher(quiet_period)
+    polls = 0
+    while True:
+        if use_autolist:
+            list_filename = os.path.join(exp_info_path, 'participants_list.tsv')
+        else:
+            list_filename = exp_info.find_participants_to_import_tsv(exp_info_path)
+        subjects_info = list(exp_info.iterate_participants_list(list_filename))
+        # Listings are not kept from one poll to the next
+        resolver = acquisition_db.SessionResolver()
+        ready_subjects = []
+        ready_session_dirs = []
+        for subject_info in subjects_info:
+            location = subject_info['location']
+            date_format = '%y%m%d' if location.strip().lower() == 'meg' else '%Y%m%d'
+            immutable = _is_immutable(subject_info)
+            session_dirs = resolver.get_session_paths(
+                location,
+                subject_info['acq_date'].strftime(date_format),
+                subject_info['NIP'],
+            )
+            if immutable and session_dirs and all(map(watcher.is_done, session_dirs)):
+                continue
+            # Every session directory must be polled, to record its snapshot
+            states = [
+                watcher.poll(session_dir, immutable=immutable)
+                for session_dir in session_dirs
+            ]
+            if 'ready' in states and 'changing' not in states:
+                ready_subjects.append(subject_info)
+                ready_session_dirs.extend(
+                    session_dir
+                    for session_dir, state in zip(session_dirs, states, strict=True)
+                    if state != 'missing'
+                )
+        if ready_subjects:
+            logger.info('importing %d new or modified sessions', len(ready_subjects))
+            if use_autolist:
+                ready_subjects = autolist.autolist_subjects(
+                    exp_info_path,
+                    [dict(subject_info) for subject_info in ready_subjects],
+                    scan_workers=scan_workers,
+                )
+            status = import_subjects(ready_subjects)
+            if status:
+                logger.error(
+                    'the import failed, it will be attempted again at the next poll'
+                )
+            else:
+                # Sessions are not imported again until they change
+                for session_dir in ready_session_dirs:
+                    watcher.mark_imported(session_dir)
+        polls += 1
+        if max_polls is not None and polls >= max_polls:
+            return
+        logger.debug('waiting %g s for the next poll', poll_interval)
+        try:
+            time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logger.info('stopped watching the acquisition archive')
+            return
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+import neurospin_to_bids.acquisition_db
+from neurospin_to_bids.utils import DataError
+
+
+def test_session_resolver(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    date_dir = tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101'
+    ses_dir = date_dir / 'aa000001-0001_001'
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000012_mbepi-3mm-PA').mkdir()
+    (date_dir / 'bb000002-0001_001').mkdir()
+    (date_dir / 'bb000002-0001_002').mkdir()
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_ROOT_PATH', str(tmp_path / 'acq'))
+    listed = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(
+        os, 'scandir', lambda path: listed.append(path) or real_scandir(path)
+    )
+
+    resolver = acquisition_db.SessionResolver()
+    assert resolver.get_session_path('prisma', '20000101', 'aa000001') == str(ses_dir)
+    with pytest.raises(DataError):
+        resolver.get_session_path('prisma', '20000101', 'bb000002')
+    with pytest.raises(DataError):
+        resolver.get_session_path('prisma', '20000102', 'aa000001')
+    assert resolver.get_series_path(str(ses_dir), 3) == str(
+        ses_dir / '000003_mprage-sag-T1'
+    )
+    assert resolver.get_series_path(str(ses_dir), '12') == str(
+        ses_dir / '000012_mbepi-3mm-PA'
+    )
+    assert resolver.get_series_path(str(ses_dir), 4) is None
+    # Each directory is listed once
+    assert sorted(listed) == sorted(
+        [str(date_dir), str(date_dir.parent / '20000102'), str(ses_dir)]
+    )
+
+
+def test_session_resolver_prefetch(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    mri_dir = tmp_path / 'acq' / 'database' / 'Prisma_fit'
+    (mri_dir / '20000101' / 'aa000001-0001_001' / '000003_mprage-sag-T1').mkdir(
+        parents=True
+    )
+    (mri_dir / '20000102' / 'bb000002-0001_001' / '000004_mbepi').mkdir(parents=True)
+    (tmp_path / 'acq' / 'neuromag' / 'data' / 'cc000003' / '000103').mkdir(parents=True)
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_ROOT_PATH', str(tmp_path / 'acq'))
+    resolver = acquisition_db.SessionResolver()
+    resolver.prefetch(
+        [
+            ('prisma', '20000101', 'aa000001'),
+            ('prisma', '20000102', 'bb000002'),
+            ('prisma', '20000102', 'dd000004'),
+            ('meg', '000103', 'cc000003'),
+            ('invalid', '20000101', 'aa000001'),
+        ],
+        workers=3,
+    )
+
+    # Everything is answered from the listings
+    def fail(path):
+        raise AssertionError(f'unexpected listing of {path}')
+
+    monkeypatch.setattr(os, 'scandir', fail)
+    session_dir = resolver.get_session_path('prisma', '20000102', 'bb000002')
+    assert list(resolver.list_dicom_series(session_dir)) == [(4, 'mbepi')]
+    assert resolver.get_session_paths('prisma', '20000102', 'dd000004') == []
+    assert resolver.get_session_paths('meg', '000103', 'cc000003') == [
+        str(tmp_path / 'acq' / 'neuromag' / 'data' / 'cc000003' / '000103')
+    ]
@@ -0,0 +1,56 @@
+import os
+import shutil
+import time
+
+import neurospin_to_bids.acquisition_db
+import neurospin_to_bids.acquisition_index
+
+
+def test_acquisition_index(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    date_dir = tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101'
+    ses_dir = date_dir / 'aa000001-0001_001'
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    index = neurospin_to_bids.acquisition_index.AcquisitionIndex(
+        str(tmp_path / 'index.sqlite'), negative_ttl=60
+    )
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_ROOT_PATH', str(tmp_path / 'acq'))
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_INDEX', index)
+
+    assert acquisition_db.get_session_paths('prisma', '20000101', 'aa000001') == [
+        str(ses_dir)
+    ]
+    assert list(acquisition_db.list_dicom_series(str(ses_dir))) == [
+        (3, 'mprage-sag-T1')
+    ]
+    assert acquisition_db.get_session_paths('prisma', '20000101', 'bb000002') == []
+
+    # The listings of a past date are answered from the index
+    shutil.rmtree(ses_dir)
+    (date_dir / 'bb000002-0001_001').mkdir()
+    assert acquisition_db.get_session_paths('prisma', '20000101', 'aa000001') == [
+        str(ses_dir)
+    ]
+    assert list(acquisition_db.list_dicom_series(str(ses_dir))) == [
+        (3, 'mprage-sag-T1')
+    ]
+    # Negative lookups are checked again after negative_ttl
+    assert acquisition_db.get_session_paths('prisma', '20000101', 'bb000002') == []
+    real_time = time.time
+    monkeypatch.setattr(time, 'time', lambda: real_time() + 120)
+    assert acquisition_db.get_session_paths('prisma', '20000101', 'bb000002') == [
+        os.path.join(date_dir, 'bb000002-0001_001')
+    ]
+
+    # The MEG sessions of a past date are also answered from the index
+    meg_dir = tmp_path / 'acq' / 'neuromag' / 'data' / 'aa000001' / '000115'
+    meg_dir.mkdir(parents=True)
+    assert acquisition_db.get_session_paths('meg', '000115', 'aa000001') == [
+        str(meg_dir)
+    ]
+    meg_dir.rmdir()
+    monkeypatch.setattr(time, 'time', lambda: real_time() + 2 * index.ttl)
+    assert acquisition_db.get_session_paths('meg', '000115', 'aa000001') == [
+        str(meg_dir)
+    ]
+    index.close()
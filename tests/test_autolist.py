@@ -112,3 +112,99 @@ def test_autolist_mri(tmp_path, monkeypatch):
     #     '--root-path', str(tmp_path)
     # ])
     # assert ret == 0
+
+
+def test_autolist_prefetch_skips_meg_sessions(tmp_path, monkeypatch):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-0001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_list.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\n'
+        'sub-01\taa000001\t2000-01-01\tprisma\n'
+        'sub-01\taa000001\t2000-01-15\tmeg\n'
+    )
+    (exp_info_dir / 'autolist.yaml').write_text(
+        json.dumps(
+            {
+                'rules': [
+                    {
+                        'SeriesDescription': 'mprage-sag-T1',
+                        'data_type': 'anat',
+                        'bids_name': 'T1w',
+                    }
+                ]
+            }
+        )
+    )
+    monkeypatch.setattr(
+        neurospin_to_bids.acquisition_db, 'ACQUISITION_ROOT_PATH', str(tmp_path / 'acq')
+    )
+    lookups = []
+    resolver_class = neurospin_to_bids.acquisition_db.SessionResolver
+    real_prefetch = resolver_class.prefetch
+
+    def prefetch(self, session_lookups, **kwargs):
+        session_lookups = list(session_lookups)
+        lookups.extend(session_lookups)
+        return real_prefetch(self, session_lookups, **kwargs)
+
+    monkeypatch.setattr(resolver_class, 'prefetch', prefetch)
+    subjects_info = list(
+        neurospin_to_bids.exp_info.iterate_participants_list(
+            str(exp_info_dir / 'participants_list.tsv')
+        )
+    )
+    neurospin_to_bids.autolist.autolist_subjects(str(exp_info_dir), subjects_info)
+    assert lookups == [('prisma', '20000101', 'aa000001')]
+
+
+def test_rule_matcher():
+    patterns = [
+        'mprage-sag-T1',
+        'mprage*',
+        '*bold*',
+        'mbepi-?mm-PA',
+        'mbepi-[23]mm-*',
+        'b0-gre-[field',
+        '*',
+        'interleaved',
+        '',
+    ]
+    rules = [
+        {'SeriesDescription': pattern, 'data_type': 'anat', 'bids_name': 'T1w'}
+        for pattern in patterns
+    ]
+    rules.append(
+        {
+            'SeriesDescription': 'mprage*',
+            'header': {'ImageType': 'ORIGINAL\\*'},
+            'data_type': 'anat',
+            'bids_name': 'T1w',
+        }
+    )
+    matcher = neurospin_to_bids.autolist.RuleMatcher(rules)
+    header = {'ImageType': ['ORIGINAL', 'PRIMARY']}
+    for description in [
+        'mprage-sag-T1',
+        'mprage',
+        'mbepi-3mm-PA',
+        'mbepi-3mm-AP',
+        'task-bold',
+        'b0-gre-[field',
+        'interleaved',
+        '',
+        'MPRAGE',
+    ]:
+        for series_header in (None, header):
+            # Twice, to check the remembered matches
+            for _ in range(2):
+                assert matcher.matching_rules(description, series_header) == [
+                    rule_index
+                    for rule_index, rule in enumerate(rules)
+                    if neurospin_to_bids.autolist.rule_matches(
+                        rule, description, series_header
+                    )
+                ]
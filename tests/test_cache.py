@@ -0,0 +1,110 @@
+import os
+
+import neurospin_to_bids.cache
+
+
+def make_outputs(out_dir, filename, size):
+    files = []
+    for ext in ('.nii.gz', '.json'):
+        path = out_dir / (filename + ext)
+        path.write_bytes(b'x' * size)
+        files.append(str(path))
+    return files
+
+
+def test_conversion_cache_store_fetch(tmp_path):
+    cache = neurospin_to_bids.cache.ConversionCache(str(tmp_path / 'cache'))
+    out_dir = tmp_path / 'ds1'
+    out_dir.mkdir()
+    series = {'in_dir': 'dicom', 'out_dir': str(out_dir), 'filename': 'sub-01_T1w'}
+    files = make_outputs(out_dir, 'sub-01_T1w', 10)
+    assert cache.fetch('abcd', series) is None
+    cache.store('abcd', series, files)
+
+    other_dir = tmp_path / 'ds2'
+    other_dir.mkdir()
+    other_series = {
+        'in_dir': 'dicom',
+        'out_dir': str(other_dir),
+        'filename': 'sub-pilot_T1w',
+    }
+    fetched = cache.fetch('abcd', other_series)
+    assert sorted(fetched) == [
+        str(other_dir / 'sub-pilot_T1w.json'),
+        str(other_dir / 'sub-pilot_T1w.nii.gz'),
+    ]
+    # The image is hard-linked, the JSON sidecar is copied
+    assert os.path.samefile(files[0], other_dir / 'sub-pilot_T1w.nii.gz')
+    assert not os.path.samefile(files[1], other_dir / 'sub-pilot_T1w.json')
+
+
+def test_conversion_cache_lru_eviction(tmp_path):
+    cache = neurospin_to_bids.cache.ConversionCache(
+        str(tmp_path / 'cache'), max_size=50
+    )
+    out_dir = tmp_path / 'ds'
+    out_dir.mkdir()
+    for index, fingerprint in enumerate(('aa01', 'bb02', 'cc03')):
+        series = {'in_dir': 'dicom', 'out_dir': str(out_dir), 'filename': f's{index}'}
+        cache.store(fingerprint, series, make_outputs(out_dir, f's{index}', 10))
+        # Make sure that the access times are distinct
+        entry_dir = tmp_path / 'cache' / fingerprint[:2] / fingerprint
+        os.utime(entry_dir, (index, index))
+    # Each entry is 20 bytes, so only 2 entries fit
+    assert cache.total_size() == 40
+    assert not (tmp_path / 'cache' / 'aa' / 'aa01').exists()
+    assert (tmp_path / 'cache' / 'bb' / 'bb02').exists()
+    assert (tmp_path / 'cache' / 'cc' / 'cc03').exists()
+
+
+def test_conversion_cache_shared_eviction(tmp_path):
+    out_dir = tmp_path / 'ds'
+    out_dir.mkdir()
+    cache1 = neurospin_to_bids.cache.ConversionCache(
+        str(tmp_path / 'cache'), max_size=50
+    )
+    cache2 = neurospin_to_bids.cache.ConversionCache(
+        str(tmp_path / 'cache'), max_size=50
+    )
+    series = {'in_dir': 'dicom', 'out_dir': str(out_dir), 'filename': 's0'}
+    cache1.store('aa01', series, make_outputs(out_dir, 's0', 10))
+    os.utime(tmp_path / 'cache' / 'aa' / 'aa01', (0, 0))
+    # Entries stored by another user of the cache are taken into account
+    series = {'in_dir': 'dicom', 'out_dir': str(out_dir), 'filename': 's1'}
+    cache2.store('bb02', series, make_outputs(out_dir, 's1', 10))
+    os.utime(tmp_path / 'cache' / 'bb' / 'bb02', (1, 1))
+    series = {'in_dir': 'dicom', 'out_dir': str(out_dir), 'filename': 's2'}
+    cache1.store('cc03', series, make_outputs(out_dir, 's2', 10))
+    assert not (tmp_path / 'cache' / 'aa' / 'aa01').exists()
+    assert (tmp_path / 'cache' / 'bb' / 'bb02').exists()
+    assert (tmp_path / 'cache' / 'cc' / 'cc03').exists()
+    # An entry evicted by another user is a cache miss
+    series = {'in_dir': 'dicom', 'out_dir': str(out_dir), 'filename': 's3'}
+    assert cache2.fetch('aa01', series) is None
+
+
+def test_conversion_cache_failed_fetch(tmp_path, monkeypatch):
+    cache = neurospin_to_bids.cache.ConversionCache(str(tmp_path / 'cache'))
+    out_dir = tmp_path / 'ds1'
+    out_dir.mkdir()
+    series = {'in_dir': 'dicom', 'out_dir': str(out_dir), 'filename': 'sub-01_T1w'}
+    cache.store('abcd', series, make_outputs(out_dir, 'sub-01_T1w', 10))
+
+    real_link_or_copy = neurospin_to_bids.cache._link_or_copy
+
+    def failing_link_or_copy(src, dst, link=True):
+        if dst.endswith('.nii.gz'):
+            raise OSError('disk full')
+        real_link_or_copy(src, dst, link)
+
+    monkeypatch.setattr(neurospin_to_bids.cache, '_link_or_copy', failing_link_or_copy)
+    other_dir = tmp_path / 'ds2'
+    other_dir.mkdir()
+    other_series = {
+        'in_dir': 'dicom',
+        'out_dir': str(other_dir),
+        'filename': 'sub-pilot_T1w',
+    }
+    assert cache.fetch('abcd', other_series) is None
+    # No partial outputs are left behind
+    assert os.listdir(other_dir) == []
@@ -0,0 +1,52 @@
+import datetime
+import shutil
+
+import neurospin_to_bids.acquisition_db
+import neurospin_to_bids.catalog
+
+
+def test_catalog(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    mri_dir = tmp_path / 'acq' / 'database' / 'Prisma_fit'
+    ses_dir = mri_dir / '20000101' / 'aa000001-0001_001'
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000003_mprage-sag-T1' / '1.dcm').write_bytes(b'x' * 10)
+    (ses_dir / '000003_mprage-sag-T1' / '2.dcm').write_bytes(b'x' * 20)
+    (ses_dir / '000004_mbepi-3mm-PA').mkdir()
+    (mri_dir / '20000101' / 'bb000002-0001_001' / '000003_t1').mkdir(parents=True)
+    (mri_dir / '20000201' / 'aa000001-0001_001' / '000003_t1').mkdir(parents=True)
+    meg_dir = tmp_path / 'acq' / 'neuromag' / 'data' / 'aa000001' / '000101'
+    meg_dir.mkdir(parents=True)
+    (meg_dir / 'run1_raw.fif').write_bytes(b'x' * 5)
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_ROOT_PATH', str(tmp_path / 'acq'))
+
+    catalog_filename = str(tmp_path / 'catalog.tsv.gz')
+    assert (
+        neurospin_to_bids.catalog.export_catalog(
+            catalog_filename,
+            scanners=['prisma', 'meg'],
+            end_date=datetime.date(2000, 1, 31),
+            nips=['aa000001'],
+            workers=2,
+        )
+        == 3
+    )
+
+    # The catalog answers the lookups without the archive
+    shutil.rmtree(tmp_path / 'acq')
+    catalog = neurospin_to_bids.catalog.Catalog(catalog_filename)
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_INDEX', catalog)
+    assert acquisition_db.get_session_paths('prisma', '20000101', 'aa000001') == [
+        str(ses_dir)
+    ]
+    assert acquisition_db.get_session_paths('prisma', '20000101', 'bb000002') == []
+    assert acquisition_db.get_session_paths('prisma', '20000201', 'aa000001') == []
+    assert acquisition_db.get_session_paths('meg', '000101', 'aa000001') == [
+        str(meg_dir)
+    ]
+    assert sorted(acquisition_db.list_dicom_series(str(ses_dir))) == [
+        (3, 'mprage-sag-T1'),
+        (4, 'mbepi-3mm-PA'),
+    ]
+    assert catalog.series_stats(str(ses_dir / '000003_mprage-sag-T1')) == (2, 30)
+    assert catalog.series_stats(str(meg_dir / 'run1_raw.fif')) == (1, 5)
@@ -0,0 +1,27 @@
+import gzip
+import os
+
+import neurospin_to_bids.compress
+
+
+def test_gzip_outputs_reproducible(tmp_path, monkeypatch):
+    monkeypatch.setattr(neurospin_to_bids.compress, 'find_pigz', lambda: None)
+    checksums = []
+    for name in ('run1', 'run2'):
+        out_dir = tmp_path / name
+        out_dir.mkdir()
+        (out_dir / 'sub-01_bold.nii').write_bytes(bytes(range(256)) * 1000)
+        (out_dir / 'sub-01_bold.json').write_text('{}')
+        files = neurospin_to_bids.compress.gzip_outputs(
+            [str(out_dir / 'sub-01_bold.nii'), str(out_dir / 'sub-01_bold.json')]
+        )
+        assert files == [
+            str(out_dir / 'sub-01_bold.nii.gz'),
+            str(out_dir / 'sub-01_bold.json'),
+        ]
+        assert sorted(os.listdir(out_dir)) == ['sub-01_bold.json', 'sub-01_bold.nii.gz']
+        with gzip.open(files[0]) as f:
+            assert f.read() == bytes(range(256)) * 1000
+        checksums.append((out_dir / 'sub-01_bold.nii.gz').read_bytes())
+    # No file name or timestamp in the gzip header
+    assert checksums[0] == checksums[1]
@@ -0,0 +1,114 @@
+import os
+import stat
+import sys
+
+import neurospin_to_bids.convert
+
+FAKE_DCM2NIIX = f"""#! {sys.executable}
+import os
+import sys
+
+args = sys.argv[1:]
+filename = args[args.index('-f') + 1]
+out_dir = args[args.index('-o') + 1]
+if 'fail' in args[-1]:
+    sys.exit(1)
+for postfix in ('_e1', '_e2'):
+    for ext in ('.nii.gz', '.json'):
+        with open(os.path.join(out_dir, filename + postfix + ext), 'w'):
+            pass
+"""
+
+
+def install_fake_dcm2niix(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    exe = bin_dir / 'dcm2niix'
+    exe.write_text(FAKE_DCM2NIIX)
+    exe.chmod(exe.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+
+def test_dcm2niix_backend(tmp_path, monkeypatch):
+    install_fake_dcm2niix(tmp_path, monkeypatch)
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    files_to_convert = [
+        {
+            'in_dir': str(tmp_path / f'00000{i}_series'),
+            'out_dir': str(out_dir),
+            'filename': f'sub-01_run-{i}_bold',
+        }
+        for i in range(1, 5)
+    ] + [
+        {
+            'in_dir': str(tmp_path / '000005_fail'),
+            'out_dir': str(out_dir),
+            'filename': 'sub-01_T1w',
+        }
+    ]
+    backend = neurospin_to_bids.convert.get_backend('dcm2niix', {'isGz': True}, jobs=3)
+    assert isinstance(backend, neurospin_to_bids.convert.Dcm2niixBackend)
+    results = list(backend.convert(files_to_convert))
+    assert len(results) == 5
+    for result in results:
+        if result.series['filename'] == 'sub-01_T1w':
+            assert result.returncode != 0
+            assert result.files == []
+            continue
+        assert result.returncode == 0
+        stem = str(out_dir / result.series['filename'])
+        assert sorted(result.files) == [
+            stem + '_e1.json',
+            stem + '_e1.nii.gz',
+            stem + '_e2.json',
+            stem + '_e2.nii.gz',
+        ]
+    # No temporary directory is left behind
+    assert not [name for name in os.listdir(out_dir) if name.startswith('.')]
+
+
+def test_dcm2niibatch_backend(tmp_path, monkeypatch):
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    # Outputs of an earlier run, and of a series with a longer name
+    old_file = out_dir / 'sub-01_run-1_bold.nii.gz'
+    old_file.write_text('')
+    os.utime(old_file, (0, 0))
+    (out_dir / 'sub-01_run-1_boldref.nii.gz').write_text('')
+    files_to_convert = [
+        {
+            'in_dir': str(tmp_path / f'00000{i}_series'),
+            'out_dir': str(out_dir),
+            'filename': f'sub-01_run-{i}_bold',
+        }
+        for i in (1, 2)
+    ]
+    returncodes = [0]
+
+    def call(cmd):
+        # Only the second series is converted
+        for ext in ('.nii.gz', '.json'):
+            (out_dir / ('sub-01_run-2_bold' + ext)).write_text('')
+        return returncodes.pop()
+
+    monkeypatch.setattr(neurospin_to_bids.convert.subprocess, 'call', call)
+    backend = neurospin_to_bids.convert.get_backend(
+        'dcm2niibatch', {'isGz': True}, batch_file=str(tmp_path / 'batch.yaml')
+    )
+    results = {
+        result.series['filename']: result
+        for result in backend.convert(files_to_convert)
+    }
+    assert results['sub-01_run-1_bold'].returncode != 0
+    assert results['sub-01_run-1_bold'].files == []
+    assert results['sub-01_run-2_bold'].returncode == 0
+    assert sorted(results['sub-01_run-2_bold'].files) == [
+        str(out_dir / 'sub-01_run-2_bold.json'),
+        str(out_dir / 'sub-01_run-2_bold.nii.gz'),
+    ]
+
+    # The exit status of dcm2niibatch is reported for all the series
+    returncodes.append(2)
+    results = list(backend.convert(files_to_convert))
+    assert [result.returncode for result in results] == [2, 2]
@@ -0,0 +1,206 @@
+import concurrent.futures
+
+import pydicom
+import pydicom.dataset
+import pydicom.uid
+
+import neurospin_to_bids.acquisition_db
+import neurospin_to_bids.autolist
+import neurospin_to_bids.dicom_headers
+
+
+def write_dicom(filename, series_number, image_type, **fields):
+    file_meta = pydicom.dataset.FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = pydicom.uid.MRImageStorage
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    dataset = pydicom.dataset.Dataset()
+    dataset.file_meta = file_meta
+    dataset.Modality = 'MR'
+    dataset.SeriesNumber = series_number
+    dataset.ImageType = image_type
+    dataset.RepetitionTime = '2300.0'
+    for field, value in fields.items():
+        setattr(dataset, field, value)
+    dataset.save_as(filename, enforce_file_format=True)
+
+
+def test_header_index(tmp_path, monkeypatch):
+    dicom_headers = neurospin_to_bids.dicom_headers
+    ses_dir = tmp_path / 'aa000001-0001_001'
+    (ses_dir / '000003_mprage').mkdir(parents=True)
+    (ses_dir / '000003_mprage' / '0.txt').write_text('not DICOM')
+    write_dicom(ses_dir / '000003_mprage' / '1.dcm', 3, ['ORIGINAL', 'PRIMARY'])
+    (ses_dir / '000004_mprage').mkdir()
+    write_dicom(ses_dir / '000004_mprage' / '1.dcm', 4, ['DERIVED', 'SECONDARY'])
+
+    header_index = dicom_headers.HeaderIndex(str(tmp_path / 'index.json'))
+    monkeypatch.setattr(neurospin_to_bids.acquisition_db, 'HEADER_INDEX', header_index)
+    headers = neurospin_to_bids.acquisition_db.get_series_headers(
+        str(ses_dir), workers=2
+    )
+    assert headers[3] == {
+        'Modality': 'MR',
+        'SeriesNumber': 3,
+        'ImageType': ['ORIGINAL', 'PRIMARY'],
+        'RepetitionTime': 2300.0,
+    }
+    assert headers[4]['ImageType'] == ['DERIVED', 'SECONDARY']
+    header_index.save()
+
+    # Headers are read again only for the series that changed
+    read = []
+    real_read_series_header = dicom_headers.read_series_header
+    monkeypatch.setattr(
+        dicom_headers,
+        'read_series_header',
+        lambda series_dir, series_stat=None: (
+            read.append(series_dir) or real_read_series_header(series_dir, series_stat)
+        ),
+    )
+    write_dicom(ses_dir / '000004_mprage' / '2.dcm', 4, ['DERIVED', 'SECONDARY'])
+    header_index = dicom_headers.HeaderIndex(str(tmp_path / 'index.json'))
+    monkeypatch.setattr(neurospin_to_bids.acquisition_db, 'HEADER_INDEX', header_index)
+    assert (
+        neurospin_to_bids.acquisition_db.get_series_headers(str(ses_dir), workers=1)
+        == headers
+    )
+    assert read == [str(ses_dir / '000004_mprage')]
+
+    # Autolist rules can match header fields
+    to_import = list(
+        neurospin_to_bids.autolist.autolist_dicom_session(
+            str(ses_dir),
+            {
+                'rules': [
+                    {
+                        'SeriesDescription': 'mprage',
+                        'header': {'ImageType': 'ORIGINAL\\*'},
+                        'data_type': 'anat',
+                        'bids_name': 'T1w',
+                    }
+                ]
+            },
+        )
+    )
+    assert to_import == [(3, 'anat', 'T1w')]
+
+
+def test_header_index_reuses_series_stats_and_pool(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    series_dirs = []
+    for series_number in (3, 4):
+        series_dir = tmp_path / f'00000{series_number}_mprage'
+        series_dir.mkdir()
+        write_dicom(series_dir / '1.dcm', series_number, ['ORIGINAL', 'PRIMARY'])
+        series_dirs.append(str(series_dir))
+    series_stats = {
+        series_dir: acquisition_db.scan_series_dir(series_dir)
+        for series_dir in series_dirs
+    }
+    scanned = []
+    real_scan_series_dir = acquisition_db.scan_series_dir
+    monkeypatch.setattr(
+        acquisition_db,
+        'scan_series_dir',
+        lambda series_dir: (
+            scanned.append(series_dir) or real_scan_series_dir(series_dir)
+        ),
+    )
+
+    pools = []
+
+    class CountingExecutor(concurrent.futures.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            pools.append(self)
+
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', CountingExecutor)
+
+    header_index = neurospin_to_bids.dicom_headers.HeaderIndex()
+    try:
+        headers = header_index.get_headers(
+            series_dirs, workers=2, series_stats=series_stats
+        )
+        assert [headers[series_dir]['SeriesNumber'] for series_dir in series_dirs] == [
+            3,
+            4,
+        ]
+        # The series are not listed again in this process
+        assert scanned == []
+
+        # The process pool is reused by the next call
+        new_series_dirs = []
+        for series_number in (5, 6):
+            series_dir = tmp_path / f'00000{series_number}_mprage'
+            series_dir.mkdir()
+            write_dicom(series_dir / '1.dcm', series_number, ['ORIGINAL', 'PRIMARY'])
+            new_series_dirs.append(str(series_dir))
+        headers = header_index.get_headers(new_series_dirs, workers=2)
+        assert headers[new_series_dirs[1]]['SeriesNumber'] == 6
+        assert len(pools) == 1
+    finally:
+        header_index.close()
+
+
+def test_header_index_lists_series_once(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    series_dirs = []
+    for series_number in (3, 4):
+        series_dir = tmp_path / f'00000{series_number}_mprage'
+        series_dir.mkdir()
+        write_dicom(series_dir / '1.dcm', series_number, ['ORIGINAL', 'PRIMARY'])
+        series_dirs.append(str(series_dir))
+    scanned = []
+    real_scan_series_dir = acquisition_db.scan_series_dir
+    monkeypatch.setattr(
+        acquisition_db,
+        'scan_series_dir',
+        lambda series_dir: (
+            scanned.append(series_dir) or real_scan_series_dir(series_dir)
+        ),
+    )
+
+    header_index = neurospin_to_bids.dicom_headers.HeaderIndex()
+    headers = header_index.get_headers(series_dirs, workers=1)
+    assert headers[series_dirs[1]]['SeriesNumber'] == 4
+    # Each directory is listed once, to fingerprint it and read its header
+    assert sorted(scanned) == series_dirs
+
+
+def test_derived_series_reason():
+    derived_series_reason = neurospin_to_bids.dicom_headers.derived_series_reason
+    assert derived_series_reason(None) is None
+    assert derived_series_reason({'ImageType': ['ORIGINAL', 'PRIMARY', 'M']}) is None
+    assert (
+        derived_series_reason({'ImageType': ['DERIVED', 'SECONDARY', 'MPR']})
+        == 'ImageType is DERIVED\\SECONDARY\\MPR'
+    )
+    assert derived_series_reason({'SOPClassUID': '1.3.12.2.1107.5.9.1'}) == (
+        'SOP class is Siemens CSA Non-Image Storage'
+    )
+
+
+def test_expected_instance_count():
+    expected_instance_count = neurospin_to_bids.dicom_headers.expected_instance_count
+    assert expected_instance_count(None) is None
+    assert expected_instance_count({'ImageType': ['ORIGINAL', 'PRIMARY']}) is None
+    assert expected_instance_count({'ImagesInAcquisition': 176}) == 176
+    assert (
+        expected_instance_count(
+            {'ImagesInAcquisition': 40, 'NumberOfTemporalPositions': 10}
+        )
+        == 400
+    )
+    assert (
+        expected_instance_count(
+            {
+                'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'MOSAIC'],
+                'ImagesInAcquisition': 40,
+            }
+        )
+        is None
+    )
+    assert (
+        expected_instance_count({'ImagesInAcquisition': 1, 'NumberOfFrames': 9}) is None
+    )
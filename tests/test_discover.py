@@ -0,0 +1,72 @@
+import datetime
+
+import pytest
+
+import neurospin_to_bids.__main__
+import neurospin_to_bids.acquisition_db
+import neurospin_to_bids.discover
+from neurospin_to_bids.utils import UserError
+
+
+def test_discover_sessions(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    mri_dir = tmp_path / 'database' / 'Prisma_fit'
+    (mri_dir / '20000101' / 'aa000001-0001_001').mkdir(parents=True)
+    (mri_dir / '20000101' / 'bb000002-0001_001').mkdir(parents=True)
+    (mri_dir / '20000201' / 'aa000001-0001_001').mkdir(parents=True)
+    (mri_dir / '20000201' / 'aa000001-0001_002').mkdir(parents=True)
+    (mri_dir / '20000301' / 'aa000001-0001_001').mkdir(parents=True)
+    (mri_dir / 'not-a-date').mkdir()
+    meg_dir = tmp_path / 'neuromag' / 'data'
+    (meg_dir / 'aa000001' / '000115').mkdir(parents=True)
+    (meg_dir / 'cc000003' / '000115').mkdir(parents=True)
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_ROOT_PATH', str(tmp_path))
+
+    rows = neurospin_to_bids.discover.discover_sessions(
+        ['aa000001', 'bb000002'],
+        scanners=['prisma', 'meg'],
+        start_date=datetime.date(2000, 1, 1),
+        end_date=datetime.date(2000, 2, 1),
+        workers=2,
+    )
+    assert [(row['NIP'], row['acq_date'], row['location']) for row in rows] == [
+        ('aa000001', datetime.date(2000, 1, 1), 'prisma'),
+        ('aa000001', datetime.date(2000, 1, 15), 'meg'),
+        ('aa000001', datetime.date(2000, 2, 1), 'prisma'),
+        ('aa000001', datetime.date(2000, 2, 1), 'prisma'),
+        ('bb000002', datetime.date(2000, 1, 1), 'prisma'),
+    ]
+    assert rows[0]['session_dir'] == str(mri_dir / '20000101' / 'aa000001-0001_001')
+
+    filename = tmp_path / 'sessions.tsv'
+    neurospin_to_bids.discover.write_discovered_sessions(str(filename), rows)
+    lines = filename.read_text(encoding='utf-8').splitlines()
+    assert lines[0] == 'NIP\tacq_date\tlocation\tsession_dir'
+    assert lines[1].startswith('aa000001\t2000-01-01\tprisma\t')
+
+    with pytest.raises(UserError):
+        neurospin_to_bids.discover.discover_sessions(['not a NIP'])
+
+
+def test_discover_leaves_header_index_alone(tmp_path, caplog):
+    (tmp_path / 'acq' / 'database' / 'Prisma_fit').mkdir(parents=True)
+    header_index = tmp_path / 'report' / 'dicom_header_index.json'
+    header_index.parent.mkdir()
+    header_index.write_text('not JSON')
+    ret = neurospin_to_bids.__main__.main(
+        [
+            'neurospin_to_bids',
+            '--discover',
+            str(tmp_path / 'sessions.tsv'),
+            '--discover-nip',
+            'aa000001',
+            '--acquisition-dir',
+            str(tmp_path / 'acq'),
+            '--root-path',
+            str(tmp_path),
+        ]
+    )
+    assert not ret
+    # The index of DICOM headers is neither read nor written
+    assert 'header index' not in caplog.text
+    assert header_index.read_text() == 'not JSON'
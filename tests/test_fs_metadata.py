@@ -0,0 +1,37 @@
+import os
+
+import neurospin_to_bids.fs_metadata
+
+
+def test_metadata_cache(tmp_path):
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'file').write_text('x')
+    os.symlink(tmp_path / 'dir', tmp_path / 'link')
+    fs_cache = neurospin_to_bids.fs_metadata.MetadataCache()
+
+    assert fs_cache.isdir(str(tmp_path / 'dir'))
+    assert fs_cache.isfile(str(tmp_path / 'dir' / 'file'))
+    assert not fs_cache.isfile(str(tmp_path / 'dir' / 'missing'))
+    assert fs_cache.islink(str(tmp_path / 'link'))
+    assert not fs_cache.exists(str(tmp_path / 'missing' / 'file'))
+    assert fs_cache.samefile(str(tmp_path / 'link'), str(tmp_path / 'dir'))
+    assert fs_cache.samefile(str(tmp_path / 'link'), str(tmp_path / 'dir'))
+    # Each directory is listed once, each symlink is stat'ed once
+    assert fs_cache.misses == 5
+    assert fs_cache.hits == 6
+
+    # Created directories are known without listing them
+    new_dir = tmp_path / 'missing' / 'a' / 'b'
+    fs_cache.makedirs(str(new_dir))
+    assert new_dir.is_dir()
+    misses = fs_cache.misses
+    fs_cache.makedirs(str(new_dir))
+    assert fs_cache.isdir(str(tmp_path / 'missing' / 'a'))
+    assert not fs_cache.exists(str(new_dir / 'file'))
+    assert fs_cache.misses == misses
+
+    # Changes made outside of the cache are seen once forgotten
+    (tmp_path / 'dir' / 'file').unlink()
+    assert fs_cache.isfile(str(tmp_path / 'dir' / 'file'))
+    fs_cache.forget(str(tmp_path / 'dir' / 'file'))
+    assert not fs_cache.isfile(str(tmp_path / 'dir' / 'file'))
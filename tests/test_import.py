@@ -1,10 +1,16 @@
 import collections.abc
+import gzip
+import json
 import logging
 import shutil
 
+import nibabel
 import yaml
 
 import neurospin_to_bids.__main__
+import neurospin_to_bids.acquisition_db
+import neurospin_to_bids.compress
+import neurospin_to_bids.scheduling
 
 
 def test_simple_import_mri(tmp_path, caplog):
@@ -229,3 +235,503 @@ def test_simple_import_mri_invalid_sequence(tmp_path):
         ]
     )
     assert ret == 1
+
+
+def test_import_mri_skip_derived_series(tmp_path):
+    from test_dicom_headers import write_dicom
+
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    write_dicom(ses_dir / '000003_mprage-sag-T1' / '1.dcm', 3, ['ORIGINAL', 'PRIMARY'])
+    (ses_dir / '000004_mprage-sag-T1-MPR').mkdir()
+    write_dicom(
+        ses_dir / '000004_mprage-sag-T1-MPR' / '1.dcm', 4, ['DERIVED', 'SECONDARY']
+    )
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_to_import.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        'sub-01\taa000001\t2000-01-01\tprisma\t'
+        '[[3,"anat","T1w"],[4,"anat","acq-mpr_T1w"]]\n'
+    )
+
+    ret = neurospin_to_bids.__main__.main(
+        [
+            'neurospin_to_bids',
+            '--noninteractive',
+            '--dry-run',
+            '--derived-series',
+            'skip',
+            '--acquisition-dir',
+            str(tmp_path / 'acq'),
+            '--root-path',
+            str(tmp_path),
+        ]
+    )
+    assert ret == 0
+    with (exp_info_dir / 'batch_dcm2nii.yaml').open() as f:
+        batch = yaml.safe_load(f)
+    assert [entry['filename'] for entry in batch['Files']] == ['sub-01_T1w']
+
+
+def test_import_mri_defer_incomplete_series(tmp_path, caplog):
+    from test_dicom_headers import write_dicom
+
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    for series_dir, file_count in (('000003_mprage-sag-T1', 2), ('000004_bold', 1)):
+        (ses_dir / series_dir).mkdir(parents=True)
+        for i in range(file_count):
+            write_dicom(
+                ses_dir / series_dir / f'{i}.dcm',
+                int(series_dir[:6]),
+                ['ORIGINAL', 'PRIMARY'],
+                ImagesInAcquisition=2,
+            )
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_to_import.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        'sub-01\taa000001\t2000-01-01\tprisma\t'
+        '[[3,"anat","T1w"],[4,"func","task-rest_bold"]]\n'
+    )
+    argv = [
+        'neurospin_to_bids',
+        '--noninteractive',
+        '--conversion-backend',
+        'simulated',
+        '--check-completeness',
+        'defer',
+        '--acquisition-dir',
+        str(tmp_path / 'acq'),
+        '--root-path',
+        str(tmp_path),
+    ]
+    caplog.set_level(logging.INFO)
+
+    # The session is not completely imported
+    assert neurospin_to_bids.__main__.main(argv) == 1
+    assert 'converting 1 series' in caplog.text
+    sub_dir = tmp_path / 'rawdata' / 'sub-01'
+    assert not (sub_dir / 'downloaded').exists()
+
+    # The deferred series is converted once complete
+    write_dicom(
+        ses_dir / '000004_bold' / '1.dcm', 4, ['ORIGINAL'], ImagesInAcquisition=2
+    )
+    caplog.clear()
+    assert neurospin_to_bids.__main__.main(argv) == 0
+    assert 'converting 1 series' in caplog.text
+    assert (sub_dir / 'func' / 'sub-01_task-rest_bold.nii.gz').is_file()
+    assert (sub_dir / 'downloaded').is_file()
+
+
+def test_import_mri_simulated_backend(tmp_path, caplog):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000004_mbepi-3mm-PA').mkdir()
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    with (exp_info_dir / 'participants_to_import.tsv').open(mode='w') as f:
+        f.write(
+            'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+            'sub-01\taa000001\t2000-01-01\tprisma\t'
+            '[[3,"anat","T1w"],[4,"func","task-rest_bold"]]\n'
+        )
+
+    ret = neurospin_to_bids.__main__.main(
+        [
+            'neurospin_to_bids',
+            '--noninteractive',
+            '--conversion-backend',
+            'simulated',
+            '--jobs',
+            '2',
+            '--acquisition-dir',
+            str(tmp_path / 'acq'),
+            '--root-path',
+            str(tmp_path),
+        ]
+    )
+    assert ret == 0
+    for record in caplog.records:
+        assert record.levelno < logging.ERROR
+    sub_dir = tmp_path / 'rawdata' / 'sub-01'
+    assert (sub_dir / 'anat' / 'sub-01_T1w.nii.gz').is_file()
+    assert (sub_dir / 'func' / 'sub-01_task-rest_bold.nii.gz').is_file()
+    with (sub_dir / 'func' / 'sub-01_task-rest_bold.json').open() as f:
+        assert json.load(f)['TaskName'] == 'rest'
+    (schedule_report,) = (tmp_path / 'report').glob('conversion_schedule_*.tsv')
+    assert len(schedule_report.read_text().splitlines()) == 3
+
+
+def test_import_mri_stage_workers(tmp_path, caplog):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    for series in (
+        '000003_mprage-sag-T1',
+        '000004_mbepi-3mm-PA',
+        '000005_mbepi-3mm-AP',
+    ):
+        (ses_dir / series).mkdir(parents=True)
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_to_import.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        'sub-01\taa000001\t2000-01-01\tprisma\t'
+        '[[3,"anat","T1w"],[4,"func","task-rest_run-1_bold"],'
+        '[5,"func","task-rest_run-2_bold"]]\n'
+    )
+
+    ret = neurospin_to_bids.__main__.main(
+        [
+            'neurospin_to_bids',
+            '--noninteractive',
+            '--conversion-backend',
+            'simulated',
+            '--jobs',
+            '2',
+            '--stage-workers',
+            'postprocess=2',
+            '--stage-workers',
+            'sidecar=3',
+            '--acquisition-dir',
+            str(tmp_path / 'acq'),
+            '--root-path',
+            str(tmp_path),
+        ]
+    )
+    assert ret == 0
+    for record in caplog.records:
+        assert record.levelno < logging.ERROR
+    sub_dir = tmp_path / 'rawdata' / 'sub-01'
+    assert (sub_dir / 'anat' / 'sub-01_T1w.nii.gz').is_file()
+    for run in (1, 2):
+        stem = f'sub-01_task-rest_run-{run}_bold'
+        assert (sub_dir / 'func' / (stem + '.nii.gz')).is_file()
+        with (sub_dir / 'func' / (stem + '.json')).open() as f:
+            assert json.load(f)['TaskName'] == 'rest'
+    assert (sub_dir / 'downloaded').is_file()
+
+
+def test_import_mri_gzip_threads(tmp_path, caplog):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000004_mbepi-3mm-PA').mkdir()
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_to_import.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        'sub-01\taa000001\t2000-01-01\tprisma\t'
+        '[[3,"anat","T1w"],[4,"func","task-rest_bold"]]\n'
+    )
+
+    ret = neurospin_to_bids.__main__.main(
+        [
+            'neurospin_to_bids',
+            '--noninteractive',
+            '--conversion-backend',
+            'simulated',
+            '--jobs',
+            '2',
+            '--gzip-threads',
+            '2',
+            '--acquisition-dir',
+            str(tmp_path / 'acq'),
+            '--root-path',
+            str(tmp_path),
+        ]
+    )
+    assert ret == 0
+    for record in caplog.records:
+        assert record.levelno < logging.ERROR
+    sub_dir = tmp_path / 'rawdata' / 'sub-01'
+    # The outputs are compressed, and the uncompressed files removed
+    for stem in ('anat/sub-01_T1w', 'func/sub-01_task-rest_bold'):
+        with gzip.open(sub_dir / (stem + '.nii.gz')) as f:
+            assert nibabel.Nifti1Image.from_bytes(f.read()).shape == (4, 4, 4)
+        assert not (sub_dir / (stem + '.nii')).exists()
+    with (sub_dir / 'func' / 'sub-01_task-rest_bold.json').open() as f:
+        assert json.load(f)['TaskName'] == 'rest'
+
+
+def test_disk_space_check_with_gzip_threads(tmp_path, monkeypatch, caplog):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000003_mprage-sag-T1' / '1.dcm').write_bytes(b'x' * 10000)
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_to_import.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        'sub-01\taa000001\t2000-01-01\tprisma\t[[3,"anat","T1w"]]\n'
+    )
+    requirements = []
+    real_check_disk_space = neurospin_to_bids.scheduling.check_disk_space
+
+    def check_disk_space(space_requirements):
+        requirements.extend(space_requirements)
+        return real_check_disk_space(space_requirements)
+
+    monkeypatch.setattr(
+        neurospin_to_bids.scheduling, 'check_disk_space', check_disk_space
+    )
+    monkeypatch.setattr(neurospin_to_bids.compress, 'find_pigz', lambda: None)
+    ret = neurospin_to_bids.__main__.main(
+        [
+            'neurospin_to_bids',
+            '--noninteractive',
+            '--conversion-backend',
+            'simulated',
+            '--gzip-threads',
+            '2',
+            '--acquisition-dir',
+            str(tmp_path / 'acq'),
+            '--root-path',
+            str(tmp_path),
+        ]
+    )
+    assert ret == 0
+    # The converter writes uncompressed NIfTI, compressed in a later stage
+    assert requirements[0] == (
+        str(tmp_path / 'rawdata'),
+        neurospin_to_bids.scheduling.estimate_output_size(
+            {'size': 10000}, compressed=False
+        ),
+    )
+    # Without pigz, the files are compressed in a single thread each
+    assert 'pigz is not installed' in caplog.text
+
+
+def test_conversion_cache_shared_with_separate_gzip(tmp_path):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000003_mprage-sag-T1' / '1.dcm').write_bytes(b'DICM')
+    # The same session is imported into two studies sharing one cache, first
+    # with compression in a separate stage, then with the default options
+    for study, extra_args in (('study1', ['--gzip-threads', '1']), ('study2', [])):
+        exp_info_dir = tmp_path / study / 'exp_info'
+        exp_info_dir.mkdir(parents=True)
+        (exp_info_dir / 'participants_to_import.tsv').write_text(
+            'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+            'sub-01\taa000001\t2000-01-01\tprisma\t[[3,"anat","T1w"]]\n'
+        )
+        ret = neurospin_to_bids.__main__.main(
+            [
+                'neurospin_to_bids',
+                '--noninteractive',
+                '--conversion-backend',
+                'simulated',
+                *extra_args,
+                '--cache-dir',
+                str(tmp_path / 'cache'),
+                '--acquisition-dir',
+                str(tmp_path / 'acq'),
+                '--root-path',
+                str(tmp_path / study),
+            ]
+        )
+        assert ret == 0
+        anat_dir = tmp_path / study / 'rawdata' / 'sub-01' / 'anat'
+        assert (anat_dir / 'sub-01_T1w.nii.gz').is_file()
+        assert not (anat_dir / 'sub-01_T1w.nii').exists()
+
+
+def test_prefetch_skips_meg_sessions(tmp_path, monkeypatch):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_to_import.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        'sub-01\taa000001\t2000-01-01\tprisma\t[[3,"anat","T1w"]]\n'
+        'sub-01\taa000001\t2000-01-15\tmeg\t[]\n'
+    )
+    lookups = []
+    resolver_class = neurospin_to_bids.acquisition_db.SessionResolver
+    real_prefetch = resolver_class.prefetch
+
+    def prefetch(self, session_lookups, **kwargs):
+        session_lookups = list(session_lookups)
+        lookups.extend(session_lookups)
+        return real_prefetch(self, session_lookups, **kwargs)
+
+    monkeypatch.setattr(resolver_class, 'prefetch', prefetch)
+    ret = neurospin_to_bids.__main__.main(
+        [
+            'neurospin_to_bids',
+            '--noninteractive',
+            '--conversion-backend',
+            'simulated',
+            '--acquisition-dir',
+            str(tmp_path / 'acq'),
+            '--root-path',
+            str(tmp_path),
+        ]
+    )
+    assert ret == 0
+    # MEG sessions are not in dated directories of the MRI layout
+    assert lookups == [('prisma', '20000101', 'aa000001')]
+
+
+def test_reimport_skips_unchanged_series(tmp_path, caplog):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000003_mprage-sag-T1' / '1.dcm').write_bytes(b'DICM')
+    (ses_dir / '000004_mbepi-3mm-PA').mkdir()
+    (ses_dir / '000004_mbepi-3mm-PA' / '1.dcm').write_bytes(b'DICM')
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    participants_to_import = exp_info_dir / 'participants_to_import.tsv'
+    participants_to_import.write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        'sub-01\taa000001\t2000-01-01\tprisma\t'
+        '[[3,"anat","T1w"],[4,"func","task-rest_bold"]]\n'
+    )
+    argv = [
+        'neurospin_to_bids',
+        '--noninteractive',
+        '--conversion-backend',
+        'simulated',
+        '--acquisition-dir',
+        str(tmp_path / 'acq'),
+        '--root-path',
+        str(tmp_path),
+    ]
+    caplog.set_level(logging.INFO)
+
+    assert neurospin_to_bids.__main__.main(argv) == 0
+    assert 'converting 2 series' in caplog.text
+    assert (tmp_path / 'rawdata' / 'sub-01' / 'downloaded').is_file()
+
+    # No series is converted again
+    caplog.clear()
+    assert neurospin_to_bids.__main__.main(argv) == 0
+    assert 'converting 0 series' in caplog.text
+
+    # Only the modified series is converted again, although the session is
+    # marked as imported
+    (ses_dir / '000004_mbepi-3mm-PA' / '2.dcm').write_bytes(b'DICM')
+    caplog.clear()
+    assert neurospin_to_bids.__main__.main(argv) == 0
+    assert 'converting 1 series' in caplog.text
+
+
+def test_import_mri_output_staging(tmp_path, caplog):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000004_mbepi-3mm-PA').mkdir()
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    with (exp_info_dir / 'participants_to_import.tsv').open(mode='w') as f:
+        f.write(
+            'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+            'sub-01\taa000001\t2000-01-01\tprisma\t'
+            '[[3,"anat","T1w"],[4,"func","task-rest_bold"]]\n'
+        )
+
+    ret = neurospin_to_bids.__main__.main(
+        [
+            'neurospin_to_bids',
+            '--noninteractive',
+            '--conversion-backend',
+            'simulated',
+            '--output-staging-dir',
+            str(tmp_path / 'scratch'),
+            '--acquisition-dir',
+            str(tmp_path / 'acq'),
+            '--root-path',
+            str(tmp_path),
+        ]
+    )
+    assert ret == 0
+    for record in caplog.records:
+        assert record.levelno < logging.ERROR
+    sub_dir = tmp_path / 'rawdata' / 'sub-01'
+    assert (sub_dir / 'anat' / 'sub-01_T1w.nii.gz').is_file()
+    with (sub_dir / 'func' / 'sub-01_task-rest_bold.json').open() as f:
+        assert json.load(f)['TaskName'] == 'rest'
+    assert (sub_dir / 'downloaded').is_file()
+    assert sorted(p.name for p in (tmp_path / 'rawdata').iterdir() if p.is_dir()) == [
+        'sub-01'
+    ]
+    assert list((tmp_path / 'scratch').iterdir()) == []
+
+
+def test_import_resume_from_journal(tmp_path, caplog):
+    ses_dir = (
+        tmp_path / 'acq' / 'database' / 'Prisma_fit' / '20000101' / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000004_mbepi-3mm-PA').mkdir()
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_to_import.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        'sub-01\taa000001\t2000-01-01\tprisma\t'
+        '[[3,"anat","T1w"],[4,"func","task-rest_bold"]]\n'
+    )
+    argv = [
+        'neurospin_to_bids',
+        '--noninteractive',
+        '--conversion-backend',
+        'simulated',
+        '--acquisition-dir',
+        str(tmp_path / 'acq'),
+        '--root-path',
+        str(tmp_path),
+    ]
+    caplog.set_level(logging.INFO)
+    assert neurospin_to_bids.__main__.main(argv) == 0
+    journal_file = tmp_path / 'report' / 'conversion_journal.jsonl'
+    entries = [json.loads(line) for line in journal_file.read_text().splitlines()]
+    assert [entry['state'] for entry in entries].count('patched') == 2
+
+    # Simulate the failure of the post-processing of the bold series
+    sub_dir = tmp_path / 'rawdata' / 'sub-01'
+    bold_key = next(e['key'] for e in entries if e.get('key', '').endswith('_bold'))
+    with journal_file.open('a') as f:
+        f.write(json.dumps({'state': 'failed', 'key': bold_key}) + '\n')
+    (sub_dir / 'func' / 'sub-01_task-rest_bold.nii.gz').unlink()
+    (sub_dir / 'downloaded').unlink()
+
+    caplog.clear()
+    assert neurospin_to_bids.__main__.main([*argv, '--resume']) == 0
+    assert 'resuming the conversion of 0 series' in caplog.text
+
+    caplog.clear()
+    assert neurospin_to_bids.__main__.main([*argv, '--retry-failed']) == 0
+    assert 'resuming the conversion of 1 series' in caplog.text
+    assert (sub_dir / 'func' / 'sub-01_task-rest_bold.nii.gz').is_file()
+    with (sub_dir / 'func' / 'sub-01_task-rest_bold.json').open() as f:
+        assert json.load(f)['TaskName'] == 'rest'
+    assert (sub_dir / 'downloaded').is_file()
+
+    # Simulate a run that died while converting the bold series
+    with journal_file.open('a') as f:
+        f.write(json.dumps({'state': 'converted', 'key': bold_key}) + '\n')
+    partial_file = sub_dir / 'func' / 'sub-01_task-rest_bold_e2.nii.gz'
+    partial_file.write_bytes(b'partial')
+    caplog.clear()
+    assert neurospin_to_bids.__main__.main([*argv, '--resume']) == 0
+    assert 'resuming the conversion of 1 series' in caplog.text
+    # The partial outputs of the interrupted conversion are removed
+    assert not partial_file.exists()
+    assert (sub_dir / 'func' / 'sub-01_task-rest_bold.nii.gz').is_file()
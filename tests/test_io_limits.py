@@ -0,0 +1,95 @@
+import threading
+import time
+
+import neurospin_to_bids.acquisition_db
+import neurospin_to_bids.convert
+import neurospin_to_bids.io_limits
+import neurospin_to_bids.scheduling
+from neurospin_to_bids import utils
+
+
+def _run_reads(limit, read, count, workers):
+    def task(_):
+        with limit.reader(1000):
+            read()
+
+    list(utils.imap_unordered_bounded(task, range(count), workers))
+
+
+def test_limits_per_database(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_ROOT_PATH', str(tmp_path))
+    limits = neurospin_to_bids.io_limits.ArchiveLimits({'prisma': 2}, default=3)
+    assert limits.get_limit(
+        str(tmp_path / 'database' / 'Prisma_fit' / '20000101')
+    ) is limits.get_limit(str(tmp_path / 'database' / 'Prisma_fit'))
+    assert limits.current_limits()['prisma'] == 2
+    assert limits.current_limits()['meg'] == 3
+
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def read():
+        with lock:
+            active.append(None)
+            peak.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.pop()
+
+    prisma_limit = limits.get_limit(str(tmp_path / 'database' / 'Prisma_fit'))
+    _run_reads(prisma_limit, read, 20, 8)
+    assert max(peak) == 2
+
+
+def test_autotune():
+    # Reads with a fixed latency: the throughput grows with concurrency
+    limit = neurospin_to_bids.io_limits.ConcurrencyLimit(
+        1, autotune=True, max_limit=4, window=4
+    )
+    _run_reads(limit, lambda: time.sleep(0.01), 80, 8)
+    assert limit.limit > 2
+
+    # Reads serialized by the backend: latency grows, not throughput
+    backend = threading.Lock()
+
+    def serialized_read():
+        with backend:
+            time.sleep(0.005)
+
+    limit = neurospin_to_bids.io_limits.ConcurrencyLimit(8, autotune=True, window=4)
+    _run_reads(limit, serialized_read, 120, 8)
+    assert limit.limit < 8
+
+
+def test_conversion_takes_reader_slot_after_reservations(tmp_path, monkeypatch):
+    limits = neurospin_to_bids.io_limits.ArchiveLimits(default=2)
+    monkeypatch.setattr(neurospin_to_bids.acquisition_db, 'IO_LIMITS', limits)
+    reader_limit = limits.get_limit(str(tmp_path))
+    active_readers = []
+
+    class Backend(neurospin_to_bids.convert.SimulatedBackend):
+        def convert_series(self, file_to_convert):
+            active_readers.append(reader_limit.active)
+            return super().convert_series(file_to_convert)
+
+    # The memory budget only admits one conversion at a time
+    backend = Backend(
+        {'isGz': True},
+        jobs=2,
+        memory_budget=neurospin_to_bids.scheduling.ResourceBudget(1),
+        latency=0.05,
+    )
+    files_to_convert = [
+        {
+            'in_dir': str(tmp_path / f'00000{i}_series'),
+            'out_dir': str(tmp_path),
+            'filename': f'sub-01_run-{i}_bold',
+        }
+        for i in range(1, 5)
+    ]
+    results = list(backend.convert(files_to_convert))
+    assert [result.returncode for result in results] == [0] * 4
+    # Conversions waiting for memory do not hold a reader slot
+    assert active_readers == [1] * 4
@@ -0,0 +1,30 @@
+import neurospin_to_bids.journal
+
+
+def test_journal_load(tmp_path):
+    journal = neurospin_to_bids.journal.Journal(str(tmp_path / 'journal.jsonl'))
+    journal.start_plan()
+    journal.plan_series('sub-01/anat/sub-01_T1w', {'in_dir': 'old'})
+    journal.record('sub-01/anat/sub-01_T1w', 'patched')
+    # A new plan supersedes the previous one
+    journal.start_plan()
+    journal.plan_session('rawdata/sub-01', [[3, 'anat', 'T1w']], ['a', 'b'], True)
+    journal.plan_series('a', {'in_dir': 'dicom_a'})
+    journal.plan_series('b', {'in_dir': 'dicom_b'})
+    journal.record('a', 'converted')
+    journal.record('b', 'failed', error='conversion failed')
+    journal.close()
+    # Line truncated by a crash
+    with open(journal.filename, 'a') as f:
+        f.write('{"key": "a", "sta')
+
+    sessions, series, states = journal.load()
+    assert sessions == {
+        'rawdata/sub-01': {
+            'to_import': [[3, 'anat', 'T1w']],
+            'series_keys': ['a', 'b'],
+            'complete': True,
+        }
+    }
+    assert series == {'a': {'in_dir': 'dicom_a'}, 'b': {'in_dir': 'dicom_b'}}
+    assert states == {'a': 'converted', 'b': 'failed'}
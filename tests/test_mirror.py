@@ -0,0 +1,66 @@
+import os
+import shutil
+
+import neurospin_to_bids.acquisition_db
+import neurospin_to_bids.convert
+import neurospin_to_bids.mirror
+
+
+def make_series(series_dir, size):
+    series_dir.mkdir(parents=True)
+    (series_dir / '1.dcm').write_bytes(b'x' * size)
+
+
+def test_archive_mirror(tmp_path, monkeypatch):
+    series_a = tmp_path / 'acq' / '000003_mprage'
+    series_b = tmp_path / 'acq' / '000004_bold'
+    make_series(series_a, 10)
+    make_series(series_b, 10)
+    mirror = neurospin_to_bids.mirror.ArchiveMirror(
+        str(tmp_path / 'mirror'), max_size=15
+    )
+    copied = []
+    real_copy2 = shutil.copy2
+    monkeypatch.setattr(
+        shutil, 'copy2', lambda src, dst: copied.append(src) or real_copy2(src, dst)
+    )
+
+    with mirror.open(str(series_a)) as local_dir:
+        assert os.path.basename(local_dir) == '000003_mprage'
+        assert not local_dir.startswith(str(series_a))
+        assert os.listdir(local_dir) == ['1.dcm']
+    with mirror.open(str(series_a)) as local_dir:
+        assert os.listdir(local_dir) == ['1.dcm']
+    assert len(copied) == 1
+
+    # A modified series is copied again
+    (series_a / '2.dcm').write_bytes(b'x')
+    with mirror.open(str(series_a)) as local_dir:
+        assert sorted(os.listdir(local_dir)) == ['1.dcm', '2.dcm']
+    assert len(copied) == 3
+
+    # The least recently used series is evicted, unless it is in use
+    with mirror.open(str(series_a)) as local_dir_a:
+        with mirror.open(str(series_b)) as local_dir_b:
+            assert mirror.total_size() == 21
+        assert os.path.isdir(local_dir_a)
+        assert not os.path.exists(local_dir_b)
+    assert mirror.total_size() == 11
+
+
+def test_convert_through_mirror(tmp_path, monkeypatch):
+    series_dir = tmp_path / 'acq' / '000003_mprage'
+    make_series(series_dir, 10)
+    (tmp_path / 'out').mkdir()
+    mirror = neurospin_to_bids.mirror.ArchiveMirror(str(tmp_path / 'mirror'))
+    monkeypatch.setattr(neurospin_to_bids.acquisition_db, 'MIRROR', mirror)
+    backend = neurospin_to_bids.convert.get_backend('simulated', {'isGz': True}, jobs=1)
+    file_to_convert = {
+        'in_dir': str(series_dir),
+        'out_dir': str(tmp_path / 'out'),
+        'filename': 'sub-01_T1w',
+    }
+    (result,) = backend.convert([file_to_convert])
+    assert result.returncode == 0
+    assert result.series == file_to_convert
+    assert mirror.total_size() == 10
@@ -0,0 +1,56 @@
+import os
+
+import neurospin_to_bids.output_staging
+
+
+def test_commit_session(tmp_path):
+    dataset_dir = tmp_path / 'rawdata'
+    session_dir = dataset_dir / 'sub-01' / 'ses-01'
+    (session_dir / 'anat').mkdir(parents=True)
+    (session_dir / 'anat' / 'sub-01_ses-01_T1w.json').write_text('old')
+    (session_dir / 'anat' / 'sub-01_ses-01_T2w.json').write_text('kept')
+    staging = neurospin_to_bids.output_staging.OutputStaging(
+        str(tmp_path / 'scratch'), str(dataset_dir)
+    )
+    local_dir = staging.local_path(str(session_dir / 'anat'))
+    os.makedirs(local_dir)
+    with open(os.path.join(local_dir, 'sub-01_ses-01_T1w.json'), 'w') as f:
+        f.write('new')
+    # Nothing is visible in the dataset before the commit
+    assert (session_dir / 'anat' / 'sub-01_ses-01_T1w.json').read_text() == 'old'
+
+    staging.commit(str(session_dir))
+    assert (session_dir / 'anat' / 'sub-01_ses-01_T1w.json').read_text() == 'new'
+    assert (session_dir / 'anat' / 'sub-01_ses-01_T2w.json').read_text() == 'kept'
+    assert os.listdir(dataset_dir / 'sub-01') == ['ses-01']
+    assert not os.path.exists(staging.local_path(str(session_dir)))
+
+    staging.cleanup()
+    assert os.listdir(tmp_path / 'scratch') == []
+
+
+def test_commit_recovers_interrupted_commit(tmp_path):
+    dataset_dir = tmp_path / 'rawdata'
+    subject_dir = dataset_dir / 'sub-01'
+    # A commit was interrupted between its two renames
+    old_session_dir = subject_dir / '.ses-01.old-0000' / 'ses-01'
+    (old_session_dir / 'anat').mkdir(parents=True)
+    (old_session_dir / 'anat' / 'sub-01_ses-01_T2w.json').write_text('kept')
+    (subject_dir / '.ses-01.partial-0000' / 'anat').mkdir(parents=True)
+    staging = neurospin_to_bids.output_staging.OutputStaging(
+        str(tmp_path / 'scratch'), str(dataset_dir)
+    )
+    session_dir = subject_dir / 'ses-01'
+    local_dir = staging.local_path(str(session_dir / 'anat'))
+    os.makedirs(local_dir)
+    with open(os.path.join(local_dir, 'sub-01_ses-01_T1w.json'), 'w') as f:
+        f.write('new')
+
+    staging.commit(str(session_dir))
+    # The previous contents are restored, then updated
+    assert sorted(os.listdir(session_dir / 'anat')) == [
+        'sub-01_ses-01_T1w.json',
+        'sub-01_ses-01_T2w.json',
+    ]
+    assert os.listdir(subject_dir) == ['ses-01']
+    staging.cleanup()
@@ -0,0 +1,49 @@
+import threading
+import time
+
+import pytest
+
+import neurospin_to_bids.pipeline
+
+
+def test_run_pipeline():
+    stages = [
+        neurospin_to_bids.pipeline.Stage('double', lambda x: 2 * x, workers=3),
+        neurospin_to_bids.pipeline.Stage(
+            'filter', transform=lambda items: (x for x in items if x % 3)
+        ),
+        neurospin_to_bids.pipeline.Stage('increment', lambda x: x + 1),
+    ]
+    results = list(neurospin_to_bids.pipeline.run_pipeline(range(10), stages))
+    assert sorted(results) == [3, 5, 9, 11, 15, 17]
+
+
+def test_run_pipeline_overlaps_stages():
+    first_item_done = threading.Event()
+
+    def slow_source():
+        yield 1
+        # The next item is only produced once the first one is through
+        assert first_item_done.wait(timeout=5)
+        yield 2
+
+    stages = [neurospin_to_bids.pipeline.Stage('identity', lambda x: x)]
+    results = []
+    for item in neurospin_to_bids.pipeline.run_pipeline(slow_source(), stages):
+        results.append(item)
+        first_item_done.set()
+    assert results == [1, 2]
+
+
+def test_run_pipeline_error():
+    def fail_on_3(x):
+        if x == 3:
+            raise ValueError('failed on 3')
+        return x
+
+    stages = [
+        neurospin_to_bids.pipeline.Stage('fail', fail_on_3),
+        neurospin_to_bids.pipeline.Stage('slow', lambda x: time.sleep(0.01) or x),
+    ]
+    with pytest.raises(ValueError, match='failed on 3'):
+        list(neurospin_to_bids.pipeline.run_pipeline(range(100), stages, queue_size=2))
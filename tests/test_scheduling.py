@@ -0,0 +1,153 @@
+import errno
+import shutil
+
+import pytest
+import yaml
+
+import neurospin_to_bids.convert
+import neurospin_to_bids.scheduling
+
+
+def test_longest_first():
+    files_to_convert = [
+        {'in_dir': 'localizer', 'file_count': 3, 'size': 1_000_000},
+        {'in_dir': 'bold', 'file_count': 3000, 'size': 600_000_000},
+        {'in_dir': 'unknown'},
+        {'in_dir': 'T1w', 'file_count': 176, 'size': 40_000_000},
+    ]
+    ordered = neurospin_to_bids.scheduling.longest_first(files_to_convert)
+    assert [f['in_dir'] for f in ordered] == ['bold', 'T1w', 'localizer', 'unknown']
+
+
+def test_write_schedule_report(tmp_path):
+    series = {'in_dir': 'bold', 'file_count': 10, 'size': 100_000_000}
+    results = [
+        neurospin_to_bids.convert.ConversionResult(series, 0, [], 1.25),
+        neurospin_to_bids.convert.ConversionResult({'in_dir': 'cached'}, 0, []),
+    ]
+    report = tmp_path / 'schedule.tsv'
+    neurospin_to_bids.scheduling.write_schedule_report(str(report), results)
+    assert report.read_text().splitlines() == [
+        'in_dir\tfile_count\tsize\testimated_duration\tduration\treturncode',
+        'bold\t10\t100000000\t1.52\t1.25\t0',
+        'cached\tn/a\tn/a\t0.50\tn/a\t0',
+    ]
+
+
+def test_resource_budget():
+    budget = neurospin_to_bids.scheduling.ResourceBudget(100)
+    with budget.reserve(60):
+        assert budget.used == 60
+        # A small job still fits while a large one would have to wait
+        with budget.reserve(40):
+            assert budget.used == 100
+    assert budget.used == 0
+    # A job larger than the capacity is admitted when nothing else runs
+    with budget.reserve(500):
+        assert budget.used == 500
+    assert budget.used == 0
+
+
+def test_backend_with_memory_budget(tmp_path):
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    files_to_convert = [
+        {
+            'in_dir': f'series{i}',
+            'out_dir': str(out_dir),
+            'filename': f's{i}',
+            'file_count': 10,
+            'size': 2**20 * (i + 1),
+        }
+        for i in range(6)
+    ]
+    budget = neurospin_to_bids.scheduling.ResourceBudget(
+        2 * neurospin_to_bids.scheduling.estimate_peak_memory(files_to_convert[-1])
+    )
+    peak = 0
+
+    class MeasuringBackend(neurospin_to_bids.convert.SimulatedBackend):
+        def convert_series(self, file_to_convert):
+            nonlocal peak
+            peak = max(peak, budget.used)
+            return super().convert_series(file_to_convert)
+
+    backend = MeasuringBackend(
+        {'isGz': True}, jobs=4, memory_budget=budget, latency=0.01
+    )
+    results = list(backend.convert(files_to_convert))
+    assert len(results) == 6
+    assert all(result.duration is not None for result in results)
+    assert 0 < peak <= budget.capacity
+
+
+def test_check_disk_space(tmp_path):
+    free = shutil.disk_usage(tmp_path).free
+    assert (
+        neurospin_to_bids.scheduling.check_disk_space(
+            [(str(tmp_path / 'rawdata'), 1000), (str(tmp_path / 'sourcedata'), 1000)]
+        )
+        == []
+    )
+    (shortfall,) = neurospin_to_bids.scheduling.check_disk_space(
+        [
+            (str(tmp_path / 'rawdata'), free // 2 + 1),
+            (str(tmp_path / 'scratch' / 'cache'), free // 2 + 1),
+        ]
+    )
+    assert shortfall.startswith('not enough disk space for ')
+
+
+def test_disk_space_admission(tmp_path):
+    admission = neurospin_to_bids.scheduling.DiskSpaceAdmission()
+    free = shutil.disk_usage(tmp_path).free
+    with admission.reserve(str(tmp_path / 'sub-01'), free // 2 + 1):
+        # The space reserved by running conversions is not available
+        with (
+            pytest.raises(OSError) as excinfo,
+            admission.reserve(str(tmp_path / 'sub-02'), free // 2 + 1),
+        ):
+            pass
+        assert excinfo.value.errno == errno.ENOSPC
+    with admission.reserve(str(tmp_path / 'sub-02'), free // 2 + 1):
+        pass
+
+
+def test_dcm2niibatch_disk_space_admission(tmp_path, monkeypatch):
+    free = shutil.disk_usage(tmp_path).free
+    batches = []
+
+    def call(cmd):
+        with open(cmd[1]) as f:
+            batches.append(yaml.safe_load(f))
+        return 0
+
+    monkeypatch.setattr(neurospin_to_bids.convert.subprocess, 'call', call)
+    backend = neurospin_to_bids.convert.get_backend(
+        'dcm2niibatch',
+        {'isGz': True},
+        batch_file=str(tmp_path / 'batch.yaml'),
+        disk_space=neurospin_to_bids.scheduling.DiskSpaceAdmission(),
+    )
+    files_to_convert = [
+        {
+            'in_dir': str(tmp_path / '000003_small'),
+            'out_dir': str(tmp_path),
+            'filename': 'sub-01_T1w',
+            'size': 1000,
+        },
+        {
+            'in_dir': str(tmp_path / '000004_huge'),
+            'out_dir': str(tmp_path),
+            'filename': 'sub-01_T2w',
+            'size': 2 * free,
+        },
+    ]
+    results = {
+        result.series['filename']: result.returncode
+        for result in backend.convert(files_to_convert)
+    }
+    assert results['sub-01_T2w'] == errno.ENOSPC
+    # The series that does not fit is left out of the batch
+    (batch,) = batches
+    assert [series['filename'] for series in batch['Files']] == ['sub-01_T1w']
@@ -0,0 +1,82 @@
+import os
+import time
+
+import neurospin_to_bids.convert
+import neurospin_to_bids.staging
+
+
+def make_series(tmp_path, count):
+    files_to_convert = []
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    for i in range(count):
+        in_dir = tmp_path / 'acq' / f'{i:06d}_series'
+        in_dir.mkdir(parents=True)
+        for j in range(3):
+            (in_dir / f'{j}.dcm').write_bytes(b'x' * 100)
+        files_to_convert.append(
+            {'in_dir': str(in_dir), 'out_dir': str(out_dir), 'filename': f's{i}'}
+        )
+    return files_to_convert
+
+
+def scratch_size(scratch_dir):
+    return sum(
+        os.path.getsize(os.path.join(dir_path, name))
+        for dir_path, _, names in os.walk(scratch_dir)
+        for name in names
+    )
+
+
+def test_stager_respects_quota(tmp_path):
+    files_to_convert = make_series(tmp_path, 4)
+    scratch_dir = tmp_path / 'scratch'
+    staged_sizes = []
+    stager = neurospin_to_bids.staging.SeriesStager(
+        str(scratch_dir),
+        depth=3,
+        quota=400,
+        on_staged=lambda file_to_convert: staged_sizes.append(
+            scratch_size(scratch_dir)
+        ),
+    )
+    staged = []
+    for file_to_convert, staged_dir in stager.stage(files_to_convert):
+        assert staged_dir is not None
+        assert sorted(os.listdir(staged_dir)) == ['0.dcm', '1.dcm', '2.dcm']
+        # Only one series (300 bytes) fits in the quota: the next one is not
+        # staged until this one is released
+        time.sleep(0.05)
+        assert scratch_size(scratch_dir) == 300
+        staged.append(file_to_convert)
+        stager.release(staged_dir)
+        assert not os.path.exists(staged_dir)
+    assert staged == files_to_convert
+    assert staged_sizes == [300] * 4
+    assert os.listdir(scratch_dir) == []
+
+
+def test_stager_cleans_up_when_stopped(tmp_path):
+    files_to_convert = make_series(tmp_path, 4)
+    stager = neurospin_to_bids.staging.SeriesStager(str(tmp_path / 'scratch'), depth=2)
+    staging = stager.stage(files_to_convert)
+    _, staged_dir = next(staging)
+    stager.release(staged_dir)
+    # The series prefetched after the first one are removed
+    staging.close()
+    assert os.listdir(tmp_path / 'scratch') == []
+
+
+def test_backend_with_stager(tmp_path):
+    files_to_convert = make_series(tmp_path, 5)
+    stager = neurospin_to_bids.staging.SeriesStager(str(tmp_path / 'scratch'), depth=2)
+    backend = neurospin_to_bids.convert.SimulatedBackend(
+        {'isGz': True}, jobs=2, stager=stager, latency=0.01
+    )
+    results = list(backend.convert(files_to_convert))
+    assert len(results) == 5
+    # Results refer to the original series, not to the staged copies
+    assert sorted(result.series['in_dir'] for result in results) == sorted(
+        f['in_dir'] for f in files_to_convert
+    )
+    assert os.listdir(tmp_path / 'scratch') == []
@@ -0,0 +1,10 @@
+from neurospin_to_bids.utils import format_size
+
+
+def test_format_size():
+    assert format_size(0) == '0 B'
+    assert format_size(1000) == '1000 B'
+    # Estimated sizes are floats
+    assert format_size(512.4) == '512 B'
+    assert format_size(1536) == '1.5 KiB'
+    assert format_size(3 * 1024**3) == '3.0 GiB'
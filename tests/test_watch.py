@@ -0,0 +1,175 @@
+import datetime
+import os
+import time
+import types
+
+import neurospin_to_bids.__main__
+import neurospin_to_bids.acquisition_db
+import neurospin_to_bids.convert
+import neurospin_to_bids.watch
+
+
+def test_session_watcher(tmp_path):
+    ses_dir = tmp_path / 'aa000001-001_001'
+    watcher = neurospin_to_bids.watch.SessionWatcher(quiet_period=3600)
+    assert watcher.poll(str(ses_dir)) == 'missing'
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    assert watcher.poll(str(ses_dir)) == 'changing'
+    # Past sessions are stable as soon as they are seen
+    assert watcher.poll(str(tmp_path / 'aa000001-001_001'), immutable=True) == (
+        'changing'
+    )
+    other_dir = tmp_path / 'bb000002-001_001'
+    (other_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    assert watcher.poll(str(other_dir), immutable=True) == 'ready'
+    watcher.mark_imported(str(other_dir))
+    assert watcher.poll(str(other_dir), immutable=True) == 'imported'
+    assert watcher.is_done(str(other_dir))
+
+    watcher.quiet_period = 0
+    assert watcher.poll(str(ses_dir)) == 'ready'
+    watcher.mark_imported(str(ses_dir))
+    (ses_dir / '000003_mprage-sag-T1' / '1.dcm').write_bytes(b'x')
+    assert watcher.poll(str(ses_dir)) == 'ready'
+
+
+def test_watch_archive(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_ROOT_PATH', str(tmp_path / 'acq'))
+    today = datetime.date.today()
+    ses_dir = (
+        tmp_path
+        / 'acq'
+        / 'database'
+        / 'Prisma_fit'
+        / today.strftime('%Y%m%d')
+        / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    with (exp_info_dir / 'participants_to_import.tsv').open(mode='w') as f:
+        f.write(
+            'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+            f'sub-01\taa000001\t{today.isoformat()}\tprisma\t[[3,"anat","T1w"]]\n'
+            f'sub-02\tbb000002\t{today.isoformat()}\tprisma\t[[3,"anat","T1w"]]\n'
+        )
+    imports = []
+
+    def import_subjects(subjects):
+        imports.append([subject_info['subject_label'] for subject_info in subjects])
+
+    neurospin_to_bids.watch.watch_archive(
+        str(exp_info_dir),
+        import_subjects,
+        poll_interval=0,
+        quiet_period=0,
+        max_polls=2,
+    )
+    # The session is imported once, the missing session is never imported
+    assert imports == [['sub-01']]
+
+
+def test_watch_archive_retries_failed_import(tmp_path, monkeypatch):
+    acquisition_db = neurospin_to_bids.acquisition_db
+    monkeypatch.setattr(acquisition_db, 'ACQUISITION_ROOT_PATH', str(tmp_path / 'acq'))
+    today = datetime.date.today()
+    ses_dir = (
+        tmp_path
+        / 'acq'
+        / 'database'
+        / 'Prisma_fit'
+        / today.strftime('%Y%m%d')
+        / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_to_import.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        f'sub-01\taa000001\t{today.isoformat()}\tprisma\t[[3,"anat","T1w"]]\n'
+    )
+    statuses = [1, 0]
+    imports = []
+
+    def import_subjects(subjects):
+        imports.append([subject_info['subject_label'] for subject_info in subjects])
+        return statuses.pop(0)
+
+    neurospin_to_bids.watch.watch_archive(
+        str(exp_info_dir),
+        import_subjects,
+        poll_interval=0,
+        quiet_period=0,
+        max_polls=3,
+    )
+    # The failed import is attempted again, although the session is unchanged
+    assert imports == [['sub-01'], ['sub-01']]
+
+
+def test_watch_retries_failed_conversion(tmp_path, monkeypatch):
+    today = datetime.date.today()
+    ses_dir = (
+        tmp_path
+        / 'acq'
+        / 'database'
+        / 'Prisma_fit'
+        / today.strftime('%Y%m%d')
+        / 'aa000001-001_001'
+    )
+    (ses_dir / '000003_mprage-sag-T1').mkdir(parents=True)
+    (ses_dir / '000004_mbepi-3mm-PA').mkdir()
+    exp_info_dir = tmp_path / 'exp_info'
+    exp_info_dir.mkdir()
+    (exp_info_dir / 'participants_to_import.tsv').write_text(
+        'participant_id\tNIP\tacq_date\tlocation\tto_import\n'
+        f'sub-01\taa000001\t{today.isoformat()}\tprisma\t'
+        '[[3,"anat","T1w"],[4,"func","task-rest_bold"]]\n'
+    )
+    # The conversion of the functional series fails
+    converted = []
+    real_convert_series = neurospin_to_bids.convert.SimulatedBackend.convert_series
+
+    def convert_series(self, file_to_convert):
+        converted.append(os.path.basename(file_to_convert['in_dir']))
+        if file_to_convert['in_dir'].endswith('mbepi-3mm-PA'):
+            return neurospin_to_bids.convert.ConversionResult(file_to_convert, 1, [])
+        return real_convert_series(self, file_to_convert)
+
+    monkeypatch.setattr(
+        neurospin_to_bids.convert.SimulatedBackend, 'convert_series', convert_series
+    )
+    # Stop watching after two polls
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 2:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(
+        neurospin_to_bids.watch,
+        'time',
+        types.SimpleNamespace(monotonic=time.monotonic, sleep=sleep),
+    )
+
+    neurospin_to_bids.__main__.main(
+        [
+            'neurospin_to_bids',
+            '--watch',
+            '--poll-interval',
+            '1',
+            '--quiet-period',
+            '0',
+            '--conversion-backend',
+            'simulated',
+            '--acquisition-dir',
+            str(tmp_path / 'acq'),
+            '--root-path',
+            str(tmp_path),
+        ]
+    )
+    # The failed series is converted again at the next poll
+    assert converted.count('000004_mbepi-3mm-PA') == 2
+    assert converted.count('000003_mprage-sag-T1') == 1
+    assert not (tmp_path / 'rawdata' / 'sub-01' / 'downloaded').exists()